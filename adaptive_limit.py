@@ -0,0 +1,214 @@
+# adaptive_limit.py
+"""AIMD concurrency limits for fan-out jobs.
+
+A fixed semaphore is wrong for every fleet. It is too small for a healthy
+LAN segment and too large for a flaky WAN site. :class:`AdaptiveLimiter`
+handles this the way TCP handles its congestion window:
+
+* **Slow start.** Each healthy completion adds one slot, so the limit
+  doubles every round, until the first sign of trouble.
+* **Additive increase.** After that, each healthy completion adds
+  ``1/limit``, roughly one slot per round.
+* **Multiplicative decrease.** An overload signal (timeout, refused or reset
+  connection, refused channel) multiplies the limit by ``backoff``. At most
+  one decrease applies per round: failures of work started before the last
+  decrease do not count again.
+
+A completion is healthy when it succeeded and its latency stayed within
+``latency_factor`` times the fastest latency seen so far, so a site that is
+slowing down stops growing before it starts timing out. Errors that say
+nothing about load (bad credentials, unknown host) neither grow nor shrink
+the limit. Every limit change is recorded in :attr:`history` for per-job
+telemetry.
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+import asyncssh
+
+HISTORY_POINTS = 240  # limit changes kept per limiter (older ones are thinned)
+
+# Errors that mean "too much at once" rather than "this host is broken"
+_OVERLOAD_ERRORS = (
+    asyncio.TimeoutError,
+    TimeoutError,
+    ConnectionRefusedError,
+    ConnectionResetError,
+    asyncssh.ConnectionLost,
+    asyncssh.ChannelOpenError,
+)
+
+
+def is_overload(exc: BaseException) -> bool:
+    return isinstance(exc, _OVERLOAD_ERRORS)
+
+
+class AdaptiveLimiter:
+    """A semaphore whose size follows AIMD on completion latency and errors."""
+
+    def __init__(self, name: str, initial: int, *, minimum: int = 1, maximum: int = 1024,
+                 backoff: float = 0.5, latency_factor: float = 3.0, latency_floor: float = 0.25):
+        self.name = name
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(self.maximum, max(self.minimum, initial)))
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.latency_floor = latency_floor
+        self.slow_start = True
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.errors = 0
+        self.overloads = 0
+        self.decreases = 0
+        self.best_latency: float | None = None
+        self.latency_total = 0.0
+        self.wait_total = 0.0
+        self.history: list[dict] = []
+        self._epoch = 0
+        self._t0 = time.monotonic()
+        self._wakers: set[asyncio.Task] = set()
+        lock = asyncio.Lock()
+        self._cond = asyncio.Condition(lock)   # a permit came free
+        self._room = asyncio.Condition(lock)   # the queue for permits got shorter
+        self._record("start")
+
+    # ── Permits ──────────────────────────────────────────────────────────────
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one permit; yields a :class:`_Slot` to report the outcome on."""
+        requested = time.monotonic()
+        async with self._cond:
+            self.waiting += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    await self._cond.wait()
+            finally:
+                self.waiting -= 1
+                self._room.notify(1)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        started = time.monotonic()
+        self.wait_total += started - requested
+        slot = _Slot(self, self._epoch, started)
+        try:
+            yield slot
+        except BaseException as e:
+            if not slot.reported and not isinstance(e, asyncio.CancelledError):
+                slot.failed(e)
+            raise
+        finally:
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    async def wait_for_room(self) -> None:
+        """Wait until fewer than ``limit`` callers are queued for a permit.
+
+        Lets an upstream stage (connecting) run at most one batch ahead of
+        this one instead of piling up work that cannot start yet.
+        """
+        async with self._room:
+            while self.waiting >= int(self.limit):
+                await self._room.wait()
+
+    # ── Feedback ─────────────────────────────────────────────────────────────
+    def _on_success(self, latency: float) -> None:
+        self.completed += 1
+        self.latency_total += latency
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if latency > max(self.latency_floor, self.best_latency * self.latency_factor):
+            return  # slower than this fleet's baseline: hold, do not grow
+        before = int(self.limit)
+        self.limit = min(self.maximum, self.limit + (1.0 if self.slow_start else 1.0 / self.limit))
+        if int(self.limit) != before:
+            self._wake()
+            self._record("grow")
+
+    def _on_error(self, exc: BaseException, epoch: int) -> None:
+        self.completed += 1
+        self.errors += 1
+        if not is_overload(exc):
+            return
+        self.overloads += 1
+        if epoch < self._epoch:
+            return  # started before the last decrease; already accounted for
+        self._epoch += 1
+        self.slow_start = False
+        self.decreases += 1
+        self.limit = max(float(self.minimum), self.limit * self.backoff)
+        self._record(f"backoff:{type(exc).__name__}")
+
+    def _wake(self):
+        # A larger limit admits waiters; notify_all needs the condition's lock
+        async def notify():
+            async with self._cond:
+                self._cond.notify_all()
+                self._room.notify_all()
+        task = asyncio.get_running_loop().create_task(notify())
+        self._wakers.add(task)
+        task.add_done_callback(self._wakers.discard)
+
+    def close(self) -> None:
+        """Cancel pending wake-ups; call once nothing waits on the limiter any more."""
+        for task in list(self._wakers):
+            task.cancel()
+
+    def _record(self, reason: str) -> None:
+        self.history.append({
+            "t": round(time.monotonic() - self._t0, 3),
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "reason": reason,
+        })
+        if len(self.history) > HISTORY_POINTS:
+            # Keep the first point and every other later one
+            self.history = self.history[:1] + self.history[2::2]
+
+    # ── Telemetry ────────────────────────────────────────────────────────────
+    def stats(self) -> dict:
+        ok = self.completed - self.errors
+        return {
+            "limit": int(self.limit),
+            "min": self.minimum,
+            "max": self.maximum,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "phase": "slow_start" if self.slow_start else "avoidance",
+            "completed": self.completed,
+            "errors": self.errors,
+            "overloads": self.overloads,
+            "decreases": self.decreases,
+            "error_rate": round(self.errors / self.completed, 3) if self.completed else 0.0,
+            "best_latency_ms": round(self.best_latency * 1000, 1) if self.best_latency is not None else None,
+            "avg_latency_ms": round(self.latency_total / ok * 1000, 1) if ok else None,
+            "avg_wait_ms": round(self.wait_total / self.completed * 1000, 1) if self.completed else None,
+            "history": self.history,
+        }
+
+
+class _Slot:
+    """One held permit; report exactly one outcome (errors escaping the block count)."""
+
+    __slots__ = ("limiter", "epoch", "started", "reported")
+
+    def __init__(self, limiter: AdaptiveLimiter, epoch: int, started: float):
+        self.limiter = limiter
+        self.epoch = epoch
+        self.started = started
+        self.reported = False
+
+    def succeeded(self) -> None:
+        if not self.reported:
+            self.reported = True
+            self.limiter._on_success(time.monotonic() - self.started)
+
+    def failed(self, exc: BaseException) -> None:
+        if not self.reported:
+            self.reported = True
+            self.limiter._on_error(exc, self.epoch)
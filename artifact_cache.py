@@ -0,0 +1,177 @@
+# artifact_cache.py
+"""Content-addressed copies of scripts and uploads on the target hosts.
+
+Each host keeps a cache directory (``ARTIFACT_CACHE_DIR``, relative to the
+login directory) with one file per artifact, named by its SHA-256. One exec
+round trip per host checks for an entry of the right size and digest and,
+on a hit, copies it into place. On a miss the file is sent over SFTP to a
+``.part`` name and renamed into the cache. Entries beyond
+``ARTIFACT_CACHE_MAX_MB`` are removed least recently used first. Files
+outside ``ARTIFACT_CACHE_MIN_BYTES`` to that cap skip the cache. Per-run
+counts are in :class:`CacheStats`, worker totals at
+``/api/metrics/artifact_cache``.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import shlex
+from pathlib import Path
+
+import sftp_transfer
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.artifact_cache")
+
+
+ENABLED = os.getenv("ARTIFACT_CACHE_ENABLED", "1").lower() not in ("0", "false", "no", "off")
+REMOTE_DIR = os.getenv("ARTIFACT_CACHE_DIR", ".cache/terminalx/artifacts").rstrip("/") or "."
+MAX_BYTES = max(1, env_int("ARTIFACT_CACHE_MAX_MB", 2048)) * 1048576
+MIN_BYTES = max(0, env_int("ARTIFACT_CACHE_MIN_BYTES", 65536))
+HASH_CHUNK = 1048576
+STALE_PART_MINUTES = 60         # interrupted transfers older than this are removed
+
+
+class Artifact:
+    """A local file and its content address."""
+
+    __slots__ = ("path", "digest", "size")
+
+    def __init__(self, path: Path, digest: str, size: int):
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+    @property
+    def cacheable(self) -> bool:
+        return ENABLED and MIN_BYTES <= self.size <= MAX_BYTES
+
+    @property
+    def remote_path(self) -> str:
+        return f"{REMOTE_DIR}/{self.digest}"
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+async def prepare(path: Path, digest: str | None = None) -> Artifact:
+    """Hash ``path`` off the event loop (unless ``digest`` is already known)."""
+    if digest is None:
+        digest = await asyncio.to_thread(_sha256, path)
+    return Artifact(path, digest, path.stat().st_size)
+
+
+class CacheStats:
+    """Hits and misses of one run."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+
+    def summary(self) -> dict:
+        looked_up = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / looked_up, 3) if looked_up else None,
+            "bytes_sent": self.bytes_sent,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+totals = CacheStats()       # this worker, all runs
+
+
+def _record(stats: CacheStats, field: str, sent: int, saved: int) -> None:
+    for s in (stats, totals):
+        setattr(s, field, getattr(s, field) + 1)
+        s.bytes_sent += sent
+        s.bytes_saved += saved
+
+
+def _evict_command() -> str:
+    # Newest first; once the running total passes the cap, remove the rest
+    return (f"cd {shlex.quote(REMOTE_DIR)} && "
+            f"find . -maxdepth 1 -name '.*.part' -mmin +{STALE_PART_MINUTES} -delete 2>/dev/null; "
+            f"ls -t | {{ n=0; total=0; while IFS= read -r f; do "
+            f"s=$(wc -c < \"$f\"); n=$((n + 1)); total=$((total + s)); "
+            f"if [ $n -gt 1 ] && [ $total -gt {MAX_BYTES} ]; then rm -f -- \"$f\"; fi; done; }}")
+
+
+async def _lookup(conn, artifact: Artifact, then: str) -> bool:
+    """One round trip: True when the entry is there and intact (and ``then`` ran), else make sure the dir is."""
+    entry = shlex.quote(artifact.remote_path)
+    result = await conn.run(
+        f"if [ -f {entry} ] && [ \"$(wc -c < {entry})\" -eq {artifact.size} ] && "
+        f"[ \"$(sha256sum < {entry} | cut -d' ' -f1)\" = {artifact.digest} ]; then "
+        f"touch {entry} && {then or 'true'} && echo hit; "
+        f"else mkdir -p {shlex.quote(REMOTE_DIR)} && echo miss; fi",
+        check=False,
+    )
+    return (result.stdout or "").strip() == "hit"
+
+
+async def _insert(conn, artifact: Artifact, then: str, throttle=None, progress=None) -> None:
+    part = f"{REMOTE_DIR}/.{artifact.digest}.{secrets.token_hex(4)}.part"
+    async with conn.start_sftp_client() as sftp:
+        await sftp_transfer.put(sftp, artifact.path, part, throttle=throttle, progress=progress)
+    commands = [f"mv -f {shlex.quote(part)} {shlex.quote(artifact.remote_path)}"]
+    if then:
+        commands.append(then)
+    result = await conn.run(" && ".join(commands) + f"; {_evict_command()}", check=False)
+    if result.exit_status not in (0, None):
+        raise OSError(f"artifact cache insert failed: {(result.stderr or '').strip()}")
+    logger.debug("Cached %s (%d bytes) on %s", artifact.digest[:12], artifact.size,
+                 conn.get_extra_info("peername"))
+
+
+async def place(conn, artifact: Artifact, dest: str, stats: CacheStats, *,
+                throttle: sftp_transfer.Throttle | None = None, progress=None) -> bool:
+    """Put ``artifact`` at ``dest`` on the host, from its cache when it is there. True on a hit.
+
+    ``throttle`` and ``progress`` apply to the transfer, if there is one (see :func:`sftp_transfer.put`).
+    """
+    if not artifact.cacheable:
+        async with conn.start_sftp_client() as sftp:
+            await sftp_transfer.put(sftp, artifact.path, dest, throttle=throttle, progress=progress)
+        _record(stats, "bypassed", artifact.size, 0)
+        return False
+    copy = f"cp -f {shlex.quote(artifact.remote_path)} {shlex.quote(dest)}"
+    if await _lookup(conn, artifact, copy):
+        _record(stats, "hits", 0, artifact.size)
+        return True
+    await _insert(conn, artifact, copy, throttle, progress)
+    _record(stats, "misses", artifact.size, 0)
+    return False
+
+
+async def fetch(conn, artifact: Artifact, stats: CacheStats, *,
+                throttle: sftp_transfer.Throttle | None = None) -> bool:
+    """Make sure the host has ``artifact`` at :attr:`Artifact.remote_path`. True on a hit."""
+    if await _lookup(conn, artifact, ""):
+        _record(stats, "hits", 0, artifact.size)
+        return True
+    await _insert(conn, artifact, "", throttle)
+    _record(stats, "misses", artifact.size, 0)
+    return False
+
+
+def stats() -> dict:
+    return {
+        **totals.summary(),
+        "enabled": ENABLED,
+        "remote_dir": REMOTE_DIR,
+        "max_bytes": MAX_BYTES,
+        "min_bytes": MIN_BYTES,
+    }
@@ -41,24 +41,20 @@ async def register_get(request: Request):
 async def register_post(request: Request,
                         username: str = Form(...),
                         password: str = Form(...)):
-    conn = db.get_db()
-    cursor = conn.cursor()
     # Canonicalize username to lowercase (case-insensitive policy)
     username_norm = (username or "").strip().lower()
     hashed = pwd_context.hash(password)
     # Proactively check for duplicates case-insensitively to avoid mixed-case dupes
-    cursor.execute("SELECT id FROM users WHERE lower(trim(username)) = lower(trim(?))", (username_norm,))
-    if cursor.fetchone():
+    if await db.fetchone("SELECT id FROM users WHERE lower(trim(username)) = lower(trim(?))", (username_norm,)):
         return templates.TemplateResponse("register.html", {
             "request": request,
             "error": "Username already taken"
         })
     try:
-        cursor.execute(
+        await db.execute(
             "INSERT INTO users (username, hashed_password) VALUES (?, ?)",
             (username_norm, hashed)
         )
-        conn.commit()
     except sqlite3.IntegrityError:
         return templates.TemplateResponse("register.html", {
             "request": request,
@@ -76,11 +72,8 @@ async def login_get(request: Request):
 async def login_post(request: Request,
                      username: str = Form(...),
                      password: str = Form(...)):
-    conn = db.get_db()
-    cursor = conn.cursor()
     # Case-insensitive username match
-    cursor.execute("SELECT * FROM users WHERE lower(trim(username)) = lower(trim(?))", ((username or "").strip(),))
-    user = cursor.fetchone()
+    user = await db.fetchone("SELECT * FROM users WHERE lower(trim(username)) = lower(trim(?))", ((username or "").strip(),))
     if not user or not pwd_context.verify(password, user["hashed_password"]):
         return templates.TemplateResponse("login.html", {
             "request": request,
@@ -0,0 +1,131 @@
+# bench_multi_exec.py
+"""Measure MultiExec throughput against a fleet for several shard counts.
+
+Runs the same job with 1, 2, 4, ... shard processes (see :mod:`exec_shards`)
+and reports wall time, hosts per second and CPU time. Every run starts
+fresh processes, so each one pays for its own SSH handshakes::
+
+    python bench_multi_exec.py --hosts "10.20.0.1-250 10.21.0.0/24" \\
+        --user ops --password ... --command true --shards 1,2,4,8
+
+``--hosts`` takes the same expressions as the MultiExec page (see
+:mod:`host_expr`), except ``@folder`` references.
+
+No web server or database is needed. Scaling stops at the number of free
+cores, or earlier if the SSH servers are the bottleneck.
+"""
+
+import argparse
+import asyncio
+import getpass
+import os
+import resource
+import time
+
+import exec_shards
+import host_expr
+from settings import env_int
+
+
+# Same defaults and variables as routers/multi_exec.py
+CONNECT = (env_int("MULTI_EXEC_CONNECT_CONCURRENCY", 16), env_int("MULTI_EXEC_CONNECT_MAX", 256))
+EXECUTE = (env_int("MULTI_EXEC_CONCURRENCY", 12), env_int("MULTI_EXEC_EXEC_MAX", 512))
+
+
+class _CountingSink:
+    def __init__(self):
+        self.ok = 0
+        self.failed = 0
+        self.output_bytes = 0
+        self.errors: dict[str, int] = {}
+
+    async def status(self, payload):
+        pass
+
+    async def output(self, host, stream, data):
+        self.output_bytes += len(data)
+
+    def new_capture(self):
+        return None
+
+    async def finished(self, host, *, connected, ok, exit_status, error=None, **_):
+        if ok:
+            self.ok += 1
+        else:
+            self.failed += 1
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def stopped(self, host):
+        self.failed += 1
+
+
+def _cpu() -> tuple[float, float]:
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return me.ru_utime + me.ru_stime, kids.ru_utime + kids.ru_stime
+
+
+async def _run(targets, args, shards: int) -> dict:
+    sink = _CountingSink()
+    run = exec_shards.ShardedRun(targets.stream(), args.user, args.password, args.command, sink, shards=shards,
+                                 cluster=False, max_output=0, connect=CONNECT, execute=EXECUTE)
+    cpu0 = _cpu()
+    started = time.perf_counter()
+    await run.run()
+    wall = time.perf_counter() - started
+    cpu1 = _cpu()
+    limits = run.concurrency()
+    return {
+        "shards": shards,
+        "wall": wall,
+        "hosts_per_sec": run.dealt / wall,
+        "ok": sink.ok,
+        "failed": sink.failed,
+        "coordinator_cpu": cpu1[0] - cpu0[0],
+        "shard_cpu": cpu1[1] - cpu0[1],
+        "peak_connect": limits["connect"]["peak_in_flight"],
+        "peak_exec": limits["exec"]["peak_in_flight"],
+        "errors": sink.errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--hosts", action="append", required=True,
+                        help="host expression, or @file with one per line (repeatable)")
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password", help="SSH password (prompted when omitted)")
+    parser.add_argument("--command", default="true")
+    parser.add_argument("--shards", default=f"1,{os.cpu_count() or 1}",
+                        help="comma-separated shard counts to compare")
+    args = parser.parse_args()
+    if args.password is None:
+        args.password = getpass.getpass("SSH password: ")
+
+    specs = []
+    for spec in args.hosts:
+        if spec.startswith("@"):
+            with open(spec[1:]) as fh:
+                specs.append(fh.read())
+        else:
+            specs.append(spec)
+    text = "\n".join(specs)
+    total = sum(1 for _ in host_expr.parse(text))
+    counts = [int(n) for n in args.shards.split(",") if n.strip()]
+    print(f"{total} hosts, `{args.command}`, {os.cpu_count()} CPU(s)")
+    print(f"{'shards':>6} {'wall s':>8} {'hosts/s':>9} {'speedup':>8} {'ok':>6} {'failed':>6} "
+          f"{'coord cpu':>9} {'shard cpu':>9} {'peak conn':>9} {'peak exec':>9}")
+    base = None
+    for n in counts:
+        r = asyncio.run(_run(host_expr.parse(text), args, max(1, min(n, total))))
+        base = base or r["hosts_per_sec"]
+        print(f"{r['shards']:>6} {r['wall']:>8.2f} {r['hosts_per_sec']:>9.1f} {r['hosts_per_sec'] / base:>7.2f}x "
+              f"{r['ok']:>6} {r['failed']:>6} {r['coordinator_cpu']:>9.2f} {r['shard_cpu']:>9.2f} "
+              f"{r['peak_connect']:>9} {r['peak_exec']:>9}")
+        for error, count in sorted(r["errors"].items(), key=lambda e: -e[1])[:3]:
+            print(f"{'':>6} {count} × {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# change_feed.py
+"""Ordered change log pushed to open pages over Server-Sent Events.
+
+Writers call :func:`record` inside their own transaction. Host add, edit,
+delete and import record one ``host`` change per host. The host-status
+leader records a ``status`` change when a host goes up or down, and a
+``summary`` change when the online/total counts or the running state move.
+Each change gets a sequence number in ``change_log``. Only the newest
+``CHANGE_LOG_KEEP`` changes are kept.
+
+Each worker runs one :class:`ChangeFeed`. It tails the table: every
+``POLL_INTERVAL`` seconds it reads ``PRAGMA data_version`` on a dedicated
+connection, and only when that moved does it read the new rows. It keeps
+the newest ones in memory. Subscribers (:meth:`ChangeFeed.events`) pull
+from that ring, or from the table when they are further behind, so a slow
+client never makes the feed buffer more. The sequence number is the SSE
+event id. A reconnecting ``EventSource`` sends it back as ``Last-Event-ID``
+and gets only what it missed. When the token is older than the retained
+log, the subscriber gets a ``reset`` event and refetches once.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import deque
+from typing import AsyncIterator
+
+import db
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.change_feed")
+
+
+KEEP = max(100, env_int("CHANGE_LOG_KEEP", 20000))
+PRUNE_EVERY = 256               # inserts between trims of the log
+POLL_INTERVAL = 0.25
+MEMORY_EVENTS = 2048            # newest changes kept in memory per worker
+READ_PAGE = 500                 # changes per database read when catching up
+HEARTBEAT = 15.0                # seconds between keep-alive comments
+
+
+def record(conn: sqlite3.Connection, kind: str, data: dict, user_id: int | None = None) -> None:
+    """Append a change (call inside the write's transaction).
+
+    ``user_id`` limits it to that user's subscribers; None sends it to all of them.
+    """
+    seq = conn.execute(
+        "INSERT INTO change_log (kind, user_id, data, created) VALUES (?, ?, ?, ?)",
+        (kind, user_id, json.dumps(data, separators=(",", ":")), time.time()),
+    ).lastrowid
+    if seq % PRUNE_EVERY == 0:
+        conn.execute("DELETE FROM change_log WHERE seq <= ?", (seq - KEEP,))
+
+
+def folder_path(folder: str | None) -> str:
+    """Folder as the dashboard shows it ("a/b", or "Ungrouped")."""
+    parts = [p.strip() for p in (folder or "").split("/") if p.strip()]
+    return "/".join(parts) or "Ungrouped"
+
+
+def host_payload(host_id: int, name: str, host: str, username: str, folder: str) -> dict:
+    """A host as the dashboard lists it, without the password."""
+    return {"id": host_id, "name": name, "host": host, "username": username,
+            "folder": folder, "folder_path": folder_path(folder)}
+
+
+class _Subscriber:
+    """What one client may see: its own hosts, their status and the summary."""
+
+    def __init__(self, user: dict, addresses: set[str]):
+        self.user_id = user["id"]
+        self.is_admin = bool(user.get("is_admin"))
+        self.addresses = addresses
+
+    def wants(self, kind: str, user_id: int | None, data: dict) -> bool:
+        if user_id is not None and user_id != self.user_id:
+            return False
+        if kind == "host":
+            if data["action"] == "removed":
+                self.addresses.discard(data["host"]["host"])
+            else:
+                self.addresses.discard(data.get("previous_host"))
+                self.addresses.add(data["host"]["host"])
+        elif kind == "status":
+            return self.is_admin or data["host"] in self.addresses
+        return True
+
+
+class ChangeFeed:
+    """Per-worker tail of ``change_log`` shared by every open stream."""
+
+    def __init__(self):
+        self._recent: deque[tuple[int, str, int | None, str]] = deque(maxlen=MEMORY_EVENTS)
+        self.head = 0
+        self.subscribers = 0
+        self.resets = 0
+        self.delivered = 0
+        self._watch: sqlite3.Connection | None = None
+        self._data_version: int | None = None
+        self._tail: asyncio.Task | None = None
+        self._wake: asyncio.Event | None = None
+
+    async def _ensure_tail(self) -> None:
+        if self._tail is None or self._tail.done():
+            head = await latest()
+            if self._tail is None or self._tail.done():
+                self.head = max(self.head, head)
+                self._wake = asyncio.Event()
+                self._tail = asyncio.create_task(self._run())
+
+    def _changed(self) -> bool:
+        if self._watch is None:
+            self._watch = db.get_db()
+        version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return False
+        self._data_version = version
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if self._changed():
+                    while True:
+                        rows = await _read(self.head)
+                        if rows and rows[0]["seq"] != self.head + 1:
+                            # Pruned (or rolled back) before we saw it: the ring must not span the gap
+                            self._recent.clear()
+                        for r in rows:
+                            self._recent.append((r["seq"], r["kind"], r["user_id"], r["data"]))
+                            self.head = r["seq"]
+                        if rows:
+                            wake, self._wake = self._wake, asyncio.Event()
+                            wake.set()
+                        if len(rows) < READ_PAGE:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Change feed tail failed: %s", e)
+                self._data_version = None
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def _after(self, cursor: int) -> list[tuple[int, str, int | None, str]] | None:
+        """Changes after ``cursor``, or None when they are no longer retained."""
+        if cursor >= self.head:
+            return []
+        if self._recent and self._recent[0][0] <= cursor + 1:
+            return [e for e in self._recent if e[0] > cursor][:READ_PAGE]
+        rows = await _read(cursor)
+        if not rows or rows[0]["seq"] > cursor + 1:
+            oldest = await db.fetchone("SELECT MIN(seq) AS seq FROM change_log")
+            if oldest["seq"] is None or oldest["seq"] > cursor + 1:
+                return None
+        return [(r["seq"], r["kind"], r["user_id"], r["data"]) for r in rows]
+
+    async def events(self, user: dict, since: int | None = None) -> AsyncIterator[tuple[int, str, str] | None]:
+        """``(seq, kind, json)`` for ``user`` after ``since`` (or from now), then live.
+
+        Yields None when nothing happened for ``HEARTBEAT`` seconds, and
+        ``(head, "reset", "{}")`` when ``since`` is too old to resume from.
+        """
+        await self._ensure_tail()
+        rows = await db.fetchall("SELECT host FROM hosts WHERE user_id = ?", (user["id"],))
+        subscriber = _Subscriber(user, {r["host"] for r in rows})
+        cursor = self.head if since is None else min(since, self.head)
+        self.subscribers += 1
+        try:
+            while True:
+                wake = self._wake
+                batch = await self._after(cursor)
+                if batch is None:
+                    self.resets += 1
+                    cursor = self.head
+                    yield cursor, "reset", "{}"
+                    continue
+                for seq, kind, user_id, data in batch:
+                    cursor = seq
+                    if subscriber.wants(kind, user_id, json.loads(data)):
+                        self.delivered += 1
+                        yield seq, kind, data
+                if not batch:
+                    try:
+                        await asyncio.wait_for(wake.wait(), HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        yield None
+        finally:
+            self.subscribers -= 1
+
+    def stats(self) -> dict:
+        return {
+            "head": self.head,
+            "subscribers": self.subscribers,
+            "in_memory": len(self._recent),
+            "oldest_in_memory": self._recent[0][0] if self._recent else None,
+            "delivered": self.delivered,
+            "resets": self.resets,
+            "keep": KEEP,
+        }
+
+
+async def latest() -> int:
+    """Current resume token. Pages read it before their data, so their stream misses nothing."""
+    row = await db.fetchone("SELECT MAX(seq) AS seq FROM change_log")
+    return row["seq"] or 0
+
+
+async def _read(after: int) -> list[sqlite3.Row]:
+    return await db.fetchall(
+        "SELECT seq, kind, user_id, data FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+        (after, READ_PAGE),
+    )
+
+
+feed = ChangeFeed()
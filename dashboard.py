@@ -3,6 +3,8 @@ from fastapi.responses import RedirectResponse, StreamingResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 
 import db, csv
+import change_feed
+import host_cache
 from io import StringIO
 from pydantic import BaseModel
 from typing import List
@@ -13,6 +15,15 @@ templates = Jinja2Templates(directory="templates")
 def get_current_user(request: Request):
     return request.session.get("user")
 
+
+def _record_removed(conn, rows) -> None:
+    """Push a "removed" change for each deleted host row (inside the delete's transaction)."""
+    for r in rows:
+        change_feed.record(conn, "host", {
+            "action": "removed",
+            "host": change_feed.host_payload(r["id"], r["name"], r["host"], r["username"], r["folder"]),
+        }, r["user_id"])
+
 # ── Portal Route ──────────────────────────────────────────────────────────
 @router.get("/portal")
 async def multiexec_portal(request: Request, hosts: str = None):
@@ -45,10 +56,9 @@ async def dashboard(request: Request):
         return RedirectResponse("/login", status_code=302)
 
     # ─── Fetch hosts ────────────────────────────────────────────────
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM hosts WHERE user_id = ?", (user["id"],))
-    hosts = cursor.fetchall()
+    # Token first: live updates resume from it, so nothing between the two reads is lost
+    change_seq = await change_feed.latest()
+    hosts = await db.fetchall("SELECT * FROM hosts WHERE user_id = ?", (user["id"],))
 
     # ─── Build nested folder tree with better logic ────────────────
     class FolderNode:
@@ -108,14 +118,14 @@ async def dashboard(request: Request):
     # ─── Admin user list ────────────────────────────────────────────
     users = []
     if user["is_admin"]:
-        cursor.execute("SELECT id, username, is_admin FROM users")
-        users = cursor.fetchall()
+        users = await db.fetchall("SELECT id, username, is_admin FROM users")
 
     return templates.TemplateResponse("dashboard.html", {
         "request": request,
         "user": user,
         "folder_tree": root,
         "all_hosts_flat": all_hosts_flat,  # Add this for JavaScript
+        "change_seq": change_seq,
         "users": users
     })
 
@@ -130,25 +140,30 @@ async def add_host(request: Request,
     if not user:
         return RedirectResponse("/login", status_code=302)
 
-    conn = db.get_db()
-    cursor = conn.cursor()
-    # Defensive: prevent duplicate hosts per user (case/whitespace insensitive)
     norm_host = (host or "").strip()
-    cursor.execute(
-        "SELECT 1 FROM hosts WHERE user_id = ? AND lower(trim(host)) = lower(trim(?))",
-        (user["id"], norm_host)
-    )
-    exists = cursor.fetchone()
-    if exists:
-        # Skip inserting duplicate and just return to dashboard
-        return RedirectResponse("/dashboard", status_code=302)
 
-    cursor.execute(
-        "INSERT INTO hosts (user_id, name, host, username, password, folder) "
-        "VALUES (?, ?, ?, ?, ?, ?)",
-        (user["id"], name, norm_host, username, password, folder.strip())
-    )
-    conn.commit()
+    def insert(conn):
+        # Defensive: prevent duplicate hosts per user (case/whitespace insensitive)
+        exists = conn.execute(
+            "SELECT 1 FROM hosts WHERE user_id = ? AND lower(trim(host)) = lower(trim(?))",
+            (user["id"], norm_host)
+        ).fetchone()
+        if exists:
+            # Skip inserting duplicate and just return to dashboard
+            return
+        host_id = conn.execute(
+            "INSERT INTO hosts (user_id, name, host, username, password, folder) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user["id"], name, norm_host, username, password, folder.strip())
+        ).lastrowid
+        host_cache.bump(conn)
+        change_feed.record(conn, "host", {
+            "action": "added",
+            "host": change_feed.host_payload(host_id, name, norm_host, username, folder.strip()),
+        }, user["id"])
+
+    await db.run(insert)
+    host_cache.invalidate()
     return RedirectResponse("/dashboard", status_code=302)
 
 
@@ -158,10 +173,7 @@ async def edit_host_get(request: Request, host_id: int):
     if not user:
         return RedirectResponse("/login", status_code=302)
 
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM hosts WHERE id = ?", (host_id,))
-    host = cursor.fetchone()
+    host = await db.fetchone("SELECT * FROM hosts WHERE id = ?", (host_id,))
     if not host or (host["user_id"] != user["id"] and not user["is_admin"]):
         return RedirectResponse("/dashboard", status_code=302)
 
@@ -183,23 +195,28 @@ async def edit_host_post(request: Request,
     if not user:
         return RedirectResponse("/login", status_code=302)
 
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM hosts WHERE id = ?", (host_id,))
-    row = cursor.fetchone()
-    if not row or (row["user_id"] != user["id"] and not user["is_admin"]):
-        return RedirectResponse("/dashboard", status_code=302)
-
-    cursor.execute("""
-        UPDATE hosts
-           SET name     = ?,
-               host     = ?,
-               username = ?,
-               password = ?,
-               folder   = ?
-         WHERE id       = ?
-    """, (name, host, username, password, folder.strip(), host_id))
-    conn.commit()
+    def update(conn):
+        row = conn.execute("SELECT user_id, host FROM hosts WHERE id = ?", (host_id,)).fetchone()
+        if not row or (row["user_id"] != user["id"] and not user["is_admin"]):
+            return
+        conn.execute("""
+            UPDATE hosts
+               SET name     = ?,
+                   host     = ?,
+                   username = ?,
+                   password = ?,
+                   folder   = ?
+             WHERE id       = ?
+        """, (name, host, username, password, folder.strip(), host_id))
+        host_cache.bump(conn)
+        change_feed.record(conn, "host", {
+            "action": "updated",
+            "host": change_feed.host_payload(host_id, name, host, username, folder.strip()),
+            "previous_host": row["host"],
+        }, row["user_id"])
+
+    await db.run(update)
+    host_cache.invalidate([host_id])
     return RedirectResponse("/dashboard", status_code=302)
 
 
@@ -209,15 +226,16 @@ async def delete_host(request: Request, host_id: int = Form(...)):
     if not user:
         return RedirectResponse("/login", status_code=302)
 
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM hosts WHERE id = ?", (host_id,))
-    row = cursor.fetchone()
-    if not row or (row["user_id"] != user["id"] and not user["is_admin"]):
-        return RedirectResponse("/dashboard", status_code=302)
+    def delete(conn):
+        row = conn.execute("SELECT * FROM hosts WHERE id = ?", (host_id,)).fetchone()
+        if not row or (row["user_id"] != user["id"] and not user["is_admin"]):
+            return
+        conn.execute("DELETE FROM hosts WHERE id = ?", (host_id,))
+        host_cache.bump(conn)
+        _record_removed(conn, [row])
 
-    cursor.execute("DELETE FROM hosts WHERE id = ?", (host_id,))
-    conn.commit()
+    await db.run(delete)
+    host_cache.invalidate([host_id])
     return RedirectResponse("/dashboard", status_code=302)
 
 
@@ -227,10 +245,7 @@ async def delete_user(request: Request, user_id: int = Form(...)):
     if not user or not user["is_admin"]:
         return RedirectResponse("/login", status_code=302)
 
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
+    await db.execute("DELETE FROM users WHERE id = ?", (user_id,))
     return RedirectResponse("/dashboard", status_code=302)
 
 
@@ -240,14 +255,11 @@ async def export_hosts(request: Request):
     if not user:
         return RedirectResponse("/login", status_code=302)
 
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute(
+    rows = await db.fetchall(
         "SELECT name, host, username, password, folder "
         "FROM hosts WHERE user_id = ?",
         (user["id"],)
     )
-    rows = cursor.fetchall()
 
     def iter_csv():
         buf = StringIO()
@@ -283,45 +295,55 @@ async def import_hosts_post(request: Request, file: UploadFile = File(...)):
 
     content = (await file.read()).decode()
     reader = csv.DictReader(StringIO(content))
-    conn = db.get_db()
-    cursor = conn.cursor()
-    # Preload existing hosts for this user for fast duplicate checking
-    cursor.execute("SELECT lower(trim(host)) AS h FROM hosts WHERE user_id = ?", (user["id"],))
-    existing = {row["h"] for row in cursor.fetchall() if row["h"] is not None}
-    inserted = 0
-    skipped = 0
-    for row in reader:
-        name_v = (row.get("name", "") or "").strip()
-        host_v = (row.get("host", "") or "").strip()
-        username_v = (row.get("username", "") or "").strip()
-        password_v = (row.get("password", "") or "").strip()
-        folder_v = (row.get("folder", "") or "").strip()
-
-        # Skip blank host rows
-        if not host_v:
-            skipped += 1
-            continue
-
-        key = host_v.lower()
-        if key in existing:
-            skipped += 1
-            continue
-
-        cursor.execute(
-            "INSERT INTO hosts (user_id, name, host, username, password, folder) "
-            "VALUES (?, ?, ?, ?, ?, ?)",
-            (
-                user["id"],
-                name_v,
-                host_v,
-                username_v,
-                password_v,
-                folder_v
-            )
-        )
-        existing.add(key)
-        inserted += 1
-    conn.commit()
+
+    def import_rows(conn):
+        # Preload existing hosts for this user for fast duplicate checking
+        cursor = conn.execute("SELECT lower(trim(host)) AS h FROM hosts WHERE user_id = ?", (user["id"],))
+        existing = {row["h"] for row in cursor.fetchall() if row["h"] is not None}
+        inserted = 0
+        skipped = 0
+        for row in reader:
+            name_v = (row.get("name", "") or "").strip()
+            host_v = (row.get("host", "") or "").strip()
+            username_v = (row.get("username", "") or "").strip()
+            password_v = (row.get("password", "") or "").strip()
+            folder_v = (row.get("folder", "") or "").strip()
+
+            # Skip blank host rows
+            if not host_v:
+                skipped += 1
+                continue
+
+            key = host_v.lower()
+            if key in existing:
+                skipped += 1
+                continue
+
+            new_id = conn.execute(
+                "INSERT INTO hosts (user_id, name, host, username, password, folder) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    user["id"],
+                    name_v,
+                    host_v,
+                    username_v,
+                    password_v,
+                    folder_v
+                )
+            ).lastrowid
+            change_feed.record(conn, "host", {
+                "action": "added",
+                "host": change_feed.host_payload(new_id, name_v, host_v, username_v, folder_v),
+            }, user["id"])
+            existing.add(key)
+            inserted += 1
+        if inserted:
+            host_cache.bump(conn)
+        return inserted, skipped
+
+    # One transaction, parsed and inserted on a database thread
+    await db.run(import_rows)
+    host_cache.invalidate()
     return RedirectResponse("/dashboard", status_code=302)
 
 
@@ -340,27 +362,24 @@ async def bulk_delete_hosts(request: Request, payload: BulkDeleteRequest):
     if not ids:
         return JSONResponse({"deleted": 0, "skipped": 0, "detail": "no ids"})
 
-    conn = db.get_db()
-    cursor = conn.cursor()
-
-    # Filter IDs the user is allowed to delete
-    q_marks = ",".join(["?"] * len(ids))
-    cursor.execute(f"SELECT id, user_id FROM hosts WHERE id IN ({q_marks})", tuple(ids))
-    rows = cursor.fetchall()
-
-    allowed_ids = []
-    skipped = 0
-    for r in rows:
-        if user["is_admin"] or r["user_id"] == user["id"]:
-            allowed_ids.append(r["id"])
-        else:
-            skipped += 1
-
-    deleted = 0
-    if allowed_ids:
-        q2 = ",".join(["?"] * len(allowed_ids))
-        cursor.execute(f"DELETE FROM hosts WHERE id IN ({q2})", tuple(allowed_ids))
-        conn.commit()
-        deleted = cursor.rowcount if cursor.rowcount is not None else len(allowed_ids)
-
+    def delete_allowed(conn):
+        # Filter IDs the user is allowed to delete
+        q_marks = ",".join(["?"] * len(ids))
+        rows = conn.execute(f"SELECT * FROM hosts WHERE id IN ({q_marks})", tuple(ids)).fetchall()
+
+        allowed = [r for r in rows if user["is_admin"] or r["user_id"] == user["id"]]
+        allowed_ids = [r["id"] for r in allowed]
+        skipped = len(rows) - len(allowed)
+
+        deleted = 0
+        if allowed_ids:
+            q2 = ",".join(["?"] * len(allowed_ids))
+            cursor = conn.execute(f"DELETE FROM hosts WHERE id IN ({q2})", tuple(allowed_ids))
+            deleted = cursor.rowcount if cursor.rowcount is not None else len(allowed_ids)
+            host_cache.bump(conn)
+            _record_removed(conn, allowed)
+        return allowed_ids, deleted, skipped
+
+    allowed_ids, deleted, skipped = await db.run(delete_allowed)
+    host_cache.invalidate(allowed_ids)
     return JSONResponse({"deleted": deleted, "skipped": skipped})
@@ -1,10 +1,211 @@
+"""SQLite access for the portal.
+
+Queries from request handlers go through a bounded :class:`ConnectionPool`
+and run on its own small thread pool, so they never block the event loop
+that is also relaying live terminal traffic::
+
+    host = await db.fetchone("SELECT * FROM hosts WHERE id = ?", (host_id,))
+
+    def move(conn):                      # several statements, one transaction
+        ...
+    await db.run(move)
+
+Code that already runs in a worker thread uses ``with db.pool.connection()
+as conn:``. The database is in WAL mode, so readers do not block the writer
+(or each other) across the uvicorn workers. Each connection waits up to
+``DB_BUSY_TIMEOUT_MS`` for a lock instead of failing with "database is locked".
+Pool wait and query latency are exposed by :func:`stats`.
+"""
+
+import asyncio
+import os
+import queue
 import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable
+
 from passlib.context import CryptContext
 
+from settings import env_int
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+
+DB_PATH = os.getenv("DB_PATH", "app.db")
+POOL_SIZE = max(1, env_int("DB_POOL_SIZE", 4))
+BUSY_TIMEOUT_MS = max(0, env_int("DB_BUSY_TIMEOUT_MS", 5000))
+POOL_TIMEOUT = 30.0     # seconds a caller may wait for a free connection
+LATENCY_SAMPLES = 1024  # recent samples kept for percentiles
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA synchronous = NORMAL")   # safe with WAL; fsync at checkpoints only
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -8192")     # 8 MiB page cache per connection
+    return conn
+
+
+def _percentile(samples: list[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+# ─── Connection pool ────────────────────────────────────────────────────────────
+class ConnectionPool:
+    """At most ``size`` SQLite connections, shared by worker threads."""
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = size
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="db")
+        self._in_use = 0
+        self._queries = 0
+        self._errors = 0
+        self._timeouts = 0
+        self._wait: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._latency: deque[float] = deque(maxlen=LATENCY_SAMPLES)
+        self._wait_max = 0.0
+        self._latency_max = 0.0
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return _connect()
+            except BaseException:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=POOL_TIMEOUT)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise TimeoutError(f"No database connection free after {POOL_TIMEOUT:.0f}s")
+
+    @contextmanager
+    def connection(self, *, _queued_at: float | None = None):
+        """A pooled connection for the duration of the block (blocking; threads only).
+
+        The block's work is committed when it exits cleanly and rolled back
+        otherwise.
+        """
+        requested = time.perf_counter() if _queued_at is None else _queued_at
+        conn = self._checkout()
+        started = time.perf_counter()
+        wait = started - requested
+        with self._lock:
+            self._in_use += 1
+            self._wait_max = max(self._wait_max, wait)
+        self._wait.append(wait)
+        failed = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            failed = True
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            raise
+        finally:
+            latency = time.perf_counter() - started
+            self._latency.append(latency)
+            with self._lock:
+                self._in_use -= 1
+                self._queries += 1
+                self._errors += failed
+                self._latency_max = max(self._latency_max, latency)
+            self._idle.put(conn)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        """``fn(conn, *args)`` on a pooled connection, off the event loop."""
+        queued_at = time.perf_counter()  # pool wait includes time queued for a thread
+
+        def call():
+            with self.connection(_queued_at=queued_at) as conn:
+                return fn(conn, *args)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def stats(self) -> dict:
+        wait, latency = list(self._wait), list(self._latency)
+        with self._lock:
+            return {
+                "path": DB_PATH,
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "queries": self._queries,
+                "errors": self._errors,
+                "timeouts": self._timeouts,
+                "wait_ms": {
+                    "p50": round(_percentile(wait, 0.50) * 1000, 3),
+                    "p95": round(_percentile(wait, 0.95) * 1000, 3),
+                    "max": round(self._wait_max * 1000, 3),
+                },
+                "query_ms": {
+                    "p50": round(_percentile(latency, 0.50) * 1000, 3),
+                    "p95": round(_percentile(latency, 0.95) * 1000, 3),
+                    "max": round(self._latency_max * 1000, 3),
+                },
+                "samples": len(latency),
+            }
+
+
+pool = ConnectionPool()
+
+
+# ─── Async helpers ──────────────────────────────────────────────────────────────
+async def run(fn: Callable[..., Any], *args) -> Any:
+    """Run ``fn(conn, *args)`` as one transaction on the pool."""
+    return await pool.run(fn, *args)
+
+
+async def fetchone(sql: str, params: tuple = ()) -> sqlite3.Row | None:
+    return await pool.run(lambda conn: conn.execute(sql, params).fetchone())
+
+
+async def fetchall(sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+    return await pool.run(lambda conn: conn.execute(sql, params).fetchall())
+
+
+async def execute(sql: str, params: tuple = ()) -> int:
+    """Run one statement and commit it; returns the affected row count."""
+    return await pool.run(lambda conn: conn.execute(sql, params).rowcount)
+
+
+def stats() -> dict:
+    return pool.stats()
+
+
+# ─── Schema ─────────────────────────────────────────────────────────────────────
 def init_db():
-    conn = sqlite3.connect("app.db")
+    conn = _connect()
+    # Persistent: readers stop blocking the writer for every later connection
+    conn.execute("PRAGMA journal_mode = WAL")
     cursor = conn.cursor()
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS users (
@@ -26,6 +227,115 @@ def init_db():
         FOREIGN KEY(user_id) REFERENCES users(id)
     )
     """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS terminal_recordings (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        host_id INTEGER NOT NULL,
+        host_name TEXT NOT NULL,
+        started REAL NOT NULL,
+        ended REAL,
+        duration REAL NOT NULL DEFAULT 0,
+        path TEXT NOT NULL,
+        bytes_out INTEGER NOT NULL DEFAULT 0,
+        bytes_in INTEGER NOT NULL DEFAULT 0,
+        stored_bytes INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS cache_generations (
+        name TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS exec_jobs (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        username TEXT NOT NULL,
+        command TEXT NOT NULL,
+        total_hosts INTEGER NOT NULL,
+        cluster INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL,
+        created REAL NOT NULL,
+        finished REAL,
+        success INTEGER NOT NULL DEFAULT 0,
+        failure INTEGER NOT NULL DEFAULT 0,
+        events INTEGER NOT NULL DEFAULT 0,
+        cancel_requested INTEGER NOT NULL DEFAULT 0,
+        pid INTEGER,
+        pid_started REAL,
+        summary TEXT
+    )
+    """)
+    # Databases created before pid_started existed
+    columns = {r[1] for r in cursor.execute("PRAGMA table_info(exec_jobs)")}
+    if "pid_started" not in columns:
+        try:
+            cursor.execute("ALTER TABLE exec_jobs ADD COLUMN pid_started REAL")
+        except sqlite3.OperationalError:
+            pass        # another worker added it first
+    # Append-only event log of each job; seq is the resubscribe offset
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS exec_job_events (
+        job_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        host TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (job_id, seq)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS exec_job_hosts (
+        job_id TEXT NOT NULL,
+        host TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        ok INTEGER,
+        exit_status INTEGER,
+        error TEXT,
+        updated REAL NOT NULL,
+        PRIMARY KEY (job_id, host)
+    ) WITHOUT ROWID
+    """)
+    # Changes pushed to open pages (change_feed.py); seq is the SSE resume token
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        user_id INTEGER,
+        data TEXT NOT NULL,
+        created REAL NOT NULL
+    )
+    """)
+    # Latest background check per host address (host_status.py); one leader writes
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS host_status (
+        host TEXT PRIMARY KEY,
+        online INTEGER NOT NULL,
+        latency_ms REAL,
+        last_seen REAL,
+        checked REAL NOT NULL,
+        error TEXT
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS host_status_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        enabled INTEGER NOT NULL DEFAULT 1,
+        total_hosts INTEGER NOT NULL DEFAULT 0,
+        online_hosts INTEGER NOT NULL DEFAULT 0,
+        last_update REAL,
+        round_seconds REAL,
+        leader_pid INTEGER
+    )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS terminal_recordings_started ON terminal_recordings(started)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS exec_jobs_user_created ON exec_jobs(user_id, created)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS host_status_checked ON host_status(checked)")
     # Enforce case-insensitive uniqueness for usernames where possible
     try:
         cursor.execute(
@@ -46,6 +356,8 @@ def init_db():
     conn.close()
 
 def get_db():
-    conn = sqlite3.connect("app.db")
-    conn.row_factory = sqlite3.Row
-    return conn
+    """A new, unpooled connection for scripts and one-off tools; the caller closes it.
+
+    Application code should use the pool (:func:`fetchone`, :func:`run`, ...).
+    """
+    return _connect()
@@ -0,0 +1,416 @@
+# exec_jobs.py
+"""Detached MultiExec jobs whose results outlive the browser socket.
+
+Each MultiExec run is an :class:`ExecJob`. It gets an id, runs as its own
+task, and appends every event (host stages, output batches, summary) to an
+in-order log:
+
+* Each event gets a sequence number (``seq``), its offset in the log.
+* Events are written to SQLite in batches every ``JOB_FLUSH_INTERVAL``
+  seconds (``exec_job_events``), along with per-host results
+  (``exec_job_hosts``) and job progress (``exec_jobs``).
+* The newest events stay in memory for live subscribers. Events are dropped
+  from memory only after they are in the database.
+
+A client (re)subscribes with :func:`follow` from any offset. It gets older
+events from the database, then the in-memory tail, then new events as they
+are appended. The subscription is pull-based: a slow socket only delays its
+own reads and never makes the job buffer more. A job running in another
+worker process is followed by polling its rows. Jobs that were running when
+their process died are marked ``interrupted`` at startup (:func:`recover`).
+Finished jobs are kept for ``MULTI_EXEC_JOB_RETENTION_HOURS``, and at most
+``MULTI_EXEC_JOB_MAX`` of them (:func:`sweep`). A swept job's stored output
+is removed with it.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import secrets
+import sqlite3
+import time
+from collections import deque
+from itertools import islice
+from typing import AsyncIterator
+
+import db
+import output_store
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.exec_jobs")
+
+
+RETENTION_HOURS = max(0, env_int("MULTI_EXEC_JOB_RETENTION_HOURS", 168))
+MAX_JOBS = max(1, env_int("MULTI_EXEC_JOB_MAX", 500))
+JOB_FLUSH_INTERVAL = 0.5
+MEMORY_EVENTS = 4096             # newest events kept in memory per running job
+MEMORY_BYTES = 8 * 1048576       # ... and at most this much of them
+READ_PAGE = 500                  # events per database read when catching up
+POLL_INTERVAL = 0.5              # following a job that runs in another worker
+
+ACTIVE = "running"
+
+_jobs: dict[str, "ExecJob"] = {}
+
+
+def _dumps(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class ExecJob:
+    """One MultiExec run: its event log, per-host results and runner task."""
+
+    def __init__(self, user: dict, command: str, total_hosts: int, cluster: bool):
+        self.id = secrets.token_hex(8)
+        self.user = user
+        self.command = command
+        self.total_hosts = total_hosts
+        self.cluster = cluster
+        self.created = time.time()
+        self.status = ACTIVE
+        self.finished = False
+        self.seq = 0                       # next event offset
+        self.persisted = 0                 # events [0, persisted) are in the database
+        self.success = 0
+        self.failure = 0
+        self.cancel_requested = False
+        self.on_cancel = None              # stops the runner (see routers/multi_exec.py)
+        self.task: asyncio.Task | None = None
+        self._recent: deque[tuple[int, str, str]] = deque()   # (seq, type, json)
+        self._recent_bytes = 0
+        self._pending: list[tuple[int, str, str | None, str]] = []
+        self._hosts: dict[str, tuple] = {}
+        self._changed = asyncio.Event()
+        self._wake = asyncio.Event()
+        self.telemetry: str | None = None  # latest live-only event (not logged)
+        self.telemetry_version = 0
+        self._writer: asyncio.Task | None = None
+
+    # ── Recording ────────────────────────────────────────────────────────────
+    def emit(self, event: dict) -> int:
+        """Append ``event`` to the log; returns its ``seq``."""
+        seq = self.seq
+        self.seq += 1
+        raw = _dumps(dict(event, seq=seq))
+        etype = str(event.get("type", ""))
+        self._recent.append((seq, etype, raw))
+        self._recent_bytes += len(raw)
+        self._pending.append((seq, etype, event.get("host"), raw))
+        self._notify()
+        return seq
+
+    def live(self, event: dict) -> None:
+        """Publish a telemetry event to current subscribers without logging it."""
+        self.telemetry = _dumps(event)
+        self.telemetry_version += 1
+        self._notify()
+
+    def host_result(self, host: str, stage: str, *, ok: bool | None = None,
+                    exit_status: int | None = None, error: str | None = None) -> None:
+        self._hosts[host] = (stage, None if ok is None else int(ok), exit_status, error, time.time())
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    # ── Persistence ──────────────────────────────────────────────────────────
+    async def start(self, runner) -> None:
+        """Insert the job row and run ``runner`` (a coroutine) detached from any socket."""
+        await db.execute(
+            "INSERT INTO exec_jobs (id, user_id, username, command, total_hosts, cluster, status, created, pid, "
+            "pid_started) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (self.id, self.user["id"], self.user["username"], self.command, self.total_hosts,
+             int(self.cluster), ACTIVE, self.created, os.getpid(), _process_started(os.getpid())),
+        )
+        _jobs[self.id] = self
+        self._writer = asyncio.create_task(self._write_loop())
+        self.task = asyncio.create_task(self._run(runner))
+
+    async def _run(self, runner) -> None:
+        status = "completed"
+        try:
+            await runner
+        except asyncio.CancelledError:
+            status = "interrupted"
+        except Exception:
+            logger.exception("MultiExec job %s failed", self.id)
+            status = "failed"
+        if self.cancel_requested and status == "completed":
+            status = "cancelled"
+        await self._finish(status)
+
+    async def _write_loop(self) -> None:
+        while not self.finished:
+            try:
+                await asyncio.wait_for(self._wake.wait(), JOB_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("MultiExec job %s: writing results failed: %s", self.id, e)
+
+    async def flush(self, summary: dict | None = None) -> None:
+        """Write pending events and host results; picks up cancel requests from other workers."""
+        events, self._pending = self._pending, []
+        hosts, self._hosts = self._hosts, {}
+        upto = events[-1][0] + 1 if events else self.persisted
+        status = self.status
+        counts = (self.success, self.failure)
+
+        def write(conn: sqlite3.Connection):
+            if events:
+                conn.executemany(
+                    "INSERT INTO exec_job_events (job_id, seq, type, host, data) VALUES (?, ?, ?, ?, ?)",
+                    [(self.id, seq, etype, host, raw) for seq, etype, host, raw in events],
+                )
+            if hosts:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO exec_job_hosts (job_id, host, stage, ok, exit_status, error, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(self.id, host, *result) for host, result in hosts.items()],
+                )
+            conn.execute(
+                "UPDATE exec_jobs SET events = ?, total_hosts = ?, success = ?, failure = ?, status = ?, "
+                "finished = CASE WHEN ? != ? THEN ? ELSE finished END, "
+                "summary = COALESCE(?, summary) WHERE id = ?",
+                (upto, self.total_hosts, *counts, status, status, ACTIVE, time.time(),
+                 _dumps(summary) if summary is not None else None, self.id),
+            )
+            row = conn.execute("SELECT cancel_requested FROM exec_jobs WHERE id = ?", (self.id,)).fetchone()
+            return bool(row and row["cancel_requested"])
+
+        try:
+            cancel = await db.run(write)
+        except BaseException:
+            # Keep the batch for the next attempt
+            self._pending[:0] = events
+            for host, result in hosts.items():
+                self._hosts.setdefault(host, result)
+            raise
+        self.persisted = max(self.persisted, upto)
+        # Persisted events may now leave memory
+        while self._recent and self._recent[0][0] < self.persisted and (
+                len(self._recent) > MEMORY_EVENTS or self._recent_bytes > MEMORY_BYTES):
+            self._recent_bytes -= len(self._recent.popleft()[2])
+        if cancel and not self.cancel_requested:
+            self.cancel()
+
+    async def _finish(self, status: str) -> None:
+        self.status = status
+        summary = None
+        for _, etype, raw in reversed(self._recent):
+            if etype == "summary":
+                summary = json.loads(raw)
+                summary.pop("results", None)  # per-host rows are in exec_job_hosts
+                break
+        self.finished = True
+        self._wake.set()
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+        for attempt in range(3):
+            try:
+                await self.flush(summary)
+                break
+            except Exception as e:
+                logger.error("MultiExec job %s: final write failed (%d/3): %s", self.id, attempt + 1, e)
+                await asyncio.sleep(1)
+        self._notify()
+        _jobs.pop(self.id, None)
+        logger.info("MultiExec job %s %s: %d ok, %d failed, %d events",
+                    self.id, status, self.success, self.failure, self.seq)
+        try:
+            await sweep()
+        except Exception as e:
+            logger.warning("MultiExec job retention sweep failed: %s", e)
+
+    def cancel(self) -> None:
+        """Stop every host that has not finished; the job still writes its summary."""
+        self.cancel_requested = True
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    # ── Subscribing ──────────────────────────────────────────────────────────
+    async def events(self, offset: int = 0) -> AsyncIterator[tuple[str, str]]:
+        """``(type, json)`` from ``offset`` on: database, memory tail, then live."""
+        pos = max(0, offset)
+        telemetry_seen = self.telemetry_version
+        while True:
+            changed = self._changed
+            first = self._recent[0][0] if self._recent else self.seq
+            if pos < first:
+                rows = await _read_events(self.id, pos, first)
+                if not rows:
+                    pos = first  # nothing stored there (write failure); skip the gap
+                for row in rows:
+                    pos = row["seq"] + 1
+                    yield row["type"], row["data"]
+                continue
+            tail = list(islice(self._recent, pos - first, None))
+            for seq, etype, raw in tail:
+                pos = seq + 1
+                yield etype, raw
+            if self.telemetry_version != telemetry_seen and self.telemetry and not self.finished:
+                telemetry_seen = self.telemetry_version
+                yield "telemetry", self.telemetry
+            if self.finished and pos >= self.seq:
+                return
+            if pos >= self.seq and changed is self._changed:
+                await changed.wait()
+
+
+async def _read_events(job_id: str, start: int, end: int | None = None, limit: int = READ_PAGE) -> list:
+    return await db.fetchall(
+        "SELECT seq, type, data FROM exec_job_events WHERE job_id = ? AND seq >= ? AND seq < ? "
+        "ORDER BY seq LIMIT ?",
+        (job_id, start, end if end is not None else 2 ** 62, limit),
+    )
+
+
+# ─── Registry ───────────────────────────────────────────────────────────────────
+def get(job_id: str) -> ExecJob | None:
+    """The job if it is running in this worker."""
+    return _jobs.get(job_id)
+
+
+def running() -> list[ExecJob]:
+    return list(_jobs.values())
+
+
+async def fetch(user: dict, job_id: str) -> sqlite3.Row | None:
+    """The job's row if ``user`` owns it (or is an admin)."""
+    return await db.fetchone(
+        "SELECT * FROM exec_jobs WHERE id = ? AND (user_id = ? OR ?)",
+        (job_id, user["id"], int(bool(user.get("is_admin")))),
+    )
+
+
+async def follow(job_id: str, offset: int = 0) -> AsyncIterator[tuple[str, str]]:
+    """Events of ``job_id`` from ``offset``, wherever the job runs."""
+    job = _jobs.get(job_id)
+    if job is not None:
+        async for item in job.events(offset):
+            yield item
+        return
+    # Finished, or running in another worker: read the log as it is written
+    pos = max(0, offset)
+    while True:
+        rows = await _read_events(job_id, pos)
+        for row in rows:
+            pos = row["seq"] + 1
+            yield row["type"], row["data"]
+        if len(rows) == READ_PAGE:
+            continue
+        row = await db.fetchone("SELECT status, events FROM exec_jobs WHERE id = ?", (job_id,))
+        if row is None or (row["status"] != ACTIVE and pos >= row["events"]):
+            return
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def request_cancel(job_id: str) -> bool:
+    """Cancel a job here, or flag it for the worker running it; False if not running."""
+    job = _jobs.get(job_id)
+    if job is not None:
+        job.cancel()
+        return True
+    return bool(await db.execute(
+        "UPDATE exec_jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, ACTIVE)
+    ))
+
+
+# ─── Maintenance ────────────────────────────────────────────────────────────────
+def _pid_alive(pid: int | None) -> bool:
+    if not pid or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _process_started(pid: int) -> float | None:
+    """When process ``pid`` started (epoch seconds), from /proc; None where that is not available."""
+    global _boot_time
+    try:
+        if _boot_time is None:
+            with open("/proc/stat") as fh:
+                _boot_time = next(int(line.split()[1]) for line in fh if line.startswith("btime "))
+        with open(f"/proc/{pid}/stat") as fh:
+            # Field 22 (starttime, in clock ticks since boot); the command name may contain spaces
+            ticks = int(fh.read().rsplit(")", 1)[1].split()[19])
+    except (OSError, StopIteration, ValueError, IndexError):
+        return None
+    return _boot_time + ticks / os.sysconf("SC_CLK_TCK")
+
+
+_boot_time: int | None = None
+
+
+def _owner_alive(pid: int | None, pid_started: float | None, created: float) -> bool:
+    """Is the process that started a job still running it?
+
+    Pids are reused: after a container restart the workers get the same
+    small pids again. The process now holding ``pid`` must also have been
+    started when the job was (or, for rows without ``pid_started``, before).
+    """
+    if not _pid_alive(pid):
+        return False
+    started = _process_started(pid)
+    if started is None:
+        return True
+    if pid_started is not None:
+        return abs(started - pid_started) < 1.0
+    return started <= created
+
+
+def recover() -> None:
+    """Mark jobs left running by a dead process as interrupted (called at startup)."""
+    conn = db.get_db()
+    try:
+        rows = conn.execute("SELECT id, pid, pid_started, created FROM exec_jobs WHERE status = ?",
+                            (ACTIVE,)).fetchall()
+        dead = [(time.time(), r["id"]) for r in rows
+                if not _owner_alive(r["pid"], r["pid_started"], r["created"])]
+        if dead:
+            conn.executemany(
+                "UPDATE exec_jobs SET status = 'interrupted', finished = ? WHERE id = ? AND status = 'running'",
+                dead,
+            )
+            conn.commit()
+            logger.info("Marked %d MultiExec job(s) interrupted", len(dead))
+    finally:
+        conn.close()
+
+
+async def sweep() -> int:
+    """Delete finished jobs past the retention age or beyond the newest ``MAX_JOBS``."""
+    cutoff = time.time() - RETENTION_HOURS * 3600
+
+    def delete(conn: sqlite3.Connection):
+        rows = conn.execute(
+            "SELECT id FROM exec_jobs WHERE status != ? AND (finished < ? OR id NOT IN "
+            "(SELECT id FROM exec_jobs WHERE status != ? ORDER BY finished DESC LIMIT ?))",
+            (ACTIVE, cutoff, ACTIVE, MAX_JOBS),
+        ).fetchall()
+        ids = [(r["id"],) for r in rows]
+        if ids:
+            conn.executemany("DELETE FROM exec_job_events WHERE job_id = ?", ids)
+            conn.executemany("DELETE FROM exec_job_hosts WHERE job_id = ?", ids)
+            conn.executemany("DELETE FROM exec_jobs WHERE id = ?", ids)
+        return [job_id for job_id, in ids]
+
+    removed = await db.run(delete)
+    if removed:
+        def remove_output():
+            # The job's log links to its stored output; they go together
+            for job_id in removed:
+                output_store.remove(job_id)
+
+        await asyncio.to_thread(remove_output)
+        logger.info("Removed %d expired MultiExec job(s)", len(removed))
+    return len(removed)
@@ -0,0 +1,246 @@
+# exec_runner.py
+"""Run one command on many hosts under adaptive limits.
+
+:class:`HostExecutor` holds the per-host steps of a MultiExec run: connect
+through the SSH pool, open the command channel, stream or capture output,
+and report the result. The run is staged and limited by two AIMD budgets
+(see :mod:`adaptive_limit`). All reporting goes through a *sink*, so the
+same code can run in the web worker, which feeds a job's event log, or in
+a shard process, which forwards events over a pipe (see :mod:`exec_shards`).
+
+A sink provides:
+
+* ``async status(payload)``: a ``host_status`` stage event.
+* ``async output(host, stream, text)``: streamed output.
+* ``new_capture()``: an output capture for clustering, or None to stream.
+* ``async finished(host, *, connected, ok, exit_status, error, capture, unreachable)``:
+  the host's final result. ``unreachable`` marks hosts the TCP pre-check
+  (see :mod:`tcp_probe`) turned away before any SSH handshake.
+* ``stopped(host)``: the host was cancelled before it finished.
+
+:meth:`HostExecutor.run_many` pulls hosts from an async iterator only as
+fast as the limits can take them. A large target set (see :mod:`host_expr`)
+is therefore never held in memory as a list, and connecting starts with the
+first host.
+"""
+
+import asyncio
+import re
+import shlex
+from typing import AsyncIterator
+
+import asyncssh
+
+import ssh_pool
+import tcp_probe
+from adaptive_limit import AdaptiveLimiter
+
+READ_CHUNK = 16384
+
+
+def ensure_exit_code(val):
+    try:
+        if isinstance(val, int):
+            return val
+        code = getattr(val, "exit_status", None)
+        if code is None:
+            code = getattr(val, "returncode", None)
+        if isinstance(code, int):
+            return code
+        if isinstance(val, str):
+            m = re.search(r"exit_status:\s*(\d+)", val) or re.search(r"returncode:\s*(\d+)", val)
+            if m:
+                return int(m.group(1))
+        if isinstance(code, str) and code.isdigit():
+            return int(code)
+    except Exception:
+        pass
+    return None
+
+
+class HostExecutor:
+    """Per-host connect → run → report steps sharing one pair of adaptive limits."""
+
+    def __init__(self, ssh_user: str, ssh_pass: str, command: str, sink, *,
+                 connect: tuple[int, int], execute: tuple[int, int], probe: bool = True):
+        self.ssh_user = ssh_user
+        self.ssh_pass = ssh_pass
+        self.command = command
+        self.sink = sink
+        # Adaptive concurrency: handshakes and command runs have separate budgets
+        self.connect_limit = AdaptiveLimiter("connect", connect[0], minimum=2, maximum=connect[1])
+        self.exec_limit = AdaptiveLimiter("exec", execute[0], minimum=1, maximum=execute[1])
+        # Dead hosts are weeded out by a TCP check before they take a connect slot
+        self.probe = probe and tcp_probe.prober.enabled
+        self.unreachable = 0
+        self.tasks: set[asyncio.Task] = set()
+        self.started = 0
+        self._admitted = 0              # hosts started but not yet past connecting
+        self._room = asyncio.Event()
+        self._stopped = False
+
+    async def stream_process(self, host: str, conn: asyncssh.SSHClientConnection, slot,
+                             capture=None) -> tuple[bool, int | None]:
+        # Start process and stream output (or collect it into ``capture``); return (ok, exit_status)
+        sink = self.sink
+        await sink.status({"type": "host_status", "host": host, "stage": "command_starting"})
+        proc = None
+        exit_status: int | None = None
+        # 1) Start process (failures here imply failure)
+        try:
+            proc = await conn.create_process(f"bash -lc {shlex.quote(self.command)}",
+                                             encoding="utf-8", errors="replace")
+        except Exception as e:
+            slot.failed(e)
+            return (False, None)
+        # Channel open latency is the exec budget's health signal; the
+        # permit is still held while the command runs
+        slot.succeeded()
+
+        await sink.status({"type": "host_status", "host": host, "stage": "command_started"})
+
+        # 2) Stream output (any reader error should NOT flip success if exit_status==0).
+        # Whatever has arrived, partial lines included, goes out on the next tick.
+        async def write(stream: str, data: str):
+            if capture is not None:
+                capture.write(stream, data)
+            else:
+                await sink.output(host, stream, data)
+
+        async def read_stream(reader, stream: str):
+            try:
+                while True:
+                    data = await reader.read(READ_CHUNK)
+                    if not data:
+                        break
+                    if isinstance(data, bytes):
+                        data = data.decode("utf-8", "replace")
+                    await write(stream, data)
+            except Exception as e:
+                # Log to UI but don't change outcome
+                await write("stderr", f"[reader-error] {e}\n")
+
+        read_out = asyncio.create_task(read_stream(proc.stdout, "stdout"))
+        read_err = asyncio.create_task(read_stream(proc.stderr, "stderr"))
+        try:
+            # Get exit status as early as possible and report completion before draining.
+            # Not proc.wait(): it collects unread output itself, racing the readers above.
+            await proc.wait_closed()
+            exit_status = ensure_exit_code(proc)
+            ex = ensure_exit_code(exit_status)
+            ok_now = (ex == 0 if ex is not None else False)
+            # Emit early completion notification to reduce risk of client missing it
+            await sink.status({
+                "type": "host_status",
+                "host": host,
+                "stage": "completed",
+                "ok": ok_now,
+                "exit_status": ex,
+            })
+
+            await asyncio.gather(read_out, read_err, return_exceptions=True)
+        finally:
+            # Stopped (job cancelled): end the remote command and the readers with it
+            if proc.exit_status is None and proc.exit_signal is None:
+                try:
+                    proc.terminate()
+                except Exception:
+                    pass
+            proc.close()
+            read_out.cancel()
+            read_err.cancel()
+            await asyncio.gather(read_out, read_err, return_exceptions=True)
+
+        return (ok_now, exit_status)
+
+    async def run_host(self, host: str) -> None:
+        sink = self.sink
+        try:
+            # Connect at most one batch ahead of the commands that can start
+            await self.exec_limit.wait_for_room()
+            async with self.connect_limit.slot() as slot:
+                await sink.status({"type": "host_status", "host": host, "stage": "connecting"})
+                try:
+                    conn = await ssh_pool.pool.acquire(host, self.ssh_user, self.ssh_pass)
+                except Exception as e:
+                    slot.failed(e)
+                    conn = None
+                    error = e
+                else:
+                    slot.succeeded()
+        finally:
+            self._admitted -= 1
+            self._room.set()
+        if conn is None:
+            await sink.finished(host, connected=False, ok=False, exit_status=None,
+                                error=str(error) or type(error).__name__)
+            return
+        await sink.status({"type": "host_status", "host": host, "stage": "connected"})
+        capture = sink.new_capture()
+        try:
+            async with self.exec_limit.slot() as slot:
+                ok, exit_status = await self.stream_process(host, conn, slot, capture)
+        finally:
+            await ssh_pool.pool.release(conn)
+        ex = ensure_exit_code(exit_status)
+        if ex is not None:
+            ok = (ex == 0)
+        await sink.finished(host, connected=True, ok=ok, exit_status=ex, capture=capture)
+
+    # ── Many hosts ───────────────────────────────────────────────────────────
+    def _backlog(self) -> int:
+        # Enough waiting hosts to fill the next connect round and the exec queue
+        return int(self.connect_limit.limit) + int(self.exec_limit.limit)
+
+    async def run_many(self, hosts: AsyncIterator[str]) -> int:
+        """Run every host ``hosts`` yields; returns how many were started.
+
+        The next host is taken only while fewer than one round of hosts
+        wait to connect, so memory follows the limits, not the target count.
+        :meth:`stop` ends the run early.
+        """
+        async def guarded(host: str):
+            try:
+                await self.run_host(host)
+            except asyncio.CancelledError:
+                self.sink.stopped(host)
+                raise
+
+        if self.probe:
+            hosts = tcp_probe.prober.reachable_hosts(hosts, self._unreachable)
+        try:
+            async for host in hosts:
+                while self._admitted >= self._backlog() and not self._stopped:
+                    self._room.clear()
+                    await self._room.wait()
+                if self._stopped:
+                    break
+                self._admitted += 1
+                self.started += 1
+                task = asyncio.create_task(guarded(host))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        finally:
+            while self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+            self.connect_limit.close()
+            self.exec_limit.close()
+        return self.started
+
+    async def _unreachable(self, host: str, error: str) -> None:
+        self.unreachable += 1
+        await self.sink.finished(host, connected=False, ok=False, exit_status=None, error=error, unreachable=True)
+
+    def stop(self) -> None:
+        """Take no more hosts and cancel the ones in progress."""
+        self._stopped = True
+        self._room.set()
+        for task in list(self.tasks):
+            task.cancel()
+
+    def concurrency(self, history: bool = False) -> dict:
+        stats = {"connect": self.connect_limit.stats(), "exec": self.exec_limit.stats()}
+        if not history:
+            for s in stats.values():
+                s.pop("history")
+        return stats
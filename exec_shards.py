@@ -0,0 +1,423 @@
+# exec_shards.py
+"""Spread one large MultiExec job over several processes.
+
+A job normally runs in the worker that accepted its WebSocket. At several
+thousand hosts that one event loop is CPU-bound on SSH crypto (key exchange,
+ciphers, MACs), while the other cores sit idle. :class:`ShardedRun` deals
+the hosts out to ``shards`` child processes, ``FEED_CHUNK`` at a time as each
+child asks for more, so the target set is never split up front and a fast
+shard takes more of it. Each child runs the
+ordinary per-host steps (:class:`exec_runner.HostExecutor`) with its own SSH
+pool and its own adaptive limits. The limit ceilings are divided between the
+shards, so the job as a whole stays within the configured maximums.
+
+Children send their reports back over a pipe in batches: stage events,
+output, final results, and limit telemetry. The coordinator replays them into
+the job's sink, so the client and the job log see one merged stream, the
+same as for an unsharded run. In clustering mode a child sends only the
+SHA-256 fingerprints of a result. It adds the output text the first time it
+sees that result, so identical output from thousands of hosts crosses the
+pipe once per shard.
+
+Jobs with at least ``MULTI_EXEC_SHARD_HOSTS`` hosts are sharded
+automatically, into up to ``MULTI_EXEC_SHARDS`` processes with at least
+``MIN_SHARD_HOSTS`` hosts each. A request can also ask for a shard count.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator
+
+import output_clusters
+import tcp_probe
+from exec_runner import HostExecutor
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.exec_shards")
+
+
+SHARD_HOSTS = max(1, env_int("MULTI_EXEC_SHARD_HOSTS", 2000))
+SHARD_PROCESSES = max(1, env_int("MULTI_EXEC_SHARDS", os.cpu_count() or 1))
+MIN_SHARD_HOSTS = 250           # automatic sharding keeps at least this many hosts per process
+BATCH_INTERVAL = 0.02           # child → coordinator batching
+BATCH_BYTES = 256 * 1024
+PENDING_BYTES = 4 * 1024 * 1024  # a child's output writers wait above this
+TELEMETRY_INTERVAL = 1.0
+QUEUE_BATCHES = 64              # batches buffered in the coordinator before children block
+FEED_CHUNK = 128                # hosts handed to a shard per request
+
+
+def shard_count(total_hosts: int, requested=None) -> int:
+    """Processes to use for a job of ``total_hosts`` (1 = run in this worker)."""
+    if requested is not None:
+        try:
+            requested = int(requested)
+        except (TypeError, ValueError):
+            requested = None
+    if requested is not None:
+        return max(1, min(requested, SHARD_PROCESSES, total_hosts))
+    if total_hosts < SHARD_HOSTS:
+        return 1
+    return max(1, min(SHARD_PROCESSES, total_hosts // MIN_SHARD_HOSTS))
+
+
+# ─── Child process ──────────────────────────────────────────────────────────────
+class _PipeSink:
+    """HostExecutor sink that batches reports to the coordinator."""
+
+    def __init__(self, conn, cluster: bool, max_output: int):
+        self.conn = conn
+        self.cluster = cluster
+        self.max_output = max_output
+        self._batch: list[tuple] = []
+        self._bytes = 0
+        self._wake = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._sent_results: set[tuple] = set()
+        self._closed = False
+
+    def put(self, message: tuple, size: int = 64) -> None:
+        self._batch.append(message)
+        self._bytes += size
+        if self._bytes >= BATCH_BYTES:
+            self._wake.set()
+
+    async def status(self, payload: dict):
+        self.put(("status", payload))
+
+    async def output(self, host: str, stream: str, data: str):
+        self.put(("output", host, stream, data), len(data))
+        while self._bytes >= PENDING_BYTES:
+            self._drained.clear()
+            await self._drained.wait()
+
+    def new_capture(self):
+        return output_clusters.new_capture(self.max_output) if self.cluster else None
+
+    async def finished(self, host: str, *, connected: bool, ok: bool, exit_status, error=None, capture=None,
+                       unreachable: bool = False):
+        fingerprint = texts = None
+        size = 64
+        if capture is not None:
+            fingerprint = output_clusters.digest(capture)
+            key = (fingerprint[0], fingerprint[1], exit_status, ok)
+            if key not in self._sent_results:
+                # First host with this result in this shard: the text goes along once
+                self._sent_results.add(key)
+                texts = ("".join(capture.parts["stdout"]), "".join(capture.parts["stderr"]), capture.truncated)
+                size += len(texts[0]) + len(texts[1])
+        self.put(("finished", host, connected, ok, exit_status, error, fingerprint, texts, unreachable), size)
+
+    def stopped(self, host: str):
+        self.put(("stopped", host))
+
+    def request(self, message: tuple) -> None:
+        """Send a request to the coordinator without waiting for the batch tick."""
+        self.put(message)
+        self._wake.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), BATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._batch:
+                batch, self._batch, self._bytes = self._batch, [], 0
+                # Blocks while the coordinator is behind, which pauses output readers
+                await loop.run_in_executor(None, self.conn.send, batch)
+                self._drained.set()
+            elif self._closed:
+                return
+
+    async def close(self):
+        self._closed = True
+        self._wake.set()
+
+
+class _Feed:
+    """This shard's hosts, requested from the coordinator a chunk at a time."""
+
+    def __init__(self, sink: _PipeSink, first: list[str], more: bool):
+        self.sink = sink
+        self.hosts = deque(first)
+        self.more = more
+        self._asked = False
+        self._arrived = asyncio.Event()
+
+    def add(self, hosts: list[str], more: bool) -> None:
+        self.hosts.extend(hosts)
+        self.more = more
+        self._asked = False
+        self._arrived.set()
+
+    def end(self) -> None:
+        self.more = False
+        self._arrived.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        while True:
+            if self.more and not self._asked and len(self.hosts) < FEED_CHUNK // 2:
+                # Ask ahead so the next chunk is here before this one runs out
+                self._asked = True
+                self.sink.request(("more",))
+            if self.hosts:
+                return self.hosts.popleft()
+            if not self.more:
+                raise StopAsyncIteration
+            self._arrived.clear()
+            await self._arrived.wait()
+
+
+async def _run_shard(events, control, first, more, ssh_user, ssh_pass, command, options):
+    loop = asyncio.get_running_loop()
+    sink = _PipeSink(events, options["cluster"], options["max_output"])
+    executor = HostExecutor(ssh_user, ssh_pass, command, sink, connect=options["connect"],
+                            execute=options["execute"], probe=options["probe"])
+    feed = _Feed(sink, first, more)
+
+    def on_control():
+        # ("hosts", chunk, more), ("cancel",), or EOF when the coordinator went away
+        try:
+            message = control.recv()
+        except (EOFError, OSError):
+            message = ("cancel",)
+        if message and message[0] == "hosts":
+            feed.add(message[1], message[2])
+        elif message and message[0] == "cancel":
+            loop.remove_reader(control.fileno())
+            feed.end()
+            executor.stop()
+
+    loop.add_reader(control.fileno(), on_control)
+
+    async def telemetry():
+        while True:
+            await asyncio.sleep(TELEMETRY_INTERVAL)
+            sink.put(("limits", executor.concurrency()))
+
+    flusher = asyncio.create_task(sink.run())
+    reporter = asyncio.create_task(telemetry())
+    await executor.run_many(feed)
+    reporter.cancel()
+    sink.put(("done", executor.concurrency(history=True)))
+    await sink.close()
+    await flusher
+
+
+def _shard_main(events, control, first, more, ssh_user, ssh_pass, command, options):
+    """Child process entry point."""
+    try:
+        asyncio.run(_run_shard(events, control, first, more, ssh_user, ssh_pass, command, options))
+    finally:
+        events.close()
+
+
+# ─── Coordinator ────────────────────────────────────────────────────────────────
+class ShardedRun:
+    """Runs hosts in ``shards`` processes and replays their reports into ``sink``.
+
+    Hosts are dealt out on demand: each shard asks for another chunk when
+    its queue runs low, so a fast shard takes more work and the target
+    set is read no faster than the shards consume it.
+    """
+
+    def __init__(self, hosts: AsyncIterator[str], ssh_user: str, ssh_pass: str, command: str, sink, *,
+                 shards: int, cluster: bool, max_output: int,
+                 connect: tuple[int, int], execute: tuple[int, int], probe: bool = True):
+        self.hosts = hosts.__aiter__()
+        self.shards = shards
+        self.sink = sink
+        self._args = (ssh_user, ssh_pass, command)
+        connect_max = max(2, connect[1] // shards)
+        execute_max = max(1, execute[1] // shards)
+        self._options = {
+            "cluster": cluster,
+            "max_output": max_output,
+            "probe": probe and tcp_probe.prober.enabled,
+            "connect": (min(connect[0], connect_max), connect_max),
+            "execute": (min(execute[0], execute_max), execute_max),
+        }
+        self._controls = []
+        self._processes = []
+        self._exhausted = False
+        self._cancelled = False
+        self.dealt = 0
+        # Hosts handed to each shard and not yet reported back
+        self.outstanding: list[set[str]] = [set() for _ in range(shards)]
+        self.limits: list[dict | None] = [None] * shards
+        self.final: list[dict | None] = [None] * shards
+        self.started = time.monotonic()
+
+    async def _take(self, index: int) -> tuple[list[str], bool]:
+        """The next chunk for shard ``index`` and whether more may follow."""
+        chunk: list[str] = []
+        while not self._exhausted and not self._cancelled and len(chunk) < FEED_CHUNK:
+            try:
+                host = await self.hosts.__anext__()
+            except StopAsyncIteration:
+                self._exhausted = True
+                break
+            # Shards start with an empty probe cache; this worker's cache answers for them
+            known = tcp_probe.prober.cached(host) if self._options["probe"] else None
+            if known is not None and not known[0]:
+                await self.sink.finished(host, connected=False, ok=False, exit_status=None,
+                                         error=known[1], unreachable=True)
+            else:
+                chunk.append(host)
+        self.outstanding[index].update(chunk)
+        self.dealt += len(chunk)
+        return chunk, not (self._exhausted or self._cancelled)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        ctx = multiprocessing.get_context("spawn")
+        queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_BATCHES)
+        try:
+            for index in range(self.shards):
+                if self._cancelled:
+                    break
+                first, more = await self._take(index)
+                events_r, events_w = ctx.Pipe(duplex=False)
+                control_r, control_w = ctx.Pipe(duplex=False)
+                process = ctx.Process(
+                    target=_shard_main, name=f"multiexec-shard-{index}", daemon=True,
+                    args=(events_w, control_r, first, more, *self._args, self._options),
+                )
+                await loop.run_in_executor(None, process.start)
+                events_w.close()
+                control_r.close()
+                self._processes.append(process)
+                self._controls.append(control_w)
+                if self._cancelled:
+                    # Cancelled while this process was starting
+                    control_w.send(("cancel",))
+                threading.Thread(target=self._pump, args=(index, events_r, queue, loop),
+                                 name=f"multiexec-shard-{index}-reader", daemon=True).start()
+            logger.info("Started %d shard process(es)", len(self._processes))
+
+            live = len(self._processes)
+            while live:
+                index, batch = await queue.get()
+                if batch is None:
+                    live -= 1
+                    if self.final[index] is None:
+                        await self._lost(index)
+                    continue
+                for message in batch:
+                    await self._dispatch(index, message)
+        finally:
+            self.cancel()
+            await loop.run_in_executor(None, self._reap)
+
+    @staticmethod
+    def _pump(index: int, conn, queue: asyncio.Queue, loop) -> None:
+        """Reader thread: hand each batch to the event loop (blocks while it is behind)."""
+        while True:
+            try:
+                batch = conn.recv()
+            except (EOFError, OSError):
+                batch = None
+            try:
+                asyncio.run_coroutine_threadsafe(queue.put((index, batch)), loop).result()
+            except Exception:
+                return
+            if batch is None:
+                conn.close()
+                return
+
+    async def _dispatch(self, index: int, message: tuple) -> None:
+        kind = message[0]
+        sink = self.sink
+        if kind == "output":
+            await sink.output(message[1], message[2], message[3])
+        elif kind == "status":
+            await sink.status(message[1])
+        elif kind == "finished":
+            _, host, connected, ok, exit_status, error, fingerprint, texts, unreachable = message
+            self.outstanding[index].discard(host)
+            if unreachable:
+                tcp_probe.prober.remember(host, False, error)
+            await sink.finished(host, connected=connected, ok=ok, exit_status=exit_status, error=error,
+                                fingerprint=fingerprint, texts=texts, unreachable=unreachable)
+        elif kind == "stopped":
+            self.outstanding[index].discard(message[1])
+            sink.stopped(message[1])
+        elif kind == "more":
+            chunk, more = await self._take(index)
+            try:
+                self._controls[index].send(("hosts", chunk, more))
+            except (OSError, ValueError):
+                pass
+        elif kind == "limits":
+            self.limits[index] = message[1]
+        elif kind == "done":
+            self.final[index] = message[1]
+
+    async def _lost(self, index: int) -> None:
+        """A shard exited without finishing: fail the hosts it never reported."""
+        process = self._processes[index] if index < len(self._processes) else None
+        code = process.exitcode if process is not None else None
+        logger.error("MultiExec shard %d exited early (exit code %s)", index, code)
+        lost, self.outstanding[index] = self.outstanding[index], set()
+        for host in sorted(lost):
+            await self.sink.finished(host, connected=False, ok=False, exit_status=None,
+                                     error=f"shard process exited (code {code})")
+
+    def cancel(self) -> None:
+        self._cancelled = True
+        for control in self._controls:
+            try:
+                control.send(("cancel",))
+            except (OSError, ValueError):
+                pass
+
+    def _reap(self) -> None:
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout=1)
+        for control in self._controls:
+            control.close()
+
+    def concurrency(self, history: bool = False) -> dict:
+        """Adaptive limits summed over shards (same shape as an unsharded run)."""
+        per_shard = [f or l for f, l in zip(self.final, self.limits)]
+        merged = {}
+        for stage in ("connect", "exec"):
+            stats = [s[stage] for s in per_shard if s]
+            total = {
+                key: sum(s[key] for s in stats)
+                for key in ("limit", "min", "max", "in_flight", "peak_in_flight", "completed",
+                            "errors", "overloads", "decreases")
+            }
+            ok = [(s["completed"] - s["errors"], s["avg_latency_ms"]) for s in stats if s["avg_latency_ms"] is not None]
+            ok_count = sum(n for n, _ in ok)
+            waits = [(s["completed"], s["avg_wait_ms"]) for s in stats if s["avg_wait_ms"] is not None]
+            wait_count = sum(n for n, _ in waits)
+            bests = [s["best_latency_ms"] for s in stats if s["best_latency_ms"] is not None]
+            total.update({
+                "phase": "slow_start" if any(s["phase"] == "slow_start" for s in stats) else "avoidance",
+                "error_rate": round(total["errors"] / total["completed"], 3) if total["completed"] else 0.0,
+                "best_latency_ms": min(bests) if bests else None,
+                "avg_latency_ms": round(sum(n * v for n, v in ok) / ok_count, 1) if ok_count else None,
+                "avg_wait_ms": round(sum(n * v for n, v in waits) / wait_count, 1) if wait_count else None,
+                "shards": self.shards,
+            })
+            if history:
+                # Each shard adapts on its own; the first shard's path is representative
+                total["history"] = next((s.get("history", []) for s in stats), [])
+            merged[stage] = total
+        return merged
@@ -0,0 +1,145 @@
+# host_cache.py
+"""Per-worker cache of host records for permission checks.
+
+Terminal pages, terminal WebSockets, the combined view and SFTP token minting
+all look up one host by id and check that the user owns it (or is an admin).
+After a proxy restart, every browser reconnects at once and repeats that
+lookup. The cache keeps host rows for ``HOST_CACHE_TTL`` seconds, up to
+``HOST_CACHE_SIZE`` entries with least-recently-used eviction. The
+ownership check is applied to the cached row, so one entry serves every user.
+
+Writes to ``hosts`` call :func:`bump` inside their transaction, which
+increments a shared generation counter in SQLite, and :func:`invalidate`
+after commit. The other workers notice cheaply: before each lookup they read
+``PRAGMA data_version`` on a dedicated connection. That is a read of the WAL
+shared-memory index with no disk I/O, and it changes only when another
+connection has committed. Only then is the counter re-read, and if it moved
+the local cache is cleared. The TTL bounds staleness for edits made outside
+the app.
+"""
+
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+import db
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.host_cache")
+
+
+HOST_CACHE_TTL = max(0, env_int("HOST_CACHE_TTL", 30))
+HOST_CACHE_SIZE = max(1, env_int("HOST_CACHE_SIZE", 4096))
+
+_GENERATION_KEY = "hosts"
+
+
+def bump(conn: sqlite3.Connection) -> None:
+    """Mark host records changed for every worker (call inside the write's transaction)."""
+    conn.execute(
+        "INSERT INTO cache_generations (name, generation) VALUES (?, 1) "
+        "ON CONFLICT(name) DO UPDATE SET generation = generation + 1",
+        (_GENERATION_KEY,),
+    )
+
+
+class HostCache:
+    """TTL + LRU map of host id → host row, kept coherent across workers."""
+
+    def __init__(self, ttl: float = HOST_CACHE_TTL, max_entries: int = HOST_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[int, tuple[float, sqlite3.Row]] = OrderedDict()
+        self._watch: sqlite3.Connection | None = None
+        self._data_version: int | None = None
+        self._generation: int | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation_clears = 0
+
+    def _sync(self) -> None:
+        """Drop everything if another connection changed the host generation."""
+        try:
+            if self._watch is None:
+                self._watch = db.get_db()
+            version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                return
+            self._data_version = version
+            row = self._watch.execute(
+                "SELECT generation FROM cache_generations WHERE name = ?", (_GENERATION_KEY,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.debug("Host cache sync failed, clearing: %s", e)
+            self._entries.clear()
+            return
+        generation = row[0] if row else 0
+        if generation != self._generation:
+            # Also taken after this worker's own writes; the clear is harmless
+            if self._generation is not None and self._entries:
+                self.generation_clears += 1
+                self._entries.clear()
+            self._generation = generation
+
+    async def get(self, host_id: int) -> sqlite3.Row | None:
+        """The host row for ``host_id`` (no permission check), else None."""
+        if self.ttl:
+            self._sync()
+            entry = self._entries.get(host_id)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(host_id)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[host_id]
+        self.misses += 1
+        row = await db.fetchone("SELECT * FROM hosts WHERE id = ?", (host_id,))
+        if row is not None and self.ttl:
+            self._entries[host_id] = (time.monotonic() + self.ttl, row)
+            self._entries.move_to_end(host_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return row
+
+    def invalidate(self, host_ids=None) -> None:
+        """Forget ``host_ids`` (all hosts when None) in this worker."""
+        self.invalidations += 1
+        if host_ids is None:
+            self._entries.clear()
+        else:
+            for host_id in host_ids:
+                self._entries.pop(host_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "generation_clears": self.generation_clears,
+            "generation": self._generation,
+        }
+
+
+cache = HostCache()
+
+
+async def get_host(user: dict, host_id: int) -> sqlite3.Row | None:
+    """Host row if it exists and ``user`` owns it (or is an admin), else None."""
+    row = await cache.get(host_id)
+    if row is None or not (row["user_id"] == user.get("id") or user.get("is_admin")):
+        return None
+    return row
+
+
+def invalidate(host_ids=None) -> None:
+    cache.invalidate(host_ids)
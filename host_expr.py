@@ -0,0 +1,505 @@
+# host_expr.py
+"""Host-set expressions for MultiExec targets.
+
+An expression is a list of terms separated by commas, spaces or newlines:
+
+* ``web01.example.com``, ``10.0.0.7``: one host.
+* ``10.0.0.1-50``: a range of the last octet (the original syntax).
+* ``10.0.0.250-10.0.1.10``: a range of addresses.
+* ``10.20.0.0/16``: the usable addresses of a network (IPv4 or IPv6).
+* ``web[01-64].dc{1,2}``: a pattern. ``[a-b]`` counts from ``a`` to ``b``,
+  zero-padded when ``a`` is written with leading zeros; ``[1,3,5-7]`` lists
+  values; ``{x,y}`` alternates and may contain further patterns.
+* ``@DC1/web``: the hosts of a dashboard folder and its subfolders
+  (``@Ungrouped`` for hosts without a folder). Quote names that contain
+  spaces: ``@"Data Center/web"``.
+* ``!term``: leave these hosts out. Exclusions apply to the whole
+  expression, wherever they appear.
+
+:func:`parse` checks the syntax and returns a :class:`HostExpr`. Iterating it
+yields each host once, in the order written, without building the list.
+Networks and ranges are walked as integers. Duplicates are tracked in a
+:class:`SeenSet`, which stores IPv4 addresses as bits (8 KB per /16 touched)
+instead of as strings. A /16 therefore starts yielding at once and never
+holds 65,536 strings. :meth:`HostExpr.estimate` gives an upper bound of the
+count (before duplicates and exclusions) without iterating.
+"""
+
+import asyncio
+import bisect
+import ipaddress
+import re
+from typing import AsyncIterator, Iterator
+
+import db
+
+MAX_PATTERN_WIDTH = 10          # digits in a [a-b] bound
+_OCTET_RANGE = re.compile(r"^(\d{1,3}\.\d{1,3}\.\d{1,3})\.(\d{1,3})-(\d{1,3})$")
+_ADDRESS_RANGE = re.compile(r"^(\d{1,3}(?:\.\d{1,3}){3})-(\d{1,3}(?:\.\d{1,3}){3})$")
+_SEPARATORS = " \t\r\n,;"
+
+
+class HostExprError(ValueError):
+    """The expression cannot be parsed or resolved; the message says where."""
+
+
+def _ipv4_key(host: str) -> int | None:
+    """Dotted-quad ``host`` as an integer, or None (cheaper than ipaddress for names)."""
+    parts = host.split(".")
+    if len(parts) != 4:
+        return None
+    value = 0
+    for part in parts:
+        if not part.isdigit() or len(part) > 3 or (len(part) > 1 and part[0] == "0"):
+            return None
+        octet = int(part)
+        if octet > 255:
+            return None
+        value = (value << 8) | octet
+    return value
+
+
+def _ipv4_str(value: int) -> str:
+    return f"{value >> 24}.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}"
+
+
+class SeenSet:
+    """Membership for hosts already yielded: IPv4 in per-/16 bitmaps, others by name."""
+
+    __slots__ = ("_v4", "_other", "count")
+
+    def __init__(self):
+        self._v4: dict[int, bytearray] = {}
+        self._other: set = set()
+        self.count = 0
+
+    def add(self, key) -> bool:
+        """Add ``key`` (IPv4 int, or any hashable); False if it was already present."""
+        if type(key) is int:
+            block = self._v4.get(key >> 16)
+            if block is None:
+                block = self._v4[key >> 16] = bytearray(8192)
+            index, bit = (key & 0xFFFF) >> 3, 1 << (key & 7)
+            if block[index] & bit:
+                return False
+            block[index] |= bit
+        elif key in self._other:
+            return False
+        else:
+            self._other.add(key)
+        self.count += 1
+        return True
+
+    def memory(self) -> int:
+        """Approximate bytes held (bitmaps plus one pointer per other key)."""
+        return 8192 * len(self._v4) + 64 * len(self._other)
+
+
+def _key(host: str):
+    """Dedup/exclusion key: an int for IPv4, ('v6', int) for IPv6, else the lowercased name."""
+    value = _ipv4_key(host)
+    if value is not None:
+        return value
+    if ":" in host:
+        try:
+            return ("v6", int(ipaddress.IPv6Address(host)))
+        except ValueError:
+            pass
+    return host.lower()
+
+
+# ─── Terms ─────────────────────────────────────────────────────────────────────
+# Each term yields (host, key) pairs and knows its size without iterating.
+
+class _Literal:
+    def __init__(self, host: str):
+        self.host = host
+
+    def size(self) -> int:
+        return 1
+
+    def __iter__(self):
+        yield self.host, _key(self.host)
+
+
+class _IPv4Range:
+    """Inclusive integer range of IPv4 addresses (ranges and networks)."""
+
+    def __init__(self, first: int, last: int):
+        self.first, self.last = first, last
+
+    def size(self) -> int:
+        return self.last - self.first + 1
+
+    def __iter__(self):
+        for value in range(self.first, self.last + 1):
+            yield _ipv4_str(value), value
+
+
+class _IPv6Range:
+    def __init__(self, first: int, last: int):
+        self.first, self.last = first, last
+
+    def size(self) -> int:
+        return self.last - self.first + 1
+
+    def __iter__(self):
+        for value in range(self.first, self.last + 1):
+            yield str(ipaddress.IPv6Address(value)), ("v6", value)
+
+
+class _Pattern:
+    """Literal text, ``[ranges]`` and ``{alternatives}``, multiplied out lazily."""
+
+    def __init__(self, parts: list):
+        # parts: str | list[tuple[start, end, width]] (ranges) | list[_Pattern] (alternatives)
+        self.parts = parts
+
+    def size(self) -> int:
+        total = 1
+        for part in self.parts:
+            if isinstance(part, str):
+                continue
+            if part and isinstance(part[0], _Pattern):
+                total *= sum(p.size() for p in part)
+            else:
+                total *= sum(end - start + 1 for start, end, _ in part)
+        return total
+
+    def strings(self, index: int = 0, prefix: str = "") -> Iterator[str]:
+        if index == len(self.parts):
+            yield prefix
+            return
+        part = self.parts[index]
+        if isinstance(part, str):
+            yield from self.strings(index + 1, prefix + part)
+        elif part and isinstance(part[0], _Pattern):
+            for alternative in part:
+                for text in alternative.strings():
+                    yield from self.strings(index + 1, prefix + text)
+        else:
+            for start, end, width in part:
+                for value in range(start, end + 1):
+                    yield from self.strings(index + 1, prefix + str(value).zfill(width))
+
+    def ends(self, text: str, pos: int, memo: dict) -> set[int]:
+        """Positions where a match of this pattern starting at ``pos`` of lowercased ``text`` can end.
+
+        ``memo`` holds the answer per (pattern, start), so nested alternatives are
+        matched once per position instead of once per path that reaches it.
+        """
+        state = (id(self), pos)
+        found = memo.get(state)
+        if found is not None:
+            return found
+        positions = {pos}
+        for part in self.parts:
+            if not positions:
+                break
+            if isinstance(part, str):
+                lowered = part.lower()
+                positions = {p + len(part) for p in positions if text.startswith(lowered, p)}
+            elif part and isinstance(part[0], _Pattern):
+                positions = {end for p in positions for alternative in part
+                             for end in alternative.ends(text, p, memo)}
+            else:
+                following = set()
+                for p in positions:
+                    run = p
+                    while run < len(text) and text[run].isdigit():
+                        run += 1
+                    for end in range(p + 1, run + 1):
+                        digits = text[p:end]
+                        value = int(digits)
+                        if any(start <= value <= stop and str(value).zfill(width) == digits
+                               for start, stop, width in part):
+                            following.add(end)
+                positions = following
+        memo[state] = positions
+        return positions
+
+    def matches(self, host: str) -> bool:
+        """Whether the pattern produces ``host`` (ignoring case), without listing what it produces."""
+        text = host.lower()
+        return len(text) in self.ends(text, 0, {})
+
+    def __iter__(self):
+        for host in self.strings():
+            yield host, _key(host)
+
+
+class _Folder:
+    """Hosts of a dashboard folder; filled in by :meth:`HostExpr.resolve`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.parts = [p.strip() for p in path.split("/") if p.strip()]
+        self.hosts: list[str] | None = None
+
+    def size(self) -> int:
+        return len(self.hosts) if self.hosts is not None else 0
+
+    def __iter__(self):
+        if self.hosts is None:
+            raise HostExprError(f"folder @{self.path} was not resolved")
+        for host in self.hosts:
+            yield host, _key(host)
+
+
+# ─── Parsing ───────────────────────────────────────────────────────────────────
+
+def _split_terms(text: str) -> list[tuple[int, str]]:
+    """Split on separators outside brackets, braces and quotes; returns (offset, term)."""
+    terms: list[tuple[int, str]] = []
+    depth: list[str] = []
+    quote = ""
+    start = None
+    current: list[str] = []
+    for i, ch in enumerate(text):
+        if quote:
+            if ch == quote:
+                quote = ""
+            else:
+                current.append(ch)
+            continue
+        if ch in _SEPARATORS and not depth:
+            if start is not None:
+                terms.append((start, "".join(current)))
+                start, current = None, []
+            continue
+        if start is None:
+            start = i
+        if ch in "\"'":
+            quote = ch
+            continue
+        if ch in "[{":
+            depth.append("]" if ch == "[" else "}")
+        elif ch in "]}":
+            if not depth or depth.pop() != ch:
+                raise HostExprError(f"unexpected '{ch}' at position {i + 1}")
+        current.append(ch)
+    if quote:
+        raise HostExprError(f"unterminated quote in '{text[start:]}'")
+    if depth:
+        raise HostExprError(f"missing '{depth[-1]}' in '{text[start:]}'")
+    if start is not None:
+        terms.append((start, "".join(current)))
+    return terms
+
+
+def _parse_ranges(body: str, term: str) -> list[tuple[int, int, int]]:
+    ranges = []
+    for item in body.split(","):
+        item = item.strip()
+        low, sep, high = item.partition("-")
+        if not low.isdigit() or (sep and not high.isdigit()) or len(low) > MAX_PATTERN_WIDTH \
+                or len(high) > MAX_PATTERN_WIDTH:
+            raise HostExprError(f"bad range '[{body}]' in '{term}'")
+        start, end = int(low), int(high) if sep else int(low)
+        if end < start:
+            raise HostExprError(f"range [{item}] runs backwards in '{term}'")
+        # Leading zero on the low end: pad every value to its width (web[01-64])
+        width = len(low) if len(low) > 1 and low[0] == "0" else 0
+        ranges.append((start, end, width))
+    return ranges
+
+
+def _parse_pattern(text: str, term: str) -> _Pattern:
+    parts: list = []
+    literal: list[str] = []
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if ch not in "[{":
+            literal.append(ch)
+            i += 1
+            continue
+        if literal:
+            parts.append("".join(literal))
+            literal = []
+        # Find the matching close at this nesting level
+        depth, j = 0, i
+        while j < len(text):
+            if text[j] in "[{":
+                depth += 1
+            elif text[j] in "]}":
+                depth -= 1
+                if depth == 0:
+                    break
+            j += 1
+        body = text[i + 1:j]
+        if ch == "[":
+            parts.append(_parse_ranges(body, term))
+        else:
+            alternatives, level, begin = [], 0, 0
+            for k, c in enumerate(body + ","):
+                if c in "[{":
+                    level += 1
+                elif c in "]}":
+                    level -= 1
+                elif c == "," and level == 0:
+                    alternatives.append(_parse_pattern(body[begin:k].strip(), term))
+                    begin = k + 1
+            parts.append(alternatives)
+        i = j + 1
+    if literal:
+        parts.append("".join(literal))
+    return _Pattern(parts)
+
+
+def _parse_term(term: str):
+    if term.startswith("@"):
+        path = term[1:].strip()
+        if not path:
+            raise HostExprError("empty folder reference '@'")
+        return _Folder(path)
+    if "[" in term or "{" in term:
+        return _parse_pattern(term, term)
+    m = _OCTET_RANGE.match(term)
+    if m:
+        base, low, high = m.group(1), int(m.group(2)), int(m.group(3))
+        first = _ipv4_key(f"{base}.{low}")
+        if first is None or high > 255 or high < low:
+            raise HostExprError(f"bad address range '{term}'")
+        return _IPv4Range(first, first + high - low)
+    m = _ADDRESS_RANGE.match(term)
+    if m:
+        first, last = _ipv4_key(m.group(1)), _ipv4_key(m.group(2))
+        if first is None or last is None or last < first:
+            raise HostExprError(f"bad address range '{term}'")
+        return _IPv4Range(first, last)
+    if "/" in term:
+        try:
+            network = ipaddress.ip_network(term, strict=False)
+        except ValueError:
+            raise HostExprError(f"bad network '{term}'") from None
+        first, last = int(network.network_address), int(network.broadcast_address)
+        if network.num_addresses > 2 and network.version == 4:
+            # Skip the network and broadcast addresses, as ip_network().hosts() does
+            first, last = first + 1, last - 1
+        elif network.num_addresses > 2:
+            first += 1     # IPv6: the subnet-router anycast address
+        return _IPv4Range(first, last) if network.version == 4 else _IPv6Range(first, last)
+    return _Literal(term)
+
+
+class HostExpr:
+    """A parsed expression: include terms, exclude terms, and the folders they name."""
+
+    def __init__(self, include: list, exclude: list):
+        self.include = include
+        self.exclude = exclude
+        self.seen: SeenSet | None = None
+        self._v4_ranges: list[tuple[int, int]] = []
+        self._v6_ranges: list[tuple[int, int]] = []
+        self._excluded: set | None = None
+        self._excluded_patterns: list[_Pattern] = []
+
+    @property
+    def folders(self) -> list[_Folder]:
+        return [t for t in self.include + self.exclude if isinstance(t, _Folder)]
+
+    def estimate(self) -> int:
+        """Upper bound of the host count; exact when nothing repeats or is excluded."""
+        return sum(term.size() for term in self.include)
+
+    def largest_exclusion(self) -> int:
+        """Size of the largest excluded pattern, which is matched against every host."""
+        return max((term.size() for term in self.exclude if isinstance(term, _Pattern)), default=0)
+
+    async def resolve(self, user: dict) -> None:
+        """Fill in ``@folder`` terms from ``user``'s dashboard hosts."""
+        folders = self.folders
+        if not folders:
+            return
+        rows = await db.fetchall("SELECT host, folder FROM hosts WHERE user_id = ? ORDER BY id", (user["id"],))
+        entries = []
+        for row in rows:
+            # Same path rules as the dashboard tree: trimmed parts, "Ungrouped" for none
+            parts = [p.strip() for p in (row["folder"] or "").split("/") if p.strip()] or ["Ungrouped"]
+            entries.append((parts, row["host"].strip()))
+        for folder in folders:
+            n = len(folder.parts)
+            folder.hosts = [host for parts, host in entries if host and parts[:n] == folder.parts]
+            if not folder.hosts:
+                raise HostExprError(f"no hosts in folder @{folder.path}")
+
+    # ── Exclusions ───────────────────────────────────────────────────────────
+    def _build_exclusions(self) -> None:
+        """Ranges stay ranges (bisect lookup) and patterns stay patterns (matched per host).
+
+        Only literals and folders, whose size is already bounded, become a key set.
+        ``!db[0000000-9999999]`` must not build ten million names.
+        """
+        v4, v6, keys, patterns = [], [], set(), []
+        for term in self.exclude:
+            if isinstance(term, _IPv4Range):
+                v4.append((term.first, term.last))
+            elif isinstance(term, _IPv6Range):
+                v6.append((term.first, term.last))
+            elif isinstance(term, _Pattern):
+                patterns.append(term)
+            else:
+                keys.update(key for _, key in term)
+        self._v4_ranges = _merge(v4)
+        self._v6_ranges = _merge(v6)
+        self._excluded = keys
+        self._excluded_patterns = patterns
+
+    def _is_excluded(self, host: str, key) -> bool:
+        if key in self._excluded:
+            return True
+        if type(key) is int and _in_ranges(self._v4_ranges, key):
+            return True
+        if type(key) is tuple and _in_ranges(self._v6_ranges, key[1]):
+            return True
+        return any(p.matches(host) for p in self._excluded_patterns)
+
+    # ── Iteration ────────────────────────────────────────────────────────────
+    def __iter__(self) -> Iterator[str]:
+        self._build_exclusions()
+        seen = self.seen = SeenSet()
+        check = bool(self._excluded or self._v4_ranges or self._v6_ranges or self._excluded_patterns)
+        for term in self.include:
+            for host, key in term:
+                if check and self._is_excluded(host, key):
+                    continue
+                if seen.add(key):
+                    yield host
+
+    async def stream(self, every: int = 512) -> AsyncIterator[str]:
+        """:meth:`__iter__` for async consumers, yielding to the loop every ``every`` hosts."""
+        for i, host in enumerate(self, 1):
+            yield host
+            if i % every == 0:
+                await asyncio.sleep(0)
+
+
+def _merge(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged: list[tuple[int, int]] = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def _in_ranges(ranges: list[tuple[int, int]], value: int) -> bool:
+    if not ranges:
+        return False
+    i = bisect.bisect_right(ranges, (value, float("inf"))) - 1
+    return i >= 0 and ranges[i][0] <= value <= ranges[i][1]
+
+
+def parse(text: str) -> HostExpr:
+    """Parse ``text``; raises :class:`HostExprError` on a malformed term."""
+    include, exclude = [], []
+    for _, term in _split_terms(text or ""):
+        negate = term.startswith("!")
+        if negate:
+            term = term[1:]
+            if not term:
+                raise HostExprError("'!' must be followed by the hosts to exclude")
+        (exclude if negate else include).append(_parse_term(term))
+    return HostExpr(include, exclude)
@@ -0,0 +1,394 @@
+# host_status.py
+"""Background reachability checks for every host in the portal.
+
+One worker process, the *leader*, probes hosts. It is the worker that holds
+an exclusive ``flock`` on ``<DB_PATH>.host-status.lock``. If it dies, another
+worker takes the lock within ``SYNC_INTERVAL`` seconds. Each round:
+
+* reloads the distinct host addresses from ``hosts``;
+* spreads their checks evenly over ``HOST_STATUS_INTERVAL`` seconds rather
+  than probing them all at once;
+* runs at most ``HOST_STATUS_CONCURRENCY`` checks at a time.
+
+A check is a plain TCP connect to port 22 (see :func:`tcp_probe.connect_time`)
+with a ``HOST_STATUS_TIMEOUT_MS`` timeout. Results go into an in-memory table
+of host → :class:`HostState` (online, connect latency, last seen, last
+checked). The table is written to SQLite in batches every ``FLUSH_INTERVAL``
+seconds, together with the online/total counters in ``host_status_state``.
+The other workers mirror it from there. They check ``PRAGMA data_version``
+and read only the rows checked since their last sync.
+
+Requests never probe. ``/api/host_status/info`` returns a pre-rendered
+summary with an ETag, rebuilt only when a batch lands. ``/api/host_status``
+looks hosts up in the table. Each batch also records hosts that went up or
+down, and changed counts, in :mod:`change_feed`, which pushes them to open
+pages. Start and stop set a flag in
+``host_status_state`` that the leader follows, so they work from any worker.
+Set ``HOST_STATUS_AUTOSTART=0`` to keep the checker stopped until an admin
+starts it.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from datetime import datetime
+
+import change_feed
+import db
+import tcp_probe
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.host_status")
+
+
+CHECK_INTERVAL = max(5, env_int("HOST_STATUS_INTERVAL", 60))
+MAX_CONCURRENT = max(1, env_int("HOST_STATUS_CONCURRENCY", 32))
+TIMEOUT_MS = max(100, env_int("HOST_STATUS_TIMEOUT_MS", 2000))
+AUTOSTART = env_int("HOST_STATUS_AUTOSTART", 1) != 0
+PORT = 22
+FLUSH_INTERVAL = 1.0    # leader: seconds between batched writes
+SYNC_INTERVAL = 2.0     # every worker: seconds between state / leadership checks
+
+LOCK_PATH = db.DB_PATH + ".host-status.lock"
+
+
+class HostState:
+    __slots__ = ("online", "latency_ms", "last_seen", "checked", "error")
+
+    def __init__(self, online: bool, latency_ms: float | None, last_seen: float | None,
+                 checked: float, error: str | None):
+        self.online = online
+        self.latency_ms = latency_ms
+        self.last_seen = last_seen
+        self.checked = checked
+        self.error = error
+
+
+def _phase(host: str) -> int:
+    """Stable slot order: a host keeps its place in the round as others come and go."""
+    return zlib.crc32(host.encode())
+
+
+class HostStatusManager:
+    """Leader-elected prober and the per-worker table it fills."""
+
+    def __init__(self, *, check_interval: int = CHECK_INTERVAL, max_concurrent: int = MAX_CONCURRENT,
+                 timeout_ms: int = TIMEOUT_MS, port: int = PORT):
+        self.check_interval = check_interval
+        self.max_concurrent = max_concurrent
+        self.probe_timeout = timeout_ms / 1000
+        self.port = port
+        self.table: dict[str, HostState] = {}
+        self.enabled = AUTOSTART
+        self.online = 0
+        self.last_update: float | None = None
+        self.last_round_seconds: float | None = None
+        self.leader = False
+        self.rounds = 0
+        self.checks = 0
+        self.late_checks = 0          # started after their slot because all slots were busy
+        self.info_requests = 0
+        self.not_modified = 0
+        self._lock_fd: int | None = None
+        self._supervisor: asyncio.Task | None = None
+        self._scheduler: asyncio.Task | None = None
+        self._flusher: asyncio.Task | None = None
+        self._checks: set[asyncio.Task] = set()
+        self._dirty: dict[str, HostState] = {}
+        self._flips: dict[str, HostState] = {}     # went up or down since the last flush
+        self._announced: tuple | None = None       # (running, total, online) last pushed
+        self._removed: set[str] = set()
+        self._watch: sqlite3.Connection | None = None
+        self._data_version: int | None = None
+        self._synced_to = 0.0
+        self._info_body = b""
+        self._info_etag = ""
+        self._render()
+
+    @property
+    def is_running(self) -> bool:
+        return self.enabled
+
+    # ── Lifecycle ────────────────────────────────────────────────────────────
+    async def attach(self) -> None:
+        """Start this worker's supervisor (called at app startup)."""
+        def init(conn: sqlite3.Connection):
+            conn.execute("INSERT OR IGNORE INTO host_status_state (id, enabled) VALUES (1, ?)", (int(AUTOSTART),))
+        await db.run(init)
+        if self._supervisor is None or self._supervisor.done():
+            self._supervisor = asyncio.create_task(self._supervise())
+
+    async def detach(self) -> None:
+        for task in (self._supervisor, self._scheduler, self._flusher):
+            if task is not None:
+                task.cancel()
+        if self.leader:
+            await self._flush()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)     # releases the flock for the next leader
+            self._lock_fd = None
+            self.leader = False
+
+    async def set_enabled(self, enabled: bool) -> None:
+        """Start or stop the checker for every worker."""
+        self.enabled = enabled
+        summary = self.summary()
+
+        def write(conn: sqlite3.Connection):
+            conn.execute("UPDATE host_status_state SET enabled = ? WHERE id = 1", (int(enabled),))
+            change_feed.record(conn, "summary", summary)
+        await db.run(write)
+        self._apply()
+        self._render()
+
+    async def _supervise(self) -> None:
+        while True:
+            try:
+                if not self.leader and self._take_lock():
+                    logger.info("Host status: worker %d is the prober", os.getpid())
+                    self.leader = True
+                    await self._load(full=True)
+                    self._flusher = asyncio.create_task(self._flush_loop())
+                elif not self.leader:
+                    await self._load(full=False)
+                else:
+                    row = await db.fetchone("SELECT enabled FROM host_status_state WHERE id = 1")
+                    self.enabled = bool(row and row["enabled"])
+                self._apply()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Host status supervisor error: %s", e)
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    def _take_lock(self) -> bool:
+        fd = os.open(LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _apply(self) -> None:
+        """Run the scheduler in the leader while enabled, and only then."""
+        running = self._scheduler is not None and not self._scheduler.done()
+        if self.leader and self.enabled and not running:
+            self._scheduler = asyncio.create_task(self._schedule())
+        elif running and not (self.leader and self.enabled):
+            self._scheduler.cancel()
+            for task in list(self._checks):
+                task.cancel()
+
+    # ── Probing (leader) ─────────────────────────────────────────────────────
+    async def _targets(self) -> list[str]:
+        rows = await db.fetchall("SELECT DISTINCT host FROM hosts")
+        hosts = [r["host"].strip() for r in rows if r["host"] and r["host"].strip()]
+        return sorted(set(hosts), key=_phase)
+
+    async def _schedule(self) -> None:
+        slots = asyncio.Semaphore(self.max_concurrent)
+        while True:
+            started = time.monotonic()
+            hosts = await self._targets()
+            current = set(hosts)
+            for host in [h for h in self.table if h not in current]:
+                self._forget(host)
+            spacing = self.check_interval / len(hosts) if hosts else 0
+            for i, host in enumerate(hosts):
+                slot = started + i * spacing
+                delay = slot - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await slots.acquire()
+                if time.monotonic() - slot > max(spacing, 1.0):
+                    self.late_checks += 1
+                task = asyncio.create_task(self._check(host, slots))
+                self._checks.add(task)
+                task.add_done_callback(self._checks.discard)
+            if self._checks:
+                await asyncio.wait(set(self._checks))
+            self.rounds += 1
+            self.last_round_seconds = round(time.monotonic() - started, 2)
+            rest = started + self.check_interval - time.monotonic()
+            if rest > 0:
+                await asyncio.sleep(rest)
+
+    async def _check(self, host: str, slots: asyncio.Semaphore) -> None:
+        try:
+            latency, error = await tcp_probe.connect_time(host, self.port, self.probe_timeout)
+        finally:
+            slots.release()
+        self.checks += 1
+        now = time.time()
+        previous = self.table.get(host)
+        online = error is None
+        state = HostState(online, round(latency * 1000, 1) if online else None,
+                          now if online else (previous.last_seen if previous else None), now, error)
+        self._put(host, state)
+        self._dirty[host] = state
+        if previous is None or previous.online != online:
+            self._flips[host] = state
+        # Fresh results also spare MultiExec a probe of its own in this worker
+        tcp_probe.prober.remember(host, online, error, self.port)
+
+    def _put(self, host: str, state: HostState) -> None:
+        previous = self.table.get(host)
+        if previous is not None and previous.online:
+            self.online -= 1
+        if state.online:
+            self.online += 1
+        self.table[host] = state
+
+    def _forget(self, host: str) -> None:
+        previous = self.table.pop(host, None)
+        if previous is not None and previous.online:
+            self.online -= 1
+        self._dirty.pop(host, None)
+        self._flips.pop(host, None)
+        self._removed.add(host)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self._flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Host status flush failed: %s", e)
+
+    async def _flush(self) -> None:
+        if not self._dirty and not self._removed:
+            return
+        dirty, self._dirty = self._dirty, {}
+        removed, self._removed = self._removed, set()
+        flips, self._flips = self._flips, {}
+        now = time.time()
+        total, online, round_seconds = len(self.table), self.online, self.last_round_seconds
+        counts = (self.is_running, total, online)
+        summary = None
+        if counts != self._announced:
+            summary = {**self.summary(), "last_update": datetime.fromtimestamp(now).isoformat()}
+
+        def write(conn: sqlite3.Connection):
+            conn.executemany(
+                "INSERT INTO host_status (host, online, latency_ms, last_seen, checked, error) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(host) DO UPDATE SET online = excluded.online, "
+                "latency_ms = excluded.latency_ms, last_seen = excluded.last_seen, "
+                "checked = excluded.checked, error = excluded.error",
+                [(h, int(s.online), s.latency_ms, s.last_seen, s.checked, s.error) for h, s in dirty.items()],
+            )
+            conn.executemany("DELETE FROM host_status WHERE host = ?", [(h,) for h in removed])
+            conn.execute(
+                "UPDATE host_status_state SET total_hosts = ?, online_hosts = ?, last_update = ?, "
+                "round_seconds = ?, leader_pid = ? WHERE id = 1",
+                (total, online, now, round_seconds, os.getpid()),
+            )
+            for h, st in flips.items():
+                change_feed.record(conn, "status", {"host": h, "online": st.online, "latency_ms": st.latency_ms,
+                                                    "last_seen": st.last_seen, "error": st.error})
+            if summary is not None:
+                change_feed.record(conn, "summary", summary)
+        await db.run(write)
+        self._announced = counts
+        self.last_update = now
+        self._render()
+
+    # ── Mirroring (all workers) ──────────────────────────────────────────────
+    def _changed(self) -> bool:
+        if self._watch is None:
+            self._watch = db.get_db()
+        version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._data_version:
+            return False
+        self._data_version = version
+        return True
+
+    async def _load(self, full: bool) -> None:
+        """Bring the table in line with SQLite: everything, or rows checked since the last sync."""
+        if not full and not self._changed():
+            return
+        state = await db.fetchone("SELECT * FROM host_status_state WHERE id = 1")
+        if state is None:
+            return
+        self.enabled = bool(state["enabled"])
+        # Deletions leave no rows to read; a count mismatch means a full reload
+        full = full or state["total_hosts"] < len(self.table)
+        since = 0.0 if full else self._synced_to
+        rows = await db.fetchall("SELECT * FROM host_status WHERE checked >= ? ORDER BY checked", (since,))
+        if full:
+            self.table.clear()
+            self.online = 0
+        for r in rows:
+            self._put(r["host"], HostState(bool(r["online"]), r["latency_ms"], r["last_seen"],
+                                           r["checked"], r["error"]))
+            self._synced_to = r["checked"]
+        if not full and len(self.table) != state["total_hosts"]:
+            return await self._load(full=True)
+        self.last_update = state["last_update"]
+        self.last_round_seconds = state["round_seconds"]
+        self._render()
+
+    # ── Reading ──────────────────────────────────────────────────────────────
+    def summary(self) -> dict:
+        return {
+            "is_running": self.is_running,
+            "total_hosts": len(self.table),
+            "online_hosts": self.online,
+            "offline_hosts": len(self.table) - self.online,
+            "last_update": datetime.fromtimestamp(self.last_update).isoformat() if self.last_update else None,
+            "check_interval": self.check_interval,
+            "last_round_seconds": self.last_round_seconds,
+        }
+
+    def _render(self) -> None:
+        body = json.dumps(self.summary()).encode()
+        if body != self._info_body:
+            self._info_body = body
+            self._info_etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+
+    def info(self) -> tuple[bytes, str]:
+        """Pre-rendered summary JSON and its ETag."""
+        return self._info_body, self._info_etag
+
+    def cache_info(self) -> dict:
+        """Summary for the admin page."""
+        return {
+            "is_running": self.is_running,
+            "total_hosts": len(self.table),
+            "online_hosts": self.online,
+            "last_update": datetime.fromtimestamp(self.last_update) if self.last_update else None,
+        }
+
+    def get(self, host: str) -> HostState | None:
+        return self.table.get(host.strip())
+
+    def stats(self) -> dict:
+        return {
+            "leader": self.leader,
+            "pid": os.getpid(),
+            "enabled": self.enabled,
+            "check_interval": self.check_interval,
+            "max_concurrent": self.max_concurrent,
+            "timeout_ms": round(self.probe_timeout * 1000),
+            "hosts": len(self.table),
+            "online": self.online,
+            "rounds": self.rounds,
+            "checks": self.checks,
+            "late_checks": self.late_checks,
+            "in_flight": len(self._checks),
+            "last_round_seconds": self.last_round_seconds,
+            "info_requests": self.info_requests,
+            "not_modified": self.not_modified,
+        }
+
+
+manager = HostStatusManager()
@@ -1,4 +1,6 @@
 import db
+import exec_jobs
+import host_status
 import os
 import secrets
 from fastapi import FastAPI, Request, Depends, HTTPException
@@ -15,6 +17,11 @@ from routers.range_gen     import router as range_gen_router
 from routers.shutdown      import router as shutdown_router
 from routers.file_uploader import router as file_uploader
 from routers.sftp_token    import router as sftp_token_router
+from routers.metrics       import router as metrics_router
+from routers.recordings    import router as recordings_router
+from routers.host_status   import router as host_status_router
+from routers.events        import router as events_router
+from routers.output        import router as output_router
 
 app = FastAPI()
 
@@ -33,6 +40,17 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 db.init_db()
+exec_jobs.recover()
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    await host_status.manager.attach()
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await host_status.manager.detach()
 
 # Root → Login
 @app.get("/", include_in_schema=False)
@@ -60,27 +78,16 @@ async def config_js():
 
 @app.get("/api/host_status")
 async def get_host_status(request: Request):
+    """"online", "offline" or "unknown" per host id, from the background checker's table."""
     user = get_current_user(request)
     if not user:
         raise HTTPException(status_code=401)
-    
-    # Implement your host status checking logic here
-    # Example: ping hosts or check last connection time
+
+    hosts = await db.fetchall("SELECT id, host FROM hosts WHERE user_id = ?", (user["id"],))
     status_data = {}
-    
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, host FROM hosts WHERE user_id = ?", (user["id"],))
-    hosts = cursor.fetchall()
-    
     for host in hosts:
-        # Simple ping check (you can make this more sophisticated)
-        try:
-            # Example status check - replace with your preferred method
-            status_data[host["id"]] = "online"  # or "offline"
-        except:
-            status_data[host["id"]] = "offline"
-    
+        state = host_status.manager.get(host["host"])
+        status_data[host["id"]] = "unknown" if state is None else ("online" if state.online else "offline")
     return status_data
 
 # Debug endpoint to check session status
@@ -105,4 +112,9 @@ app.include_router(script_exec_router)
 app.include_router(range_gen_router)
 app.include_router(shutdown_router)
 app.include_router(file_uploader)
-app.include_router(sftp_token_router)
\ No newline at end of file
+app.include_router(sftp_token_router)
+app.include_router(metrics_router)
+app.include_router(recordings_router)
+app.include_router(host_status_router)
+app.include_router(events_router)
+app.include_router(output_router)
\ No newline at end of file
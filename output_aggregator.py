@@ -0,0 +1,132 @@
+# output_aggregator.py
+"""Batch per-host command output into a few WebSocket frames per second.
+
+:class:`OutputAggregator` collects output from every host in a job and sends
+one ``output_batch`` frame when either of these happens first:
+
+* ``interval`` seconds have passed since the first unsent byte.
+* ``max_bytes`` of output are pending.
+
+A frame holds one chunk per host and stream with output since the last frame,
+in first-seen order. Output is not split at line boundaries, so a partial
+line reaches the browser on the next tick. When the socket cannot keep up,
+writers block once ``max_pending`` is buffered. That pushes back on the SSH
+channels instead of growing memory.
+"""
+
+import asyncio
+
+FLUSH_INTERVAL = 0.075          # seconds from the first pending byte to the frame
+FLUSH_BYTES = 64 * 1024         # send early once this much is pending
+PENDING_BYTES = 4 * 1024 * 1024  # writers wait above this (socket is behind)
+
+
+class OutputAggregator:
+    """Collects ``(host, stream, text)`` writes and sends them as batched frames.
+
+    ``send`` is an async callable that takes the frame dict. Sizes are counted
+    in characters of decoded text.
+    """
+
+    def __init__(self, send, *, interval: float = FLUSH_INTERVAL, max_bytes: int = FLUSH_BYTES,
+                 max_pending: int = PENDING_BYTES):
+        self._send = send
+        self.interval = interval
+        self.max_bytes = max(1, max_bytes)
+        self.max_pending = max(self.max_bytes, max_pending)
+        self._pending: dict[tuple[str, str], list[str]] = {}
+        self._pending_bytes = 0
+        self._has_data = asyncio.Event()   # something is waiting for the next frame
+        self._full = asyncio.Event()       # max_bytes reached: do not wait for the tick
+        self._drained = asyncio.Event()    # the last frame went out
+        self._drained.set()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+        self.frames = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.max_frame_bytes = 0
+        self.timer_flushes = 0
+        self.size_flushes = 0
+        self.writer_waits = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def write(self, host: str, stream: str, data: str) -> None:
+        if not data:
+            return
+        key = (host, stream)
+        parts = self._pending.get(key)
+        if parts is None:
+            self._pending[key] = [data]
+        else:
+            parts.append(data)
+        self._pending_bytes += len(data)
+        self._has_data.set()
+        if self._pending_bytes >= self.max_bytes:
+            self._full.set()
+        if self._pending_bytes >= self.max_pending:
+            self.writer_waits += 1
+            while self._pending_bytes >= self.max_pending:
+                self._drained.clear()
+                await self._drained.wait()
+
+    async def _run(self) -> None:
+        while not self._closed:
+            await self._has_data.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+                if not self._closed:
+                    self.size_flushes += 1
+            except asyncio.TimeoutError:
+                self.timer_flushes += 1
+            await self._flush()
+
+    async def flush(self) -> None:
+        """Send what is pending now, so that an event sent next cannot overtake it."""
+        await self._flush()
+
+    async def _flush(self) -> None:
+        self._has_data.clear()
+        self._full.clear()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        size, self._pending_bytes = self._pending_bytes, 0
+        chunks = [
+            {"host": host, "stream": stream, "data": "".join(parts)}
+            for (host, stream), parts in pending.items()
+        ]
+        self.frames += 1
+        self.chunks += len(chunks)
+        self.bytes += size
+        self.max_frame_bytes = max(self.max_frame_bytes, size)
+        try:
+            await self._send({"type": "output_batch", "chunks": chunks})
+        finally:
+            self._drained.set()
+
+    async def close(self) -> None:
+        """Stop the timer and send whatever is still pending."""
+        self._closed = True
+        if self._task is not None:
+            # Wake the loop rather than cancel it, so a frame being sent is not lost
+            self._has_data.set()
+            self._full.set()
+            await self._task
+            self._task = None
+        await self._flush()
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "chunks_per_frame": round(self.chunks / self.frames, 1) if self.frames else 0.0,
+            "max_frame_bytes": self.max_frame_bytes,
+            "timer_flushes": self.timer_flushes,
+            "size_flushes": self.size_flushes,
+            "writer_waits": self.writer_waits,
+        }
@@ -0,0 +1,197 @@
+# output_clusters.py
+"""Group hosts whose command produced identical results.
+
+On a typical fleet run (``cat /etc/os-release``, ``rpm -q openssl``) almost
+every host prints the same bytes. In clustering mode, MultiExec does not
+stream each host's output. It captures the output while the command runs and
+fingerprints the finished result: SHA-256 of stdout and of stderr, plus the
+exit status or connection error. Hosts with equal fingerprints form a
+cluster. A cluster's output is sent once, when its first host finishes.
+Later hosts only add their name to it.
+
+The client gets ``clusters`` frames, at most one per ``interval``. Each frame
+carries the clusters created since the last one (with their output) and the
+hosts that joined existing clusters. A cluster of one host is an outlier.
+Captured text is kept up to ``max_output`` characters per stream, but the
+fingerprint always covers the full output, so truncation never merges two
+different results.
+"""
+
+import asyncio
+import hashlib
+
+FLUSH_INTERVAL = 0.25
+MAX_OUTPUT = 1024 * 1024  # characters kept per stream of a cluster's first host
+
+
+class _Capture:
+    """Output of one host while its command runs."""
+
+    __slots__ = ("parts", "hashes", "sizes", "truncated", "max_output")
+
+    def __init__(self, max_output: int):
+        self.parts = {"stdout": [], "stderr": []}
+        self.hashes = {"stdout": hashlib.sha256(), "stderr": hashlib.sha256()}
+        self.sizes = {"stdout": 0, "stderr": 0}
+        self.truncated = False
+        self.max_output = max_output
+
+    def write(self, stream: str, data: str) -> None:
+        if not data:
+            return
+        self.hashes[stream].update(data.encode("utf-8", "replace"))
+        room = self.max_output - self.sizes[stream]
+        if room > 0:
+            self.parts[stream].append(data[:room])
+        if len(data) > room:
+            self.truncated = True
+        self.sizes[stream] += len(data)
+
+
+def new_capture(max_output: int = MAX_OUTPUT) -> _Capture:
+    """An empty capture, for code that fingerprints without an :class:`OutputClusters`."""
+    return _Capture(max_output)
+
+
+def digest(capture: _Capture) -> tuple:
+    """``(stdout_sha256, stderr_sha256, stdout_size, stderr_size)`` of a capture."""
+    return (capture.hashes["stdout"].digest(), capture.hashes["stderr"].digest(),
+            capture.sizes["stdout"], capture.sizes["stderr"])
+
+
+class OutputClusters:
+    """Fingerprints finished hosts and streams cluster frames through ``send``."""
+
+    def __init__(self, send, *, interval: float = FLUSH_INTERVAL, max_output: int = MAX_OUTPUT):
+        self._send = send
+        self.interval = interval
+        self.max_output = max_output
+        self._by_key: dict[tuple, dict] = {}
+        self.clusters: list[dict] = []
+        self._new: dict[int, dict] = {}
+        self._joined: dict[int, list[str]] = {}
+        self._dirty = asyncio.Event()
+        self._closed = False
+        self._task: asyncio.Task | None = None
+        self.hosts = 0
+        self.output_bytes = 0       # characters produced across all hosts
+        self.sent_bytes = 0         # characters of output actually sent
+        self.frames = 0
+
+    def capture(self) -> _Capture:
+        return new_capture(self.max_output)
+
+    def finish(self, host: str, capture: _Capture | None, *, exit_status: int | None = None,
+               ok: bool = False, error: str | None = None) -> int:
+        """File ``host``'s result into its cluster; returns the cluster id."""
+        capture = capture or self.capture()
+        return self.finish_digest(
+            host, digest(capture), texts=(
+                "".join(capture.parts["stdout"]), "".join(capture.parts["stderr"]), capture.truncated,
+            ), exit_status=exit_status, ok=ok, error=error,
+        )
+
+    def finish_digest(self, host: str, fingerprint: tuple, texts: tuple | None = None, *,
+                      exit_status: int | None = None, ok: bool = False, error: str | None = None) -> int:
+        """Like :meth:`finish` for a result fingerprinted elsewhere (a shard process).
+
+        ``fingerprint`` is ``(stdout_sha256, stderr_sha256, stdout_size,
+        stderr_size)`` from :func:`digest`. ``texts`` is
+        ``(stdout, stderr, truncated)``. It may be None when the sender
+        already sent this result's text.
+        """
+        key = (fingerprint[0], fingerprint[1], exit_status, ok, error)
+        self.hosts += 1
+        self.output_bytes += fingerprint[2] + fingerprint[3]
+        cluster = self._by_key.get(key)
+        if cluster is None:
+            stdout, stderr, truncated = texts or ("", "", False)
+            cluster = {
+                "id": len(self.clusters),
+                "ok": ok,
+                "exit_status": exit_status,
+                "error": error,
+                "stdout": stdout,
+                "stderr": stderr,
+                "stdout_bytes": fingerprint[2],
+                "stderr_bytes": fingerprint[3],
+                "truncated": truncated,
+                "fingerprint": key[0].hex()[:12] + key[1].hex()[:12],
+                "hosts": [host],
+            }
+            self._by_key[key] = cluster
+            self.clusters.append(cluster)
+            self._new[cluster["id"]] = cluster
+            self.sent_bytes += len(stdout) + len(stderr)
+        else:
+            cluster["hosts"].append(host)
+            if cluster["id"] not in self._new:
+                self._joined.setdefault(cluster["id"], []).append(host)
+        self._dirty.set()
+        return cluster["id"]
+
+    # ── Frames ───────────────────────────────────────────────────────────────
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while not self._closed:
+            await self._dirty.wait()
+            if not self._closed:
+                await asyncio.sleep(self.interval)
+            await self._flush()
+
+    async def _flush(self) -> None:
+        self._dirty.clear()
+        if not self._new and not self._joined:
+            return
+        new, self._new = self._new, {}
+        joined, self._joined = self._joined, {}
+        self.frames += 1
+        await self._send({
+            "type": "clusters",
+            # hosts is a snapshot: later joins arrive under "joined"
+            "new": [dict(c, hosts=list(c["hosts"])) for c in new.values()],
+            "joined": {str(cid): hosts for cid, hosts in joined.items()},
+            "finished": self.hosts,
+        })
+
+    async def close(self) -> None:
+        """Stop the timer and send whatever is still pending."""
+        self._closed = True
+        if self._task is not None:
+            self._dirty.set()
+            await self._task
+            self._task = None
+        await self._flush()
+
+    # ── Summary ──────────────────────────────────────────────────────────────
+    def summary(self) -> list[dict]:
+        """Clusters largest first, without their output text."""
+        ordered = sorted(self.clusters, key=lambda c: (-len(c["hosts"]), c["id"]))
+        return [
+            {
+                "id": c["id"],
+                "count": len(c["hosts"]),
+                "ok": c["ok"],
+                "exit_status": c["exit_status"],
+                "error": c["error"],
+                "stdout_bytes": c["stdout_bytes"],
+                "stderr_bytes": c["stderr_bytes"],
+                "fingerprint": c["fingerprint"],
+                "hosts": c["hosts"],
+            }
+            for c in ordered
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "hosts": self.hosts,
+            "clusters": len(self.clusters),
+            "outliers": sum(1 for c in self.clusters if len(c["hosts"]) == 1),
+            "largest": max((len(c["hosts"]) for c in self.clusters), default=0),
+            "output_bytes": self.output_bytes,
+            "sent_bytes": self.sent_bytes,
+            "frames": self.frames,
+        }
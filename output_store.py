@@ -0,0 +1,310 @@
+# output_store.py
+"""Per-host command output with a bounded memory footprint.
+
+An :class:`OutputStore` belongs to one run (a MultiExec job or a ScriptExec
+run). For each host and stream it keeps the first ``OUTPUT_HEAD_BYTES``,
+which is what gets shown live, and the last ``OUTPUT_TAIL_BYTES`` in memory.
+
+The complete stream is written to ``OUTPUT_STORE_DIR/<run>/`` as
+zlib-compressed segments of up to ``SEGMENT_BYTES``, each with a header of
+raw offset, raw length and compressed length. A byte range is read by
+walking the headers and inflating only the segments it overlaps, from any
+worker and while the host is still running.
+
+Run directories are removed ``OUTPUT_RETENTION_HOURS`` after their last
+write (by default ``MULTI_EXEC_JOB_RETENTION_HOURS``), or with their job
+(:func:`remove`). An open run touches its ``owner`` file every
+``TOUCH_INTERVAL`` seconds. Reading checks the owner recorded when the run
+was created.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import struct
+import time
+import zlib
+from urllib.parse import quote, unquote
+
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.output_store")
+
+
+OUTPUT_DIR = os.getenv("OUTPUT_STORE_DIR", "/tmp/ssh_portal_output")
+HEAD_BYTES = max(1024, env_int("OUTPUT_HEAD_BYTES", 16384))
+TAIL_BYTES = max(1024, env_int("OUTPUT_TAIL_BYTES", 16384))
+RETENTION_HOURS = max(1, env_int("OUTPUT_RETENTION_HOURS", env_int("MULTI_EXEC_JOB_RETENTION_HOURS", 168)))
+SEGMENT_BYTES = 64 * 1024       # raw bytes buffered per stream before a segment is written
+COMPRESS_LEVEL = 1              # output is text; level 1 gets most of the ratio at a fraction of the CPU
+SWEEP_INTERVAL = 600            # seconds between retention sweeps
+TOUCH_INTERVAL = 600            # seconds between an open run's owner touches
+READ_LIMIT = 4 * 1048576        # largest range served in one request
+
+STREAMS = ("stdout", "stderr")
+_HEADER = struct.Struct(">QII")   # raw offset, raw length, compressed length
+_last_sweep = 0.0
+
+
+def _file_name(host: str, stream: str) -> str:
+    return f"{quote(host, safe='')}.{stream}.z"
+
+
+def _run_dir(run_id: str) -> str:
+    if not run_id or "/" in run_id or run_id.startswith("."):
+        raise ValueError("bad run id")
+    return os.path.join(OUTPUT_DIR, run_id)
+
+
+class StreamOutput:
+    """One host's stdout or stderr: head and tail in memory, everything on disk."""
+
+    __slots__ = ("path", "head", "tail", "size", "head_full", "_pending", "_lock")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.size = 0
+        self.head_full = False
+        self._pending = bytearray()
+        self._lock = asyncio.Lock()
+
+    async def write(self, text: str) -> str:
+        """Store ``text``; return the part of it that falls within the head."""
+        raw = text.encode("utf-8", "replace")
+        shown = ""
+        if not self.head_full:
+            room = HEAD_BYTES - len(self.head)
+            if len(raw) <= room:
+                shown = text
+                self.head += raw
+            else:
+                # Cut on a character boundary; the head ends here
+                shown = raw[:room].decode("utf-8", "ignore")
+                self.head += shown.encode("utf-8")
+                self.head_full = True
+        self.tail += raw
+        if len(self.tail) > TAIL_BYTES:
+            del self.tail[:len(self.tail) - TAIL_BYTES]
+        self.size += len(raw)
+        self._pending += raw
+        if len(self._pending) >= SEGMENT_BYTES:
+            await self._spill()
+        return shown
+
+    async def _spill(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+            data, self._pending = bytes(self._pending), bytearray()
+            offset = self.size - len(data)
+            await asyncio.to_thread(_append_segment, self.path, offset, data)
+
+    async def close(self) -> None:
+        await self._spill()
+
+    def rest(self) -> tuple[int, str]:
+        """``(omitted_bytes, text)`` after the head: the bytes between head and tail, and the tail."""
+        after_head = self.size - len(self.head)
+        if after_head <= 0:
+            return 0, ""
+        if after_head <= len(self.tail):
+            return 0, bytes(self.tail[-after_head:]).decode("utf-8", "replace")
+        tail = bytes(self.tail)
+        start = 0
+        while start < len(tail) and start < 4 and 0x80 <= tail[start] < 0xC0:
+            start += 1      # starts mid-character
+        return after_head - len(tail) + start, tail[start:].decode("utf-8", "replace")
+
+    def text(self, url: str | None = None) -> str:
+        """Head and tail as one string, with a marker (and ``url``) where bytes were left out."""
+        omitted, rest = self.rest()
+        head = bytes(self.head).decode("utf-8", "replace")
+        if not omitted:
+            return head + rest
+        where = f"; full output: {url}" if url else ""
+        return f"{head}\n[... {omitted} bytes omitted{where} ...]\n{rest}"
+
+
+def _create(directory: str, user_id: int) -> None:
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "owner"), "w") as fh:
+        fh.write(str(user_id))
+    _maybe_sweep()
+
+
+def _append_segment(path: str, offset: int, data: bytes) -> None:
+    packed = zlib.compress(data, COMPRESS_LEVEL)
+    with open(path, "ab") as fh:
+        fh.write(_HEADER.pack(offset, len(data), len(packed)))
+        fh.write(packed)
+
+
+class OutputStore:
+    """All hosts' output of one run."""
+
+    def __init__(self, run_id: str, user_id: int):
+        self.run_id = run_id
+        self.user_id = user_id
+        self.dir = _run_dir(run_id)
+        self._streams: dict[tuple[str, str], StreamOutput] = {}
+        self.bytes = 0          # output of finished hosts
+        self._keepalive: asyncio.Task | None = None
+
+    async def open(self) -> None:
+        """Create the run directory (and sweep old runs) off the event loop; call before writing."""
+        await asyncio.to_thread(_create, self.dir, self.user_id)
+        self._keepalive = asyncio.create_task(self._touch())
+
+    async def _touch(self) -> None:
+        owner_file = os.path.join(self.dir, "owner")
+        while True:
+            await asyncio.sleep(TOUCH_INTERVAL)
+            try:
+                await asyncio.to_thread(os.utime, owner_file)
+            except OSError as e:
+                logger.debug("Could not touch %s: %s", owner_file, e)
+
+    def stream(self, host: str, stream: str) -> StreamOutput:
+        key = (host, stream)
+        out = self._streams.get(key)
+        if out is None:
+            out = self._streams[key] = StreamOutput(os.path.join(self.dir, _file_name(host, stream)))
+        return out
+
+    async def write(self, host: str, stream: str, text: str) -> str:
+        return await self.stream(host, stream).write(text)
+
+    async def finish_host(self, host: str) -> dict[str, StreamOutput]:
+        """Write out the host's last segments and drop it from memory; returns its streams."""
+        done = {}
+        for stream in STREAMS:
+            out = self._streams.pop((host, stream), None)
+            if out is not None:
+                await out.close()
+                self.bytes += out.size
+                done[stream] = out
+        return done
+
+    async def close(self) -> None:
+        for host, _ in list(self._streams):
+            await self.finish_host(host)
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            # Retention counts from the end of the run
+            await asyncio.to_thread(os.utime, os.path.join(self.dir, "owner"))
+
+    def url(self, host: str, stream: str) -> str:
+        return f"/api/output/{self.run_id}/{quote(host, safe='')}/{stream}"
+
+    def stats(self) -> dict:
+        streams = list(self._streams.values())
+        return {
+            "open_streams": len(streams),
+            "bytes": self.bytes + sum(s.size for s in streams),
+            "memory_bytes": sum(len(s.head) + len(s.tail) + len(s._pending) for s in streams),
+        }
+
+
+# ─── Reading (any worker) ─────────────────────────────────────────────────────
+def owner(run_id: str) -> int | None:
+    try:
+        with open(os.path.join(_run_dir(run_id), "owner")) as fh:
+            return int(fh.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _segments(path: str) -> list[tuple[int, int, int, int]]:
+    """``(raw_offset, raw_length, file_offset, compressed_length)`` of each segment."""
+    found = []
+    with open(path, "rb") as fh:
+        position = 0
+        while True:
+            header = fh.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                break
+            offset, length, packed = _HEADER.unpack(header)
+            position += _HEADER.size
+            found.append((offset, length, position, packed))
+            position += packed
+            fh.seek(position)
+    return found
+
+
+def size(run_id: str, host: str, stream: str) -> int | None:
+    path = os.path.join(_run_dir(run_id), _file_name(host, stream))
+    try:
+        segments = _segments(path)
+    except FileNotFoundError:
+        return None
+    return segments[-1][0] + segments[-1][1] if segments else 0
+
+
+def read_range(run_id: str, host: str, stream: str, start: int, end: int | None) -> tuple[bytes, int] | None:
+    """Bytes ``start`` up to (not including) ``end`` of a stream and its stored size; None if unknown.
+
+    Blocking: call it with ``asyncio.to_thread``.
+    """
+    path = os.path.join(_run_dir(run_id), _file_name(host, stream))
+    try:
+        segments = _segments(path)
+    except FileNotFoundError:
+        return None
+    total = segments[-1][0] + segments[-1][1] if segments else 0
+    end = total if end is None else min(end, total)
+    end = min(end, start + READ_LIMIT)
+    if start >= end:
+        return b"", total
+    parts = []
+    with open(path, "rb") as fh:
+        for offset, length, position, packed in segments:
+            if offset + length <= start or offset >= end:
+                continue
+            fh.seek(position)
+            data = zlib.decompress(fh.read(packed))
+            parts.append(data[max(0, start - offset):end - offset])
+    return b"".join(parts), total
+
+
+def listing(run_id: str) -> list[dict]:
+    """Hosts and stored sizes of a run."""
+    directory = _run_dir(run_id)
+    hosts: dict[str, dict] = {}
+    for name in os.listdir(directory):
+        if not name.endswith(".z"):
+            continue
+        quoted, stream, _ = name.rsplit(".", 2)
+        host = unquote(quoted)
+        stored = size(run_id, host, stream)
+        hosts.setdefault(host, {"host": host})[f"{stream}_bytes"] = stored or 0
+    return sorted(hosts.values(), key=lambda h: h["host"])
+
+
+def remove(run_id: str) -> None:
+    """Delete a run's stored output (its job was swept). Blocking."""
+    try:
+        shutil.rmtree(_run_dir(run_id), ignore_errors=True)
+    except ValueError:
+        pass
+
+
+def _maybe_sweep() -> None:
+    global _last_sweep
+    now = time.time()
+    if now - _last_sweep < SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+    cutoff = now - RETENTION_HOURS * 3600
+    try:
+        entries = list(os.scandir(OUTPUT_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir() and os.stat(os.path.join(entry.path, "owner")).st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError as e:
+            logger.debug("Output sweep skipped %s: %s", entry.path, e)
@@ -0,0 +1,42 @@
+# routers/events.py
+"""Server-Sent Events stream of host, host-status and summary changes."""
+
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import StreamingResponse
+
+import change_feed
+
+router = APIRouter()
+
+RETRY_MS = 3000     # EventSource reconnect delay
+
+
+def _resume_token(request: Request) -> int | None:
+    token = request.headers.get("last-event-id") or request.query_params.get("since")
+    try:
+        return max(0, int(token)) if token else None
+    except ValueError:
+        return None
+
+
+@router.get("/api/events")
+async def events(request: Request):
+    """Deltas for the signed-in user; resumes after ``Last-Event-ID`` (or ``?since=``)."""
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401)
+    since = _resume_token(request)
+
+    async def stream():
+        yield f"retry: {RETRY_MS}\n\n"
+        async for event in change_feed.feed.events(user, since):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            seq, kind, data = event
+            yield f"id: {seq}\nevent: {kind}\ndata: {data}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",      # nginx: pass events through unbuffered
+    })
@@ -1,9 +1,11 @@
 from fastapi import APIRouter, Request, Depends, Form, UploadFile, File
 from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 from auth import require_auth
-import json, asyncssh
-from pathlib import Path
+import upload_runner
+import upload_spool
+import json
 import logging
 import asyncio
 
@@ -12,6 +14,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
+HEARTBEAT = 15.0    # seconds between keep-alive comments while transfers are quiet
 templates = Jinja2Templates(directory="templates")
 
 @router.get("/upload", response_class=HTMLResponse)
@@ -19,6 +22,7 @@ def upload_page(request: Request, auth=Depends(require_auth)):
     return templates.TemplateResponse("file_uploader.html", {
         "request": request,
         "default_username": "root",
+        "upload_concurrency": upload_runner.CONCURRENCY,
         "title": "FileUploader"
     })
 
@@ -28,57 +32,52 @@ async def upload_file(
     ssh_pass: str = Form(...),
     hosts: str = Form(...),
     remote_path: str = Form("/tmp/uploads"),
+    probe: bool = Form(True),
+    concurrency: int = Form(upload_runner.CONCURRENCY),
+    max_mb_per_sec: int = Form(0),
     file: UploadFile = File(...),
     auth=Depends(require_auth)
 ):
+    if not isinstance(auth, dict):
+        return auth
     hosts_list = json.loads(hosts)
-    content = await file.read()
-    local_tmp = Path("/tmp/uploads")
-    local_tmp.mkdir(exist_ok=True)
-    path = local_tmp / file.filename
-    path.write_bytes(content)
+    # Chunked to disk and hashed in one pass, so memory stays flat whatever the size
+    artifact = await upload_spool.spool(file)
 
-    logger.info("🚀 Upload initiated")
+    logger.info(f"🚀 Upload initiated: {artifact.path.name}, {artifact.size} bytes, sha256 {artifact.digest[:12]}")
+    try:
+        run = upload_runner.UploadRun(artifact, hosts_list, ssh_user, ssh_pass, remote_path, probe=probe,
+                                      concurrency=concurrency, max_mb_per_sec=max_mb_per_sec)
+    except BaseException:
+        upload_spool.discard(artifact.path)
+        raise
 
     async def event_stream():
         yield "data: 🚀 Upload log started\n\n"
+        task = asyncio.create_task(run.run())
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(run.events.get(), HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    break
+                if event["type"] == "log":
+                    yield f"data: {event['message']}\n\n"
+                else:
+                    # Progress and summary are named events; the log ignores them
+                    yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            await task
+        finally:
+            # The client went away: stop the transfers too
+            task.cancel()
+            upload_spool.discard(artifact.path)
+            await asyncio.gather(task, return_exceptions=True)
 
-        for host in hosts_list:
-            try:
-                msg = f"[{host}] Connecting..."
-                logger.info(msg)
-                yield f"data: {msg}\n\n"
-
-                async with asyncssh.connect(host, username=ssh_user, password=ssh_pass, known_hosts=None) as conn:
-                    clean_path = remote_path.rstrip("/")
-                    mkdir_cmd = f"mkdir -p {clean_path}"
-                    result = await conn.run(mkdir_cmd, check=False)
-                    if result.exit_status == 0:
-                        msg = f"[{host}] 📁 Ensured directory {clean_path} exists"
-                        logger.info(msg)
-                        yield f"data: {msg}\n\n"
-                    else:
-                        msg = f"[{host}] ⚠ Failed to mkdir: {result.stderr}"
-                        logger.warning(msg)
-                        yield f"data: {msg}\n\n"
-
-                    async with conn.start_sftp_client() as sftp:
-                        remote_full = f"{clean_path}/{file.filename}"
-                        await sftp.put(str(path), remote_full)
-                        msg = f"[{host}] ✅ Uploaded to {remote_full}"
-                        logger.info(msg)
-                        yield f"data: {msg}\n\n"
-
-            except Exception as e:
-                msg = f"[{host}] ❌ Upload failed: {e}"
-                logger.error(msg)
-                yield f"data: {msg}\n\n"
-
-            await asyncio.sleep(0.05)  # small delay for smoother streaming
-
-        msg = " 🧭 Upload finished - look for errors if they occured"
-        logger.info(msg)
-        yield f"data: {msg}\n\n"
-        path.unlink()
-
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    # The background task also covers a client that left before the stream started
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",      # nginx: pass events through unbuffered
+    }, background=BackgroundTask(upload_spool.discard, artifact.path))
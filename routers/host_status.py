@@ -0,0 +1,67 @@
+# routers/host_status.py
+"""Host status monitor: admin page, start/stop and the cached summary."""
+
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+from fastapi.templating import Jinja2Templates
+
+import change_feed
+import host_status
+
+router = APIRouter()
+templates = Jinja2Templates(directory="templates")
+
+
+def _require_user(request: Request) -> dict:
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401)
+    return user
+
+
+def _require_admin(request: Request) -> dict:
+    user = _require_user(request)
+    if not user.get("is_admin"):
+        raise HTTPException(status_code=403)
+    return user
+
+
+@router.get("/admin/status", response_class=HTMLResponse)
+async def status_page(request: Request):
+    _require_admin(request)
+    manager = host_status.manager
+    return templates.TemplateResponse("admin_status.html", {
+        "request": request,
+        "title": "Host Status",
+        "cache_info": manager.cache_info(),
+        "status_manager": manager,
+        "change_seq": await change_feed.latest(),
+    })
+
+
+@router.get("/api/host_status/info")
+async def status_info(request: Request):
+    """Summary from the in-memory table; 304 while it has not changed."""
+    _require_user(request)
+    manager = host_status.manager
+    manager.info_requests += 1
+    body, etag = manager.info()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        manager.not_modified += 1
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@router.post("/api/host_status/start")
+async def start_checker(request: Request):
+    _require_admin(request)
+    await host_status.manager.set_enabled(True)
+    return JSONResponse({"message": "Background status checker started"})
+
+
+@router.post("/api/host_status/stop")
+async def stop_checker(request: Request):
+    _require_admin(request)
+    await host_status.manager.set_enabled(False)
+    return JSONResponse({"message": "Background status checker stopped"})
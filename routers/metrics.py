@@ -0,0 +1,89 @@
+# routers/metrics.py
+"""Admin-only runtime metrics for the shared subsystems of this worker."""
+
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse
+
+import artifact_cache
+import change_feed
+import db
+import host_cache
+import host_status
+import sftp_transfer
+import ssh_pool
+import tcp_probe
+import upload_spool
+
+router = APIRouter()
+
+
+def _require_admin(request: Request) -> dict:
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401)
+    if not user.get("is_admin"):
+        raise HTTPException(status_code=403)
+    return user
+
+
+@router.get("/api/metrics/ssh_pool")
+async def ssh_pool_metrics(request: Request):
+    """Hit/miss counters and occupancy of the SSH connection pool."""
+    _require_admin(request)
+    return JSONResponse(ssh_pool.pool.stats())
+
+
+@router.get("/api/metrics/db")
+async def db_metrics(request: Request):
+    """Connection pool occupancy, pool wait and query latency (recent p50/p95, max)."""
+    _require_admin(request)
+    return JSONResponse(db.stats())
+
+
+@router.get("/api/metrics/host_cache")
+async def host_cache_metrics(request: Request):
+    """Hit rate, size and invalidations of this worker's host cache."""
+    _require_admin(request)
+    return JSONResponse(host_cache.cache.stats())
+
+
+@router.get("/api/metrics/tcp_probe")
+async def tcp_probe_metrics(request: Request):
+    """Port-22 pre-check counters and cached results of this worker."""
+    _require_admin(request)
+    return JSONResponse(tcp_probe.prober.stats())
+
+
+@router.get("/api/metrics/host_status")
+async def host_status_metrics(request: Request):
+    """Background checker rounds, checks and info-endpoint cache hits in this worker."""
+    _require_admin(request)
+    return JSONResponse(host_status.manager.stats())
+
+
+@router.get("/api/metrics/change_feed")
+async def change_feed_metrics(request: Request):
+    """Open event streams, delivered changes and resume resets in this worker."""
+    _require_admin(request)
+    return JSONResponse(change_feed.feed.stats())
+
+
+@router.get("/api/metrics/artifact_cache")
+async def artifact_cache_metrics(request: Request):
+    """Remote artifact cache hits, misses and bytes not sent by this worker."""
+    _require_admin(request)
+    return JSONResponse(artifact_cache.stats())
+
+
+@router.get("/api/metrics/upload_spool")
+async def upload_spool_metrics(request: Request):
+    """Uploads being spooled to disk and totals in this worker."""
+    _require_admin(request)
+    return JSONResponse(upload_spool.stats())
+
+
+@router.get("/api/metrics/sftp_transfer")
+async def sftp_transfer_metrics(request: Request):
+    """Outbound upload cap and how long transfers waited for it in this worker."""
+    _require_admin(request)
+    return JSONResponse(sftp_transfer.stats())
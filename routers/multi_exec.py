@@ -2,19 +2,57 @@
 
 Streams per-host stages and output over WebSocket:
  - connecting -> connected -> command_started -> completed (with exit status)
-Aggregates a final summary and enforces bounded concurrency so it can scale
-to 30+ hosts without overwhelming the server/UI.
+Aggregates a final summary. Concurrency is adaptive (see :mod:`adaptive_limit`):
+SSH handshakes and running commands have separate AIMD budgets that grow
+while the fleet stays healthy and back off on timeouts and refusals. The
+limits are streamed to the client as ``concurrency`` frames and included,
+with their history, in the summary. Before a host gets a connect slot, a TCP
+check of port 22 (see :mod:`tcp_probe`) weeds out dead hosts in a few hundred
+milliseconds instead of a 10 s handshake timeout; ``"probe": false`` skips it.
+
+Output from all hosts goes through one :class:`OutputAggregator` per job and
+reaches the client as ``output_batch`` frames, a few per second, each carrying
+many host chunks. A host that prints a partial line and then stalls still
+shows it on the next tick. Only the first ``OUTPUT_HEAD_BYTES`` of each
+host's stdout and stderr are streamed and logged. All of it is written to
+disk by :mod:`output_store`. When a host finishes with more than that, an
+``output_rest`` event carries its tail, the number of bytes left out and the
+URL that serves them by byte range.
+
+With ``"cluster": true`` in the request, output is not streamed per host.
+Hosts with identical results (stdout, stderr, exit status) are grouped by
+:class:`OutputClusters`, each distinct output is sent once as a ``clusters``
+frame, and per-host stage events are skipped.
+
+Targets are a host expression (see :mod:`host_expr`): CIDRs, ranges,
+``web[01-64].dc{1,2}`` patterns, ``@folder`` references and ``!`` exclusions.
+Hosts are read from it lazily as the limits make room, so a /16 starts
+connecting at once. ``init`` carries an upper bound of the host count and
+a ``targets`` event the exact count once the expression is exhausted.
+
+Each run is a detached job (see :mod:`exec_jobs`). It keeps running when the
+socket closes, and its events are persisted with sequence numbers. A client
+resubscribes by sending ``{"job_id": ..., "offset": n}`` and stops a run with
+``{"type": "cancel"}``. Finished jobs can be listed and paged through under
+``/api/multi_exec/jobs``.
 """
 
 import asyncio
 import logging
-import os
-import asyncssh
 import json
-from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect, Depends
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, Request, WebSocket, Depends, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 from auth import require_auth
+import db
+import exec_jobs
+import exec_shards
+import host_expr
+import output_store
+from exec_runner import HostExecutor
+from output_aggregator import OutputAggregator
+from output_clusters import OutputClusters
+from settings import env_int
 
 
 router = APIRouter()
@@ -22,25 +60,19 @@ templates = Jinja2Templates(directory="templates")
 logger = logging.getLogger("ssh_portal.multi_exec")
 
 
-def _ensure_exit_code(val):
-    try:
-        if isinstance(val, int):
-            return val
-        code = getattr(val, "exit_status", None)
-        if code is None:
-            code = getattr(val, "returncode", None)
-        if isinstance(code, int):
-            return code
-        if isinstance(val, str):
-            import re
-            m = re.search(r"exit_status:\s*(\d+)", val) or re.search(r"returncode:\s*(\d+)", val)
-            if m:
-                return int(m.group(1))
-        if isinstance(code, str) and code.isdigit():
-            return int(code)
-    except Exception:
-        pass
-    return None
+# Starting points and ceilings of the adaptive limits (per job)
+CONNECT_CONCURRENCY = max(1, env_int("MULTI_EXEC_CONNECT_CONCURRENCY", 16))
+CONNECT_MAX = max(CONNECT_CONCURRENCY, env_int("MULTI_EXEC_CONNECT_MAX", 256))
+EXEC_CONCURRENCY = max(1, env_int("MULTI_EXEC_CONCURRENCY", 12))
+EXEC_MAX = max(EXEC_CONCURRENCY, env_int("MULTI_EXEC_EXEC_MAX", 512))
+TELEMETRY_INTERVAL = 1.0
+
+# Output batching across hosts (per job)
+FLUSH_MS = min(1000, max(10, env_int("MULTI_EXEC_FLUSH_MS", 75)))
+FLUSH_BYTES = max(1024, env_int("MULTI_EXEC_FLUSH_BYTES", 65536))
+CLUSTER_MAX_OUTPUT = max(1024, env_int("MULTI_EXEC_CLUSTER_MAX_OUTPUT", 1024 * 1024))
+# Largest target set one job accepts (checked against the expression's upper bound)
+MAX_HOSTS = max(1, env_int("MULTI_EXEC_MAX_HOSTS", 262144))
 
 
 @router.get("/portal", response_class=HTMLResponse)
@@ -51,6 +83,88 @@ def portal(request: Request, auth=Depends(require_auth)):
     )
 
 
+# ─── Jobs API ───────────────────────────────────────────────────────────────────
+def _require_user(request: Request) -> dict:
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401)
+    return user
+
+
+async def _fetch_job(user: dict, job_id: str):
+    row = await exec_jobs.fetch(user, job_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return row
+
+
+def _job_info(row) -> dict:
+    info = dict(row)
+    info["summary"] = json.loads(info["summary"]) if info.get("summary") else None
+    info["cluster"] = bool(info["cluster"])
+    info.pop("pid", None)
+    info.pop("pid_started", None)
+    info.pop("cancel_requested", None)
+    return info
+
+
+@router.get("/api/multi_exec/jobs")
+async def list_jobs(request: Request, limit: int = 50, offset: int = 0):
+    """Newest jobs first (own, or all for admins)."""
+    user = _require_user(request)
+    rows = await db.fetchall(
+        "SELECT id, username, command, total_hosts, cluster, status, created, finished, success, failure, events "
+        "FROM exec_jobs WHERE (user_id = ? OR ?) ORDER BY created DESC LIMIT ? OFFSET ?",
+        (user["id"], int(bool(user.get("is_admin"))), max(1, min(limit, 500)), max(0, offset)),
+    )
+    return JSONResponse({"jobs": [dict(r, cluster=bool(r["cluster"])) for r in rows]})
+
+
+@router.get("/api/multi_exec/jobs/{job_id}")
+async def job_info(request: Request, job_id: str):
+    user = _require_user(request)
+    return JSONResponse(_job_info(await _fetch_job(user, job_id)))
+
+
+@router.get("/api/multi_exec/jobs/{job_id}/hosts")
+async def job_hosts(request: Request, job_id: str, status: str = "", limit: int = 500, offset: int = 0):
+    """Per-host results, paged; ``status`` is ``ok``, ``failed`` or ``pending``."""
+    user = _require_user(request)
+    await _fetch_job(user, job_id)
+    where = {"ok": " AND ok = 1", "failed": " AND ok = 0", "pending": " AND ok IS NULL"}.get(status, "")
+    rows = await db.fetchall(
+        "SELECT host, stage, ok, exit_status, error, updated FROM exec_job_hosts "
+        f"WHERE job_id = ?{where} ORDER BY host LIMIT ? OFFSET ?",
+        (job_id, max(1, min(limit, 5000)), max(0, offset)),
+    )
+    hosts = [dict(r, ok=None if r["ok"] is None else bool(r["ok"])) for r in rows]
+    return JSONResponse({"hosts": hosts, "offset": offset, "count": len(hosts)})
+
+
+@router.get("/api/multi_exec/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: str, offset: int = 0, limit: int = 500):
+    """Stored events from ``offset`` (their ``seq``) on; ``next_offset`` continues the page."""
+    user = _require_user(request)
+    row = await _fetch_job(user, job_id)
+    rows = await db.fetchall(
+        "SELECT seq, data FROM exec_job_events WHERE job_id = ? AND seq >= ? ORDER BY seq LIMIT ?",
+        (job_id, max(0, offset), max(1, min(limit, 5000))),
+    )
+    events = [json.loads(r["data"]) for r in rows]
+    return JSONResponse({
+        "events": events,
+        "next_offset": rows[-1]["seq"] + 1 if rows else max(0, offset),
+        "finished": row["status"] != exec_jobs.ACTIVE,
+    })
+
+
+@router.post("/api/multi_exec/jobs/{job_id}/cancel")
+async def cancel_job(request: Request, job_id: str):
+    user = _require_user(request)
+    await _fetch_job(user, job_id)
+    return JSONResponse({"cancelled": await exec_jobs.request_cancel(job_id)})
+
+
 def _sanitize(obj):
     if obj is None or isinstance(obj, (str, int, float, bool)):
         return obj
@@ -79,39 +193,19 @@ async def _safe_ws_send(ws: WebSocket, payload: dict) -> bool:
         return False
 
 
-def _parse_hosts(data: dict) -> list[str]:
-    hosts: list[str] = []
-    file_hosts = data.get("hosts_file_lines", [])
+def _parse_targets(data: dict) -> host_expr.HostExpr:
+    """Target hosts as a lazy expression (see :mod:`host_expr`); an uploaded file wins over the field."""
+    file_hosts = data.get("hosts_file_lines") or []
     if file_hosts:
-        hosts = [h.strip() for h in file_hosts if h and h.strip()]
-    else:
-        rng = (data.get("host_range") or "").strip()
-        if not rng:
-            return []
-        if "-" in rng and "." in rng:
-            try:
-                base, suffix = rng.rsplit(".", 1)
-                s, e = map(int, suffix.split("-"))
-                hosts = [f"{base}.{i}" for i in range(s, e + 1)]
-            except Exception:
-                hosts = [rng]
-        else:
-            hosts = [rng]
-    # Deduplicate while preserving order
-    seen = set()
-    unique = []
-    for h in hosts:
-        if h not in seen:
-            unique.append(h)
-            seen.add(h)
-    return unique
+        return host_expr.parse("\n".join(h for h in file_hosts if h))
+    return host_expr.parse(data.get("host_range") or "")
 
 
 @router.websocket("/ws")
 async def ws_endpoint(ws: WebSocket):
     await ws.accept()
 
-    # Each websocket session is single-execution to keep state simple
+    # Either a new run, or {"job_id": ..., "offset": n} to resubscribe to one
     try:
         data = await ws.receive_json()
     except Exception:
@@ -124,176 +218,265 @@ async def ws_endpoint(ws: WebSocket):
         await ws.close(code=1008)
         return
 
+    job_id = data.get("job_id")
+    if job_id:
+        if not await exec_jobs.fetch(session_user, str(job_id)):
+            await _safe_ws_send(ws, {"type": "error", "message": "Job not found"})
+            await ws.close()
+            return
+        try:
+            offset = max(0, int(data.get("offset") or 0))
+        except (TypeError, ValueError):
+            offset = 0
+        await _stream_job(ws, str(job_id), offset)
+        return
+
     ssh_user = data.get("ssh_user", "")
     ssh_pass = data.get("ssh_pass", "")
     command = (data.get("command") or "").strip()
-    hosts = _parse_hosts(data)
+    cluster_mode = bool(data.get("cluster"))
+    probe = data.get("probe", True) is not False
+    try:
+        targets = _parse_targets(data)
+        await targets.resolve(session_user)
+    except host_expr.HostExprError as e:
+        await _safe_ws_send(ws, {"type": "error", "message": f"Target hosts: {e}"})
+        await ws.close()
+        return
+    # Upper bound: duplicates and exclusions drop out while the targets are read
+    estimate = targets.estimate()
 
-    if not hosts or not command or not ssh_user:
+    if not estimate or not command or not ssh_user:
         await _safe_ws_send(ws, {"type": "error", "message": "Missing hosts, command or username"})
         await ws.close()
         return
+    if estimate > MAX_HOSTS:
+        await _safe_ws_send(ws, {"type": "error", "message": f"Target hosts expand to {estimate} hosts "
+                                                             f"(limit {MAX_HOSTS})"})
+        await ws.close()
+        return
+    excluded = targets.largest_exclusion()
+    if excluded > MAX_HOSTS:
+        await _safe_ws_send(ws, {"type": "error", "message": f"An excluded pattern expands to {excluded} hosts "
+                                                             f"(limit {MAX_HOSTS})"})
+        await ws.close()
+        return
 
-    logger.info("Launching `%s` on %d host(s)", command, len(hosts))
+    # The sudo wrapper built by the page embeds the password; never store it
+    stored_command = command.replace(ssh_pass, "********") if ssh_pass else command
+    shards = exec_shards.shard_count(estimate, data.get("shards"))
+    job = exec_jobs.ExecJob(session_user, stored_command, estimate, cluster_mode)
+    await job.start(_run_job(job, targets, ssh_user, ssh_pass, command, cluster_mode, shards, probe))
+    await _stream_job(ws, job.id, 0)
 
-    # Concurrency bound (tunable via env)
-    try:
-        limit = int(os.getenv("MULTI_EXEC_CONCURRENCY", "12"))
-    except ValueError:
-        limit = 12
-    sem = asyncio.Semaphore(max(1, limit))
-    ws_lock = asyncio.Lock()
-
-    # Shared counters
-    success = 0
-    failed = 0
-    started_hosts = 0
-    start_ts = asyncio.get_event_loop().time()
-    host_results: dict[str, dict] = {}
-
-    async def send(payload: dict):
-        async with ws_lock:
-            await _safe_ws_send(ws, payload)
-
-    async def stream_process(host: str, conn: asyncssh.SSHClientConnection) -> tuple[bool, int | None]:
-        # Start process and stream output; return (ok, exit_status)
-        await send({"type": "host_status", "host": host, "stage": "command_starting"})
-        proc = None
-        exit_status: int | None = None
-        # 1) Start process (failures here imply failure)
-        try:
-            try:
-                import shlex
-                shell_cmd = f"bash -lc {shlex.quote(command)}"
-            except Exception:
-                shell_cmd = command
-            proc = await conn.create_process(shell_cmd, encoding="utf-8", errors="replace")
-        except Exception:
-            return (False, None)
-
-        await send({"type": "host_status", "host": host, "stage": "command_started"})
-
-        # 2) Stream output (any reader error should NOT flip success if exit_status==0)
-        out_buf: list[str] = []
-        err_buf: list[str] = []
-        FLUSH_LINES = 20
-
-        async def flush():
-            if out_buf:
-                chunk = "".join(out_buf)
-                out_buf.clear()
-                await send({"type": "output", "host": host, "stream": "stdout", "data": chunk})
-            if err_buf:
-                chunk = "".join(err_buf)
-                err_buf.clear()
-                if chunk.strip():
-                    await send({"type": "output", "host": host, "stream": "stderr", "data": chunk})
-
-        async def read_stream(reader, target_buf):
+
+async def _stream_job(ws: WebSocket, job_id: str, offset: int):
+    """Forward a job's events from ``offset`` until its ``done`` event or a disconnect.
+
+    Disconnecting does not stop the job; ``{"type": "cancel"}`` from the
+    client does.
+    """
+    async def pump():
+        async for etype, raw in exec_jobs.follow(job_id, offset):
             try:
-                async for line in reader:
-                    if isinstance(line, bytes):
-                        try:
-                            line = line.decode("utf-8", "replace")
-                        except Exception:
-                            line = line.decode(errors="replace")
-                    target_buf.append(line)
-                    if len(target_buf) >= FLUSH_LINES:
-                        await flush()
+                await ws.send_text(raw)
             except Exception as e:
-                # Log to UI but don't change outcome
-                await send({"type": "output", "host": host, "stream": "stderr", "data": f"[reader-error] {e}\n"})
-
-        read_out = asyncio.create_task(read_stream(proc.stdout, out_buf))
-        read_err = asyncio.create_task(read_stream(proc.stderr, err_buf))
-
-        # Get exit status as early as possible and report completion before draining
-        exit_status = await proc.wait()
-        ex = _ensure_exit_code(exit_status)
-        ok_now = (ex == 0 if ex is not None else False)
-        # Emit early completion notification to reduce risk of client missing it
-        await send({
+                logger.debug("Job %s subscriber went away: %s", job_id, e)
+                return
+            if etype == "done":
+                return
+
+    async def listen():
+        while True:
+            msg = await ws.receive_text()
+            try:
+                msg = json.loads(msg)
+            except ValueError:
+                continue
+            if isinstance(msg, dict) and msg.get("type") == "cancel":
+                await exec_jobs.request_cancel(job_id)
+
+    pump_task = asyncio.create_task(pump())
+    listen_task = asyncio.create_task(listen())
+    try:
+        await asyncio.wait({pump_task, listen_task}, return_when=asyncio.FIRST_COMPLETED)
+        if pump_task.done() and not listen_task.done():
+            # Give client time to receive 'done' and close from its side.
+            await asyncio.wait({listen_task}, timeout=2.0)
+    finally:
+        for t in (pump_task, listen_task):
+            t.cancel()
+        await asyncio.gather(pump_task, listen_task, return_exceptions=True)
+
+
+class _JobSink:
+    """Turns :class:`HostExecutor` reports into a job's events, counters and clusters.
+
+    Local runs and shard processes (see :mod:`exec_shards`) report through the
+    same sink, so both produce the same event stream.
+    """
+
+    def __init__(self, job: exec_jobs.ExecJob, cluster_mode: bool):
+        self.job = job
+        self.cluster_mode = cluster_mode
+        self.batcher = OutputAggregator(self.send, interval=FLUSH_MS / 1000, max_bytes=FLUSH_BYTES)
+        self.clusters = OutputClusters(self.send, max_output=CLUSTER_MAX_OUTPUT) if cluster_mode else None
+        self.store = output_store.OutputStore(job.id, job.user["id"])
+        self.success = 0
+        self.failure = 0
+        self.started = 0
+        self.unreachable = 0
+        self.results: dict[str, dict] = {}
+
+    async def send(self, payload: dict):
+        self.job.emit(payload)
+
+    async def status(self, payload: dict):
+        self.job.host_result(payload["host"], payload["stage"], ok=payload.get("ok"),
+                             exit_status=payload.get("exit_status"), error=payload.get("error"))
+        if payload["stage"] == "connected":
+            self.started += 1
+        # Clustered runs report progress through cluster frames instead
+        if not self.cluster_mode:
+            await self.send(payload)
+
+    async def output(self, host: str, stream: str, data: str):
+        # All of it goes to disk; only the head of each stream is streamed and logged
+        shown = await self.store.write(host, stream, data)
+        if shown:
+            await self.batcher.write(host, stream, shown)
+
+    async def _finish_output(self, host: str):
+        streams = await self.store.finish_host(host)
+        rest = [(stream, out) for stream, out in streams.items() if out.size > len(out.head)]
+        if not rest:
+            return
+        await self.batcher.flush()      # the head goes out first
+        for stream, out in rest:
+            omitted, text = out.rest()
+            await self.send({
+                "type": "output_rest",
+                "host": host,
+                "stream": stream,
+                "data": text,
+                "omitted": omitted,             # bytes [omitted_from, omitted_from + omitted) are on disk only
+                "omitted_from": len(out.head),
+                "size": out.size,
+                "url": self.store.url(host, stream),
+            })
+
+    def new_capture(self):
+        return self.clusters.capture() if self.clusters else None
+
+    async def finished(self, host: str, *, connected: bool, ok: bool, exit_status: int | None,
+                       error: str | None = None, capture=None, fingerprint=None, texts=None,
+                       unreachable: bool = False):
+        job = self.job
+        if not connected:
+            self.failure += 1
+            self.unreachable += unreachable
+            job.failure = self.failure
+            if self.clusters:
+                # Drop the address so hosts failing the same way cluster together
+                self.clusters.finish(host, None, error=error.replace(host, "<host>"))
+            await self.status({"type": "host_status", "host": host, "stage": "connect_failed", "error": error})
+            return
+        await self._finish_output(host)
+        if ok:
+            self.success += 1
+        else:
+            self.failure += 1
+        job.success, job.failure = self.success, self.failure
+        self.results[host] = {"ok": ok, "exit_status": exit_status}
+        if self.clusters:
+            if fingerprint is not None:
+                self.clusters.finish_digest(host, fingerprint, texts, exit_status=exit_status, ok=ok)
+            else:
+                self.clusters.finish(host, capture, exit_status=exit_status, ok=ok)
+        await self.status({
             "type": "host_status",
             "host": host,
             "stage": "completed",
-            "ok": ok_now,
-            "exit_status": ex,
+            "ok": ok,
+            "exit_status": exit_status,
         })
 
-        await asyncio.gather(read_out, read_err, return_exceptions=True)
-        await flush()
+    def stopped(self, host: str):
+        self.job.host_result(host, "stopped")
 
-        return (ok_now, exit_status)
 
-    async def run_host(host: str):
-        nonlocal started_hosts, success, failed
-        async with sem:
-            await send({"type": "host_status", "host": host, "stage": "connecting"})
-            try:
-                conn = await asyncssh.connect(
-                    host, username=ssh_user, password=ssh_pass, known_hosts=None
-                )
-            except Exception as e:
-                failed += 1
-                await send({"type": "host_status", "host": host, "stage": "connect_failed", "error": str(e)})
-                return
-            await send({"type": "host_status", "host": host, "stage": "connected"})
-            started_hosts += 1
-            ok, exit_status = await stream_process(host, conn)
-            ex = _ensure_exit_code(exit_status)
-            if ex is not None:
-                ok = (ex == 0)
-            if ok:
-                success += 1
-            else:
-                failed += 1
-            result_evt = {
-                "type": "host_status",
-                "host": host,
-                "stage": "completed",
-                "ok": ok,
-                "exit_status": ex,
-            }
-            host_results[host] = {"ok": ok, "exit_status": ex}
-            await send(result_evt)
-            try:
-                conn.close()
-            except Exception:
-                pass
-
-    # Kick off all host tasks
-    tasks = [asyncio.create_task(run_host(h)) for h in hosts]
-    await send({"type": "init", "total_hosts": len(hosts)})
+async def _run_job(job: exec_jobs.ExecJob, targets: host_expr.HostExpr, ssh_user: str, ssh_pass: str,
+                   command: str, cluster_mode: bool, shards: int = 1, probe: bool = True):
+    logger.info("Job %s: launching `%s` on up to %d host(s)%s%s", job.id, command, job.total_hosts,
+                " (clustered)" if cluster_mode else "", f" in {shards} shards" if shards > 1 else "")
+    start_ts = asyncio.get_event_loop().time()
+    sink = _JobSink(job, cluster_mode)
+    limits = {"connect": (CONNECT_CONCURRENCY, CONNECT_MAX), "execute": (EXEC_CONCURRENCY, EXEC_MAX),
+              "probe": probe}
+
+    async def hosts():
+        # Read lazily by the runner; the exact count is known once the expression is exhausted
+        count = 0
+        async for host in targets.stream():
+            count += 1
+            yield host
+        job.total_hosts = count
+        await sink.send({"type": "targets", "total_hosts": count})
+
+    if shards > 1:
+        # Large fan-out: SSH work spread over processes, events merged here
+        runner = exec_shards.ShardedRun(hosts(), ssh_user, ssh_pass, command, sink, shards=shards,
+                                        cluster=cluster_mode, max_output=CLUSTER_MAX_OUTPUT, **limits)
+        job.on_cancel = runner.cancel
+        concurrency = runner.concurrency
+        run = runner.run()
+    else:
+        executor = HostExecutor(ssh_user, ssh_pass, command, sink, **limits)
+        job.on_cancel = executor.stop
+        concurrency = executor.concurrency
+        run = executor.run_many(hosts())
+
+    async def report_concurrency():
+        while True:
+            await asyncio.sleep(TELEMETRY_INTERVAL)
+            job.live({"type": "concurrency", **concurrency()})
+
+    await sink.store.open()
+    await sink.send({"type": "init", "total_hosts": job.total_hosts, "job_id": job.id,
+                     "cluster": cluster_mode, "shards": shards})
+    sink.batcher.start()
+    if sink.clusters:
+        sink.clusters.start()
+    reporter = asyncio.create_task(report_concurrency())
 
     try:
-        await asyncio.gather(*tasks)
-    except WebSocketDisconnect:
-        for t in tasks:
-            t.cancel()
+        # Runs to the end even if every browser disconnects; cancel() stops the hosts
+        await run
     finally:
+        reporter.cancel()
+        await sink.batcher.close()
+        await sink.store.close()
+        if sink.clusters:
+            await sink.clusters.close()
         duration = asyncio.get_event_loop().time() - start_ts
-        await send({
+        await sink.send({
             "type": "summary",
-            "total_hosts": len(hosts),
-            "started": started_hosts,
-            "success": success,
-            "failure": failed,
+            "job_id": job.id,
+            "total_hosts": job.total_hosts,
+            "started": sink.started,
+            "success": sink.success,
+            "failure": sink.failure,
+            "unreachable": sink.unreachable,
+            "cancelled": job.cancel_requested,
             "duration_sec": round(duration, 2),
-            "results": host_results,
+            "results": sink.results,
+            "concurrency": concurrency(history=True),
+            "output": {**sink.batcher.stats(), "stored": sink.store.stats()},
+            **({"clusters": sink.clusters.summary(), "clustering": sink.clusters.stats()} if sink.clusters else {}),
         })
-        # Emit a final 'done' signal and small delay to let client process frames
-        await send({
+        await sink.send({
             "type": "done",
-            "results": host_results,
-            "success": success,
-            "failure": failed,
+            "results": sink.results,
+            "success": sink.success,
+            "failure": sink.failure,
         })
-        # Give client time to receive 'done' and close from its side.
-        try:
-            await asyncio.wait_for(ws.receive_text(), timeout=2.0)
-        except Exception:
-            # Client may have already closed or not send anything; leave socket to be closed by client.
-            try:
-                await asyncio.sleep(0.2)
-            except Exception:
-                pass
@@ -0,0 +1,79 @@
+# routers/output.py
+"""Full per-host output of MultiExec and ScriptExec runs, fetched by byte range."""
+
+import asyncio
+import re
+
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse, Response
+
+import output_store
+
+router = APIRouter()
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+def _require_owner(request: Request, run_id: str) -> dict:
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401)
+    owner = output_store.owner(run_id)
+    if owner is None or not (owner == user["id"] or user.get("is_admin")):
+        raise HTTPException(status_code=404, detail="Run not found")
+    return user
+
+
+@router.get("/api/output/{run_id}")
+async def run_output(request: Request, run_id: str):
+    """Hosts of a run with the stored size of their stdout and stderr."""
+    _require_owner(request, run_id)
+    hosts = await asyncio.to_thread(output_store.listing, run_id)
+    return JSONResponse({"run_id": run_id, "hosts": hosts})
+
+
+@router.get("/api/output/{run_id}/{host}/{stream}")
+async def host_output(request: Request, run_id: str, host: str, stream: str,
+                      offset: int = 0, length: int | None = None):
+    """One host's stdout or stderr as text.
+
+    Takes an HTTP ``Range: bytes=a-b`` header (one range, suffix ranges
+    included) or ``?offset=&length=``. Each request returns at most 4 MiB.
+    ``X-Output-Size`` carries the stored size.
+    """
+    _require_owner(request, run_id)
+    if stream not in output_store.STREAMS:
+        raise HTTPException(status_code=404)
+    start, end = max(0, offset), (max(0, offset) + max(0, length) if length is not None else None)
+    header = request.headers.get("range")
+    ranged = header is not None or offset > 0 or length is not None
+    backwards = False
+    if header:
+        match = _RANGE.match(header.strip())
+        if not match or match.groups() == ("", ""):
+            raise HTTPException(status_code=416)
+        first, last = match.groups()
+        if first:
+            start, end = int(first), (int(last) + 1 if last else None)
+            backwards = bool(last) and int(last) < start
+        else:
+            total = await asyncio.to_thread(output_store.size, run_id, host, stream)
+            if total is None:
+                raise HTTPException(status_code=404, detail="No output stored for this host")
+            start, end = max(0, total - int(last)), None
+    result = await asyncio.to_thread(output_store.read_range, run_id, host, stream, start, end)
+    if result is None:
+        raise HTTPException(status_code=404, detail="No output stored for this host")
+    data, total = result
+    headers = {"Accept-Ranges": "bytes", "X-Output-Size": str(total), "Cache-Control": "no-cache"}
+    if not ranged:
+        if len(data) < total:
+            # Larger than one read: say so, like a range response
+            headers["Content-Range"] = f"bytes 0-{len(data) - 1}/{total}"
+            return Response(data, status_code=206, media_type="text/plain; charset=utf-8", headers=headers)
+        return Response(data, media_type="text/plain; charset=utf-8", headers=headers)
+    if backwards or (start >= total and total):
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{total}"})
+    if data:
+        headers["Content-Range"] = f"bytes {start}-{start + len(data) - 1}/{total}"
+    return Response(data, status_code=206, media_type="text/plain; charset=utf-8", headers=headers)
@@ -0,0 +1,63 @@
+# routers/recordings.py
+"""Terminal session recordings: listing, keyframe index and asciicast replay."""
+
+from fastapi import APIRouter, Request, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+
+import db
+import term_recorder
+
+router = APIRouter()
+
+
+def _require_user(request: Request) -> dict:
+    user = request.session.get("user")
+    if not user:
+        raise HTTPException(status_code=401)
+    return user
+
+
+async def _fetch_recording(user: dict, rec_id: str):
+    row = await db.fetchone(
+        "SELECT * FROM terminal_recordings WHERE id = ? AND (user_id = ? OR ?)",
+        (rec_id, user["id"], int(user["is_admin"])),
+    )
+    if not row:
+        raise HTTPException(status_code=404, detail="Recording not found")
+    return row
+
+
+@router.get("/api/terminal/recordings")
+async def list_recordings(request: Request, limit: int = 100, offset: int = 0):
+    """Newest recordings first (own, or all for admins)."""
+    user = _require_user(request)
+    rows = await db.fetchall(
+        "SELECT id, username, host_id, host_name, started, ended, duration, bytes_out, bytes_in, stored_bytes "
+        "FROM terminal_recordings WHERE (user_id = ? OR ?) ORDER BY started DESC LIMIT ? OFFSET ?",
+        (user["id"], int(user["is_admin"]), max(1, min(limit, 1000)), max(0, offset)),
+    )
+    return JSONResponse({"recordings": [dict(r) for r in rows]})
+
+
+@router.get("/api/terminal/recordings/{rec_id}")
+async def recording_info(request: Request, rec_id: str):
+    """Recording metadata plus its keyframe index (time → file position)."""
+    user = _require_user(request)
+    row = await _fetch_recording(user, rec_id)
+    info = dict(row)
+    info.pop("path", None)
+    info["keyframes"] = term_recorder.read_index(row["path"])
+    return JSONResponse(info)
+
+
+@router.get("/api/terminal/recordings/{rec_id}/cast")
+async def recording_cast(request: Request, rec_id: str, start: float = 0.0):
+    """Stream the recording as asciicast v2, optionally from ``start`` seconds."""
+    user = _require_user(request)
+    row = await _fetch_recording(user, rec_id)
+    # Sync generator: Starlette iterates it in the threadpool, off the event loop
+    return StreamingResponse(
+        term_recorder.iter_cast(row["path"], max(0.0, start)),
+        media_type="application/x-asciicast",
+        headers={"Content-Disposition": f'attachment; filename="{rec_id}.cast"'},
+    )
@@ -1,15 +1,18 @@
 # routers/script_exec.py
-import logging, json
-from pathlib import Path
-import asyncssh
+import asyncio, logging, json
 from fastapi import APIRouter, Request, Form, File, UploadFile, Depends
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.templating import Jinja2Templates
 from auth import require_auth
+import script_runner
+import upload_spool
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
+HEARTBEAT = 15.0    # seconds between keep-alive comments while hosts are quiet
+
 @router.get("/script", response_class=HTMLResponse)
 def script_page(request: Request, auth=Depends(require_auth)):
     return templates.TemplateResponse("script.html", {
@@ -24,31 +27,47 @@ async def run_script(
     ssh_pass: str = Form(...),
     hosts: str   = Form(...),
     sudo: bool   = Form(False),
+    probe: bool  = Form(True),
+    concurrency: int = Form(script_runner.CONCURRENCY),
+    mode: str    = Form("auto"),
     script: UploadFile = File(...),
     auth=Depends(require_auth)
 ):
+    """Run the script on every host, streaming stages and output as server-sent events."""
+    if not isinstance(auth, dict):
+        return auth
     hosts_list = json.loads(hosts)
-    content = await script.read()
-    tmp = Path("/tmp/ssh_scripts")
-    tmp.mkdir(exist_ok=True)
-    path = tmp / script.filename
-    path.write_bytes(content)
+    artifact = await upload_spool.spool(script)
+
+    try:
+        run = script_runner.ScriptRun(artifact, hosts_list, ssh_user, ssh_pass, user_id=auth["id"],
+                                      sudo=sudo, probe=probe, concurrency=concurrency, mode=mode)
+    except BaseException:
+        upload_spool.discard(artifact.path)
+        raise
+    logging.info(f"Script run {run.id}: {script.filename} on {len(hosts_list)} host(s)")
+
+    async def event_stream():
+        task = asyncio.create_task(run.run())
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(run.events.get(), HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield f"data: {json.dumps(event)}\n\n"
+            await task
+        finally:
+            # The client went away (Stop Execution): stop the hosts too
+            task.cancel()
+            upload_spool.discard(artifact.path)
+            await asyncio.gather(task, return_exceptions=True)
 
-    log = ""
-    for host in hosts_list:
-        logging.info(f"On {host}: uploading {script.filename}")
-        async with asyncssh.connect(host,
-                                   username=ssh_user,
-                                   password=ssh_pass,
-                                   known_hosts=None) as conn:
-            async with conn.start_sftp_client() as sftp:
-                await sftp.put(str(path), f"/home/{ssh_user}/{path.name}")
-            cmd = f"bash /home/{ssh_user}/{path.name}"
-            if sudo:
-                cmd = f"echo '{ssh_pass}' | sudo -S -p '' {cmd}"
-            res = await conn.run(cmd, check=False)
-            log += f"[{host}] STDOUT:\n{res.stdout}\n"
-            log += f"[{host}] STDERR:\n{res.stderr}\n" if res.stderr else ""
-            await conn.run(f"rm /home/{ssh_user}/{path.name}")
-    path.unlink()
-    return log
+    # The background task also covers a client that left before the stream started
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",      # nginx: pass events through unbuffered
+    }, background=BackgroundTask(upload_spool.discard, artifact.path))
@@ -8,7 +8,7 @@ from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import JSONResponse
 
 from auth import require_auth
-import db
+import host_cache
 
 try:
     from cryptography.hazmat.primitives.ciphers.aead import AESGCM
@@ -101,13 +101,7 @@ async def mint_token(request: Request, auth=Depends(require_auth)):
     # Preferred: host_id lookup (avoids exposing credentials to the browser)
     host_id: Optional[int] = body.get("host_id") if isinstance(body, dict) else None
     if isinstance(host_id, int) and host_id > 0:
-        conn = db.get_db()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT * FROM hosts WHERE id = ? AND (user_id = ? OR ?)",
-            (host_id, user.get("id", 0), int(bool(user.get("is_admin"))))
-        )
-        row = cur.fetchone()
+        row = await host_cache.get_host(user, host_id)
         if not row:
             raise HTTPException(status_code=404, detail="host not found")
         token = _mint_for_values(row["host"], row["username"], row["password"], user_name)
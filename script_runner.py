@@ -0,0 +1,321 @@
+# script_runner.py
+"""Run an uploaded script on many hosts at once and stream what happens.
+
+A :class:`ScriptRun` works through the hosts with ``SCRIPT_EXEC_CONCURRENCY``
+workers. Each worker takes the next host, connects through the SSH pool,
+runs the script and takes another host. The summary has the mean time per
+host for each step (connect, upload, run, cleanup).
+
+By default the script is piped over stdin on the one exec channel. Bash
+reads it from a copy of stdin on fd 3, and the script's own stdin is
+``/dev/null``, so commands inside it cannot read the rest of the script.
+With sudo, the password goes first on stdin to ``sudo -v``, and the
+redirection happens in a shell under sudo. A script that uses ``$0`` or
+``BASH_SOURCE`` is uploaded, run and removed; ``mode="upload"`` forces
+that. Uploads, and piped scripts large enough to be worth it, go through
+the host's :mod:`artifact_cache`. Sudo runs never execute a cache entry.
+
+Events go on the :attr:`ScriptRun.events` queue as they happen, with None
+at the end. They have the same shapes as MultiExec's:
+
+* ``init``: run id, host count, worker count and mode.
+* ``host_status``: a host moved to ``connecting``, ``uploading``,
+  ``command_started`` or ``completed`` (with exit status and duration), or
+  failed (``connect_failed``, ``failed``, ``skipped``).
+* ``output_batch``: output of every host, batched a few times per second
+  (see :mod:`output_aggregator`). Only the head of each stream is sent; the
+  rest goes to disk (see :mod:`output_store`). An ``output_rest`` event with
+  the tail follows when a host finishes.
+* ``summary``: exit status, duration and error per host, then ``done``.
+
+The queue is bounded. When the client reads slowly, the output readers wait
+instead of buffering. Cancelling :meth:`ScriptRun.run` (the client went
+away) stops every host.
+"""
+
+import asyncio
+import codecs
+import logging
+import re
+import secrets
+import shlex
+import time
+
+import artifact_cache
+import output_store
+import sftp_transfer
+import ssh_pool
+import tcp_probe
+from output_aggregator import OutputAggregator
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.script_runner")
+
+
+CONCURRENCY = max(1, env_int("SCRIPT_EXEC_CONCURRENCY", 32))   # hosts at once; a run may ask for fewer
+QUEUE_EVENTS = 256              # events waiting for the client before hosts pause
+READ_CHUNK = 65536
+
+# Scripts that refer to their own file must be uploaded; the rest are piped
+_SELF_PATH = re.compile(rb"\$0\b|\$\{0\}|BASH_SOURCE")
+_SELF_PATH_OVERLAP = 16         # bytes kept between chunks, longer than any match
+# The script comes in on stdin; its commands must not read the rest of it
+_PIPED = "bash /dev/fd/3 3<&0 </dev/null"
+
+
+def _refers_to_self(path) -> bool:
+    """True when the script mentions ``$0`` or ``BASH_SOURCE``, read a chunk at a time."""
+    tail = b""
+    with open(path, "rb") as src:
+        while chunk := src.read(READ_CHUNK):
+            window = tail + chunk
+            if _SELF_PATH.search(window):
+                return True
+            tail = window[-_SELF_PATH_OVERLAP:]
+    return False
+
+
+class ScriptRun:
+    """One script on a list of hosts."""
+
+    def __init__(self, artifact: artifact_cache.Artifact, hosts: list[str], ssh_user: str, ssh_pass: str, *,
+                 user_id: int, sudo: bool = False, probe: bool = True, concurrency: int = CONCURRENCY,
+                 mode: str = "auto"):
+        self.id = secrets.token_hex(8)
+        self.artifact = artifact
+        self.path = artifact.path
+        self.mode = mode
+        self.pipe = mode == "pipe"      # settled by _prepare once the script is read
+        self.from_cache = False
+        self.body = b""
+        self.hosts = hosts
+        self.ssh_user = ssh_user
+        self.ssh_pass = ssh_pass
+        self.sudo = sudo
+        self.probe = probe
+        self.concurrency = max(1, min(concurrency, CONCURRENCY, len(hosts) or 1))
+        self.events: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=QUEUE_EVENTS)
+        self.store = output_store.OutputStore(self.id, user_id)
+        self.batcher = OutputAggregator(self.emit)
+        self.results: dict[str, dict] = {}
+        self.success = 0
+        self.failure = 0
+        self.unreachable = 0
+        self.cancelled = False
+        self._stage_totals: dict[str, tuple[float, int]] = {}
+        self.cache = artifact_cache.CacheStats()
+
+    async def emit(self, event: dict) -> None:
+        if not self.cancelled:
+            await self.events.put(event)
+
+    def _prepare(self) -> None:
+        """Pick pipe or upload mode and load what gets piped; runs on a worker thread."""
+        if self.mode == "auto":
+            self.pipe = not _refers_to_self(self.path)
+        # Large piped scripts run from the host's cached copy, except under sudo
+        self.from_cache = self.pipe and self.artifact.cacheable and not self.sudo
+        if self.pipe and not self.from_cache:
+            self.body = self.path.read_bytes()
+
+    # ── Running ──────────────────────────────────────────────────────────────
+    async def run(self) -> None:
+        started = time.monotonic()
+        await asyncio.to_thread(self._prepare)
+        logger.info("Script run %s: %s on %d host(s), %d at a time, %s mode",
+                    self.id, self.path.name, len(self.hosts), self.concurrency, "pipe" if self.pipe else "upload")
+        await self.emit({"type": "init", "run_id": self.id, "total_hosts": len(self.hosts),
+                         "concurrency": self.concurrency, "script": self.path.name,
+                         "mode": "pipe" if self.pipe else "upload"})
+        await self.store.open()
+        self.batcher.start()
+        try:
+            # Check port 22 on every host at once so dead hosts don't each cost an SSH timeout
+            reach = {}
+            if self.probe and tcp_probe.prober.enabled:
+                reach = await tcp_probe.prober.check_all(self.hosts)
+            pending = iter(self.hosts)
+
+            async def worker():
+                for host in pending:
+                    ok, error = reach.get(host, (True, None))
+                    if ok:
+                        await self._run_host(host)
+                    else:
+                        self._result(host, False, None, 0.0, error)
+                        self.unreachable += 1
+                        await self.emit({"type": "host_status", "host": host, "stage": "skipped", "error": error})
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        except asyncio.CancelledError:
+            # Nobody reads the queue any more: drop what is in it and what comes
+            logger.info("Script run %s cancelled", self.id)
+            self.cancelled = True
+            while not self.events.empty():
+                self.events.get_nowait()
+            raise
+        finally:
+            await self.batcher.close()
+            await self.store.close()
+        duration = time.monotonic() - started
+        logger.info("Script run %s finished in %.1fs: %d ok, %d failed",
+                    self.id, duration, self.success, self.failure)
+        await self.emit({
+            "type": "summary",
+            "run_id": self.id,
+            "total_hosts": len(self.hosts),
+            "success": self.success,
+            "failure": self.failure,
+            "unreachable": self.unreachable,
+            "duration_sec": round(duration, 2),
+            "mode": "pipe" if self.pipe else "upload",
+            "stage_avg_sec": self.stage_averages(),
+            "artifact_cache": self.cache.summary(),
+            "results": self.results,
+            "output": {**self.batcher.stats(), "stored": self.store.stats()},
+        })
+        await self.emit({"type": "done", "success": self.success, "failure": self.failure})
+        await self.events.put(None)
+
+    def _result(self, host: str, ok: bool, exit_status: int | None, duration: float,
+                error: str | None = None, timings: dict | None = None) -> None:
+        if ok:
+            self.success += 1
+        else:
+            self.failure += 1
+        self.results[host] = {"ok": ok, "exit_status": exit_status, "duration_sec": round(duration, 2),
+                              **({"error": error} if error else {}), **({"timings": timings} if timings else {})}
+        for stage, seconds in (timings or {}).items():
+            total, count = self._stage_totals.get(stage, (0.0, 0))
+            self._stage_totals[stage] = (total + seconds, count + 1)
+
+    def stage_averages(self) -> dict[str, float]:
+        """Mean seconds per host spent connecting, uploading, running and cleaning up."""
+        return {stage: round(total / count, 3) for stage, (total, count) in self._stage_totals.items()}
+
+    async def _run_host(self, host: str) -> None:
+        started = mark = time.monotonic()
+        timings: dict[str, float] = {}
+
+        def lap(stage: str) -> None:
+            nonlocal mark
+            now = time.monotonic()
+            timings[stage] = round(now - mark, 3)
+            mark = now
+
+        await self.emit({"type": "host_status", "host": host, "stage": "connecting"})
+        try:
+            conn = await ssh_pool.pool.acquire(host, self.ssh_user, self.ssh_pass)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            self._result(host, False, None, time.monotonic() - started, error)
+            await self.emit({"type": "host_status", "host": host, "stage": "connect_failed", "error": error})
+            return
+        lap("connect")
+        remote = None if self.pipe else f"/home/{self.ssh_user}/{self.path.name}"
+        try:
+            if remote:
+                await self.emit({"type": "host_status", "host": host, "stage": "uploading"})
+                await artifact_cache.place(conn, self.artifact, remote, self.cache, throttle=sftp_transfer.outbound)
+                lap("upload")
+                script, body = f"bash {shlex.quote(remote)}", b""
+            elif self.from_cache:
+                # A large script: run the host's cached copy rather than send it again
+                await self.emit({"type": "host_status", "host": host, "stage": "uploading"})
+                await artifact_cache.fetch(conn, self.artifact, self.cache, throttle=sftp_transfer.outbound)
+                lap("upload")
+                script, body = f"bash {shlex.quote(self.artifact.remote_path)}", b""
+            else:
+                script, body = _PIPED, self.body
+            if self.sudo:
+                # The password is the first line on stdin, never on a command line
+                cmd = (f"IFS= read -r p; printf '%s\\n' \"$p\" | sudo -S -p '' -v && "
+                       f"sudo -n sh -c {shlex.quote(script)}")
+                body = self.ssh_pass.encode() + b"\n" + body
+            else:
+                cmd = script
+            await self.emit({"type": "host_status", "host": host, "stage": "command_started"})
+            exit_status = await self._execute(conn, host, cmd, body)
+            lap("run")
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            await self._finish_output(host)
+            self._result(host, False, None, time.monotonic() - started, error)
+            await self.emit({"type": "host_status", "host": host, "stage": "failed", "error": error})
+            return
+        finally:
+            if remote:
+                try:
+                    await conn.run(f"rm -f {shlex.quote(remote)}", check=False)
+                except Exception as e:
+                    logger.debug("Could not remove %s on %s: %s", remote, host, e)
+            await ssh_pool.pool.release(conn)
+        if remote:
+            lap("cleanup")
+        await self._finish_output(host)
+        duration = time.monotonic() - started
+        ok = exit_status == 0
+        self._result(host, ok, exit_status, duration, timings=timings)
+        await self.emit({"type": "host_status", "host": host, "stage": "completed", "ok": ok,
+                         "exit_status": exit_status, "duration_sec": round(duration, 2)})
+
+    async def _execute(self, conn, host: str, cmd: str, stdin: bytes = b"") -> int | None:
+        """Run ``cmd`` with ``stdin`` as its input, streaming its output; returns the exit status."""
+        proc = await conn.create_process(cmd, encoding=None)
+
+        async def feed():
+            try:
+                # Piped scripts count against the same outbound cap as transfers
+                for offset in range(0, len(stdin), sftp_transfer.BLOCK_BYTES):
+                    block = stdin[offset:offset + sftp_transfer.BLOCK_BYTES]
+                    await sftp_transfer.outbound.take(len(block))
+                    proc.stdin.write(block)
+                    await proc.stdin.drain()
+                proc.stdin.write_eof()
+            except OSError:
+                pass        # exited before reading all of it
+
+        async def pump(reader, stream: str):
+            # Decode here so a character split across reads survives
+            decoder = codecs.getincrementaldecoder("utf-8")("replace")
+            while True:
+                data = await reader.read(READ_CHUNK)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    shown = await self.store.write(host, stream, text)
+                    if shown:
+                        await self.batcher.write(host, stream, shown)
+                if not data:
+                    break
+
+        try:
+            await asyncio.gather(feed(), pump(proc.stdout, "stdout"), pump(proc.stderr, "stderr"))
+            await proc.wait_closed()
+        finally:
+            if proc.exit_status is None and proc.exit_signal is None:
+                # Cancelled: signal the script (where the server allows it) before closing the channel
+                try:
+                    proc.terminate()
+                except Exception:
+                    pass
+            proc.close()
+        return proc.exit_status if proc.exit_status is not None else proc.returncode
+
+    async def _finish_output(self, host: str) -> None:
+        streams = await self.store.finish_host(host)
+        rest = [(stream, out) for stream, out in streams.items() if out.size > len(out.head)]
+        if not rest:
+            return
+        await self.batcher.flush()      # the head goes out first
+        for stream, out in rest:
+            omitted, text = out.rest()
+            await self.emit({
+                "type": "output_rest",
+                "host": host,
+                "stream": stream,
+                "data": text,
+                "omitted": omitted,
+                "omitted_from": len(out.head),
+                "size": out.size,
+                "url": self.store.url(host, stream),
+            })
@@ -0,0 +1,12 @@
+# settings.py
+"""Environment settings shared by the portal's modules."""
+
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    """``name`` from the environment as an int; ``default`` when unset or malformed."""
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
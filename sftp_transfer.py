@@ -0,0 +1,97 @@
+# sftp_transfer.py
+"""Pipelined SFTP uploads that share an outbound bandwidth budget.
+
+:func:`put` does the work of ``sftp.put``. It reads the file in
+``BLOCK_BYTES`` blocks and keeps ``REQUESTS`` writes in flight per
+transfer. Before each block it takes that many bytes from a
+:class:`Throttle`, a token bucket that any number of transfers can share. A
+throttle may have a parent, so a run can have its own cap under the
+worker-wide one (``UPLOAD_MAX_MB_PER_SEC``, :data:`outbound`). The progress
+callback gets the bytes written so far after every block.
+"""
+
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import Callable
+
+from settings import env_int
+
+
+# asyncssh's defaults (the server's largest write, often 4 MB, times 128 in
+# flight) hold hundreds of megabytes per large transfer
+BLOCK_BYTES = 256 * 1024
+REQUESTS = 16
+MAX_BYTES_PER_SEC = max(0, env_int("UPLOAD_MAX_MB_PER_SEC", 0)) * 1048576    # 0: no cap
+
+
+class Throttle:
+    """Token bucket: at most ``rate`` bytes per second (0 is unlimited), bursts of up to a second."""
+
+    def __init__(self, rate: int, parent: "Throttle | None" = None):
+        self.rate = rate
+        self.parent = parent
+        self._tokens = float(rate)
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.waited = 0.0       # seconds transfers spent held back here
+
+    async def take(self, size: int) -> None:
+        if self.rate:
+            # Waiters queue on the lock, so they are served in order
+            async with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._stamp) * self.rate) - size
+                self._stamp = now
+                if self._tokens < 0:
+                    delay = -self._tokens / self.rate
+                    self.waited += delay
+                    await asyncio.sleep(delay)
+        if self.parent is not None:
+            await self.parent.take(size)
+
+
+outbound = Throttle(MAX_BYTES_PER_SEC)      # everything this worker uploads
+
+
+async def put(sftp, path: Path, dest: str, *, throttle: Throttle | None = None,
+              progress: Callable[[int], None] | None = None) -> int:
+    """Upload ``path`` to ``dest``; returns the bytes sent."""
+    size = path.stat().st_size
+    sent = 0
+    offsets = iter(range(0, size, BLOCK_BYTES))
+    with open(path, "rb") as src:
+        fd = src.fileno()
+        async with sftp.open(dest, "wb") as dst:
+
+            async def writer():
+                nonlocal sent
+                for offset in offsets:
+                    # A page-cache read of one block; asyncssh's own put reads the same way
+                    data = os.pread(fd, BLOCK_BYTES, offset)
+                    if throttle is not None:
+                        await throttle.take(len(data))
+                    await dst.write(data, offset)
+                    sent += len(data)
+                    if progress is not None:
+                        progress(sent)
+
+            tasks = [asyncio.create_task(writer()) for _ in range(min(REQUESTS, size // BLOCK_BYTES + 1))]
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                # One write failed (or we were cancelled): stop the rest before the file closes
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+    return sent
+
+
+def stats() -> dict:
+    return {
+        "max_bytes_per_sec": outbound.rate,
+        "throttled_sec": round(outbound.waited, 1),
+        "block_bytes": BLOCK_BYTES,
+        "requests": REQUESTS,
+    }
@@ -0,0 +1,305 @@
+# ssh_pool.py
+"""Process-wide pool of reusable SSH connections.
+
+Terminals, MultiExec, ScriptExec and FileUploader all borrow connections from
+here instead of calling ``asyncssh.connect`` themselves. Connections are keyed
+by (host, port, username, credential fingerprint), so a repeat run against the
+same fleet opens new channels on live connections and skips the TCP + key
+exchange + auth round trips. Idle connections are evicted by TTL, and by LRU
+when a per-host or global cap is reached.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import secrets
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import asyncssh
+
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.ssh_pool")
+
+
+# Per-process key: fingerprints separate credentials without keeping a
+# reusable password hash around in memory.
+_FINGERPRINT_KEY = secrets.token_bytes(32)
+
+
+def credential_fingerprint(password: str) -> str:
+    digest = hmac.new(_FINGERPRINT_KEY, (password or "").encode("utf-8"), hashlib.sha256)
+    return digest.hexdigest()[:32]
+
+
+class _Entry:
+    """One live connection plus its lease bookkeeping."""
+
+    __slots__ = ("key", "conn", "leases", "retired", "created", "last_used")
+
+    def __init__(self, key: tuple, conn: asyncssh.SSHClientConnection):
+        self.key = key
+        self.conn = conn
+        self.leases = 0
+        self.retired = False
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+    @property
+    def host(self) -> str:
+        return self.key[0]
+
+    def is_alive(self) -> bool:
+        try:
+            return not self.conn.is_closed()
+        except Exception:
+            return False
+
+
+class SSHConnectionPool:
+    """Shares SSH connections across callers and opens channels on them.
+
+    A connection carries up to ``max_sessions`` concurrent leases (one per
+    channel a caller intends to open). Callers wait when both the per-host
+    and global caps are exhausted and nothing idle can be evicted.
+    """
+
+    def __init__(self, *, idle_ttl: float = 600, max_total: int = 1024,
+                 max_per_host: int = 4, max_sessions: int = 8,
+                 keepalive_interval: int = 30):
+        self.idle_ttl = max(1.0, float(idle_ttl))
+        self.max_total = max(1, int(max_total))
+        self.max_per_host = max(1, int(max_per_host))
+        self.max_sessions = max(1, int(max_sessions))
+        self.keepalive_interval = keepalive_interval
+
+        self._entries: dict[tuple, list[_Entry]] = {}
+        self._by_conn: dict[int, _Entry] = {}
+        self._idle: "OrderedDict[int, _Entry]" = OrderedDict()  # LRU: oldest first
+        self._host_counts: dict[str, int] = {}
+        self._pending_keys: dict[tuple, int] = {}
+        self._pending_hosts: dict[str, int] = {}
+        self._pending_total = 0
+        self._cond = asyncio.Condition()
+        self._reaper: asyncio.Task | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connect_failures = 0
+
+    @classmethod
+    def from_env(cls) -> "SSHConnectionPool":
+        return cls(
+            idle_ttl=env_int("SSH_POOL_IDLE_TTL", 600),
+            max_total=env_int("SSH_POOL_MAX_TOTAL", 1024),
+            max_per_host=env_int("SSH_POOL_MAX_PER_HOST", 4),
+            max_sessions=env_int("SSH_POOL_MAX_SESSIONS", 8),
+        )
+
+    # ── Acquire / release ──────────────────────────────────────────────────
+    async def acquire(self, host: str, username: str, password: str, *,
+                      port: int = 22, connect_timeout: float = 10,
+                      **connect_kwargs) -> asyncssh.SSHClientConnection:
+        """Return a connection with a free session slot, opening one if needed.
+
+        Every successful call must be paired with :meth:`release`.
+        Connection errors from ``asyncssh.connect`` propagate unchanged.
+        """
+        key = (host, port, username, credential_fingerprint(password))
+        self._ensure_reaper()
+
+        async with self._cond:
+            while True:
+                entry = self._pick(key)
+                if entry is not None:
+                    entry.leases += 1
+                    entry.last_used = time.monotonic()
+                    self._idle.pop(id(entry.conn), None)
+                    self.hits += 1
+                    return entry.conn
+                # One handshake per key at a time; the others reuse its result.
+                if not self._pending_keys.get(key) and self._can_open(host):
+                    break
+                if not self._pending_keys.get(key) and self._evict_one(host):
+                    continue
+                await self._cond.wait()
+
+            self.misses += 1
+            self._pending_keys[key] = self._pending_keys.get(key, 0) + 1
+            self._pending_hosts[host] = self._pending_hosts.get(host, 0) + 1
+            self._pending_total += 1
+
+        conn = None
+        try:
+            conn = await asyncssh.connect(
+                host,
+                port=port,
+                username=username,
+                password=password,
+                known_hosts=None,
+                connect_timeout=connect_timeout,
+                keepalive_interval=self.keepalive_interval,
+                **connect_kwargs,
+            )
+        finally:
+            async with self._cond:
+                self._pending_total -= 1
+                self._decrement(self._pending_keys, key)
+                self._decrement(self._pending_hosts, host)
+                if conn is None:
+                    self.connect_failures += 1
+                else:
+                    entry = _Entry(key, conn)
+                    entry.leases = 1
+                    self._entries.setdefault(key, []).append(entry)
+                    self._by_conn[id(conn)] = entry
+                    self._host_counts[host] = self._host_counts.get(host, 0) + 1
+                self._cond.notify_all()
+        return conn
+
+    async def release(self, conn: asyncssh.SSHClientConnection, *, discard: bool = False) -> None:
+        """Return a lease. ``discard=True`` closes the connection once unused."""
+        async with self._cond:
+            entry = self._by_conn.get(id(conn))
+            if entry is None or entry.conn is not conn:
+                # Not ours (or already evicted): just make sure it goes away.
+                self._close(conn)
+                return
+            entry.leases = max(0, entry.leases - 1)
+            entry.last_used = time.monotonic()
+            if discard:
+                entry.retired = True
+            if entry.retired or not entry.is_alive():
+                if entry.leases == 0:
+                    self._remove(entry)
+                    self._close(conn)
+                else:
+                    # Stop handing it out; the remaining holders finish normally.
+                    self._forget(entry)
+            elif entry.leases == 0:
+                self._idle[id(conn)] = entry
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def connection(self, host: str, username: str, password: str, **kwargs):
+        """``async with pool.connection(...) as conn`` – acquire and release."""
+        conn = await self.acquire(host, username, password, **kwargs)
+        broken = False
+        try:
+            yield conn
+        except (asyncssh.ChannelOpenError, asyncssh.ConnectionLost, ConnectionError):
+            broken = True
+            raise
+        finally:
+            await self.release(conn, discard=broken)
+
+    # ── Internals ──────────────────────────────────────────────────────────
+    def _pick(self, key: tuple) -> _Entry | None:
+        best = None
+        for entry in list(self._entries.get(key, ())):
+            if not entry.is_alive():
+                if entry.leases == 0:
+                    self._remove(entry)
+                continue
+            if entry.leases < self.max_sessions and (best is None or entry.leases < best.leases):
+                best = entry
+        return best
+
+    def _can_open(self, host: str) -> bool:
+        per_host = self._host_counts.get(host, 0) + self._pending_hosts.get(host, 0)
+        total = len(self._by_conn) + self._pending_total
+        return per_host < self.max_per_host and total < self.max_total
+
+    def _evict_one(self, host: str) -> bool:
+        """Close the least recently used idle connection that frees a slot."""
+        host_full = (self._host_counts.get(host, 0) + self._pending_hosts.get(host, 0)) >= self.max_per_host
+        for conn_id, entry in self._idle.items():
+            if host_full and entry.host != host:
+                continue
+            self._remove(entry)
+            self._close(entry.conn)
+            self.evictions += 1
+            return True
+        return False
+
+    def _forget(self, entry: _Entry) -> None:
+        """Drop an entry from lookup tables so it is never picked again."""
+        bucket = self._entries.get(entry.key)
+        if bucket and entry in bucket:
+            bucket.remove(entry)
+            if not bucket:
+                del self._entries[entry.key]
+        self._idle.pop(id(entry.conn), None)
+
+    def _remove(self, entry: _Entry) -> None:
+        self._forget(entry)
+        if self._by_conn.pop(id(entry.conn), None) is not None:
+            self._decrement(self._host_counts, entry.host)
+
+    @staticmethod
+    def _decrement(counts: dict, key) -> None:
+        left = counts.get(key, 0) - 1
+        if left > 0:
+            counts[key] = left
+        else:
+            counts.pop(key, None)
+
+    @staticmethod
+    def _close(conn) -> None:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug("Error closing pooled SSH connection: %s", e)
+
+    def _ensure_reaper(self) -> None:
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_idle())
+
+    async def _reap_idle(self) -> None:
+        interval = min(30.0, self.idle_ttl / 2)
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = time.monotonic() - self.idle_ttl
+            async with self._cond:
+                expired = [e for e in self._idle.values()
+                           if e.last_used < cutoff or not e.is_alive()]
+                for entry in expired:
+                    self._remove(entry)
+                    self._close(entry.conn)
+                    self.evictions += 1
+                if expired:
+                    logger.info("Evicted %d idle SSH connection(s)", len(expired))
+                    self._cond.notify_all()
+
+    def has_connection(self, host: str) -> bool:
+        """Whether a pooled connection to ``host`` is open (for any user)."""
+        return self._host_counts.get(host, 0) > 0
+
+    # ── Monitoring ─────────────────────────────────────────────────────────
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "connect_failures": self.connect_failures,
+            "open_connections": len(self._by_conn),
+            "idle_connections": len(self._idle),
+            "active_leases": sum(e.leases for e in self._by_conn.values()),
+            "pending_connects": self._pending_total,
+            "hosts": len(self._host_counts),
+            "limits": {
+                "idle_ttl": self.idle_ttl,
+                "max_total": self.max_total,
+                "max_per_host": self.max_per_host,
+                "max_sessions": self.max_sessions,
+            },
+        }
+
+
+pool = SSHConnectionPool.from_env()
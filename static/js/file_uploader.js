@@ -60,6 +60,10 @@ if (uploadBtn) {
     formData.append("hosts", JSON.stringify(hosts));
     formData.append("file", fileValue);
     formData.append("remote_path", remotePathValue);
+    const concurrency = document.getElementById("uploadConcurrency");
+    if (concurrency && concurrency.value) formData.append("concurrency", concurrency.value);
+    const maxRate = document.getElementById("uploadMaxRate");
+    if (maxRate && maxRate.value) formData.append("max_mb_per_sec", maxRate.value);
 
     const res = await fetch("/upload_file", {
       method: "POST",
@@ -71,25 +75,50 @@ if (uploadBtn) {
       return;
     }
 
-    // STEP 2: Start streaming the upload logs
+    // STEP 2: Stream the upload log; progress and summary come as named events
     const stream = res.body.getReader();
     const decoder = new TextDecoder();
+    const progressLines = {};
+    let buffer = "";
 
     while (true) {
       const { value, done } = await stream.read();
       if (done) break;
-      const chunk = decoder.decode(value, { stream: true });
+      buffer += decoder.decode(value, { stream: true });
+      const frames = buffer.split("\n\n");
+      buffer = frames.pop();
 
-      chunk.split("\n\n").forEach(line => {
-        if (line.startsWith("data: ")) {
-          output.textContent += line.slice(6) + "\n";
-          output.scrollTop = output.scrollHeight;
+      frames.forEach(frame => {
+        if (frame.startsWith("event: progress\n")) {
+          const msg = JSON.parse(frame.slice(frame.indexOf("data: ") + 6));
+          msg.hosts.forEach(p => showUploadProgress(output, progressLines, p));
+        } else if (frame.startsWith("data: ")) {
+          appendUploadLine(output, frame.slice(6));
         }
       });
     }
   });
 }
 
+function appendUploadLine(output, text) {
+  output.appendChild(document.createTextNode(text + "\n"));
+  output.scrollTop = output.scrollHeight;
+}
+
+// One line per host, rewritten in place as its transfer moves
+function showUploadProgress(output, lines, p) {
+  let line = lines[p.host];
+  if (!line) {
+    line = lines[p.host] = document.createElement("span");
+    output.appendChild(line);
+  }
+  const mb = n => (n / 1048576).toFixed(1);
+  const pct = p.total ? Math.floor(p.sent * 100 / p.total) : 100;
+  const eta = p.eta_sec == null ? "" : `, ETA ${Math.ceil(p.eta_sec)}s`;
+  line.textContent = `[${p.host}] ⏫ ${mb(p.sent)}/${mb(p.total)} MB (${pct}%) at ${mb(p.rate)} MB/s${eta}\n`;
+  output.scrollTop = output.scrollHeight;
+}
+
 function expandRange(rangeStr) {
   const match = rangeStr.match(/(\d+\.\d+\.\d+\.)(\d+)-(\d+)/);
   if (!match) return [rangeStr];
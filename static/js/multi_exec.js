@@ -4,6 +4,15 @@ const hostViews = new Map();
 let summary = { total: 0, started: 0, success: 0, failure: 0 };
 let userStopped = false;
 let lastResults = {};
+let concurrencyText = '';
+// Clustering mode: one view per distinct result instead of one per host
+let clusterMode = false;
+const clusterViews = new Map();
+// Detached job this page is following; it keeps running if the socket drops
+const JOB_KEY = 'multiExecJob';
+let jobId = null;
+let lastSeq = -1;
+let jobDone = false;
 
 function showExamples() {
   alert(
@@ -48,29 +57,67 @@ function connect() {
   }
 
   const range = document.getElementById('hostRange').value;
+  const clusterToggle = document.getElementById('clusterOutput');
+  clusterMode = !!(clusterToggle && clusterToggle.checked);
+  const probeToggle = document.getElementById('probeHosts');
+  const probe = !probeToggle || probeToggle.checked;
   const hostsPromise = fileInput.files.length
     ? readFileLines(fileInput.files[0])
     : Promise.resolve([]);
 
   hostsPromise.then(fileLines => {
-    startWebsocket(range, sshUser, sshPass, command, fileLines);
+    startWebsocket(range, sshUser, sshPass, command, fileLines, probe);
   });
 }
 
-function startWebsocket(range, user, pw, cmd, fileLines) {
+function startWebsocket(range, user, pw, cmd, fileLines, probe) {
+  jobId = null;
+  lastSeq = -1;
+  jobDone = false;
+  openSocket(
+    { host_range: range, hosts_file_lines: fileLines, ssh_user: user, ssh_pass: pw, command: cmd, cluster: clusterMode, probe },
+    `Launching command: ${cmd}`
+  );
+}
+
+// Follow a job from the event after the last one seen (from the start after a reload)
+function resumeJob(id, fromStart) {
+  if (fromStart) {
+    clearOutput();
+    lastSeq = -1;
+  }
+  jobId = id;
+  jobDone = false;
+  busy = true;
+  setButtonsState(true);
+  openOutputPanel();
+  openSocket({ job_id: id, offset: lastSeq + 1 }, `Reattaching to job ${id}…`);
+}
+
+function openSocket(first, note) {
   ws = new WebSocket(`ws://${location.host}/ws`);
 
   ws.onopen = () => {
-    appendSystem(`Launching command: ${cmd}`);
-    ws.send(JSON.stringify({ host_range: range, hosts_file_lines: fileLines, ssh_user: user, ssh_pass: pw, command: cmd }));
+    appendSystem(note);
+    ws.send(JSON.stringify(first));
   };
 
   ws.onmessage = evt => {
     const msg = JSON.parse(evt.data);
+    if (typeof msg.seq === 'number') {
+      if (msg.seq <= lastSeq) return; // already applied before a reattach
+      lastSeq = msg.seq;
+    }
     handleMessage(msg);
   };
 
   ws.onclose = () => {
+    if (jobId && !jobDone && !userStopped) {
+      // The job is still running server-side: pick up where we left off
+      appendSystem('Connection lost; reattaching…');
+      setTimeout(() => { if (!jobDone) resumeJob(jobId, false); }, 1000);
+      return;
+    }
     appendSystem('Execution stopped.');
     busy = false;
     setButtonsState(false);
@@ -90,6 +137,15 @@ function startWebsocket(range, user, pw, cmd, fileLines) {
 
 function stopAll() {
   userStopped = true;
+  if (jobId && !jobDone) {
+    // Stop the job itself; its summary still arrives over the socket
+    if (ws && ws.readyState === WebSocket.OPEN) {
+      try { ws.send(JSON.stringify({ type: 'cancel' })); } catch {}
+    } else {
+      fetch(`/api/multi_exec/jobs/${jobId}/cancel`, { method: 'POST' }).catch(() => {});
+    }
+    return;
+  }
   if (ws) try { ws.close(); } catch {}
 }
 
@@ -115,7 +171,8 @@ function ensureHostView(host) {
 
   section.append(header, pre);
   container.append(section);
-  const view = { section, header, title, status, pre };
+  // openStream: stream whose last line has not ended yet (output arrives in chunks)
+  const view = { section, header, title, status, pre, openStream: null };
   hostViews.set(host, view);
   return view;
 }
@@ -161,24 +218,171 @@ function setStatus(host, stage, extra) {
   }
 }
 
-function appendHostOutput(host, stream, data) {
+function appendHostOutput(host, stream, data, now) {
   const view = ensureHostView(host);
-  const now = new Date().toLocaleTimeString();
-  if (stream === 'stderr' && (!data || data.trim() === '')) {
+  if (!data) return;
+  if (stream === 'stderr' && view.openStream !== 'stderr' && data.trim() === '') {
     return; // skip empty stderr chunks to avoid stray ERR> lines
   }
-  const prefix = stream === 'stderr' ? 'ERR> ' : '';
+  now = now || new Date().toLocaleTimeString();
+  const prefix = `[${now}] ${stream === 'stderr' ? 'ERR> ' : ''}`;
+  // Chunks may start or end mid-line: only prefix lines that start here
+  let text = '';
+  if (view.openStream && view.openStream !== stream) text += '\n';
+  const lines = data.split('\n');
+  lines.forEach((line, i) => {
+    const last = i === lines.length - 1;
+    if (last && line === '') return;
+    const continues = i === 0 && view.openStream === stream;
+    text += (continues ? '' : prefix) + line + (last ? '' : '\n');
+  });
+  view.openStream = data.endsWith('\n') ? null : stream;
   // Keep as a single text node append to reduce DOM churn
-  view.pre.append(document.createTextNode(`[${now}] ${prefix}${data}`));
+  view.pre.append(document.createTextNode(text));
+}
+
+function clusterLabel(cluster) {
+  if (cluster.error) return 'Connect failed';
+  if (cluster.ok) return 'Success';
+  return cluster.exit_status === null || cluster.exit_status === undefined ? 'Failed' : `Exit ${cluster.exit_status}`;
+}
+
+function ensureClusterView(cluster) {
+  if (clusterViews.has(cluster.id)) return clusterViews.get(cluster.id);
+  const section = document.createElement('section');
+  section.className = 'host-section cluster-section';
+
+  const header = document.createElement('div');
+  header.className = 'host-header';
+  const title = document.createElement('span');
+  title.className = 'host-title';
+  const status = document.createElement('span');
+  status.className = `host-status badge ${cluster.ok ? 'status-ok' : (cluster.error ? 'status-error' : 'status-failed')}`;
+  status.textContent = clusterLabel(cluster);
+  header.append(title, status);
+
+  // Host names as one growing text node; collapsed by default
+  const details = document.createElement('details');
+  details.className = 'cluster-hosts';
+  const label = document.createElement('summary');
+  label.textContent = 'Hosts';
+  const list = document.createElement('div');
+  list.className = 'cluster-host-list';
+  details.append(label, list);
+
+  const pre = document.createElement('pre');
+  pre.className = 'host-output';
+  let text = cluster.stdout || '';
+  if (cluster.stderr) {
+    if (text && !text.endsWith('\n')) text += '\n';
+    text += cluster.stderr.replace(/\n$/, '').split('\n').map(l => `ERR> ${l}`).join('\n') + '\n';
+  }
+  if (cluster.error) text += `ERR> ${cluster.error}\n`;
+  if (cluster.truncated) text += `[output truncated: ${cluster.stdout_bytes + cluster.stderr_bytes} chars in total]\n`;
+  pre.textContent = text || '(no output)';
+
+  section.append(header, details, pre);
+  document.getElementById('output').append(section);
+  const view = { section, title, list, ok: !!cluster.ok, hosts: [] };
+  clusterViews.set(cluster.id, view);
+  return view;
+}
+
+function addClusterHosts(view, hosts) {
+  if (!hosts || !hosts.length) return;
+  const sep = view.hosts.length ? ', ' : '';
+  view.hosts.push(...hosts);
+  view.list.append(document.createTextNode(sep + hosts.join(', ')));
+  view.title.textContent = view.hosts.length === 1 ? view.hosts[0] : `${view.hosts.length} hosts`;
+}
+
+function applyClusters(msg) {
+  (msg.new || []).forEach(cluster => addClusterHosts(ensureClusterView(cluster), cluster.hosts));
+  Object.entries(msg.joined || {}).forEach(([id, hosts]) => {
+    const view = clusterViews.get(Number(id));
+    if (view) addClusterHosts(view, hosts);
+  });
+}
+
+function formatSize(bytes) {
+  if (bytes < 1024) return `${bytes} B`;
+  if (bytes < 1048576) return `${(bytes / 1024).toFixed(1)} KiB`;
+  return `${(bytes / 1048576).toFixed(1)} MiB`;
+}
+
+// A long output's middle stays on the server: a marker that loads it on demand, then the tail
+function appendOutputRest(msg) {
+  const view = ensureHostView(msg.host);
+  if (msg.omitted > 0) {
+    if (view.openStream) view.pre.append(document.createTextNode('\n'));
+    view.openStream = null;
+    const gap = document.createElement('span');
+    gap.className = 'output-gap';
+    const button = document.createElement('button');
+    button.type = 'button';
+    button.textContent = `… ${formatSize(msg.omitted)} of ${msg.stream} not shown, load`;
+    button.onclick = () => loadOmitted(msg, gap, button);
+    const link = document.createElement('a');
+    link.href = msg.url;
+    link.target = '_blank';
+    link.textContent = 'full output';
+    gap.append(button, ' · ', link, '\n');
+    view.pre.append(gap);
+  }
+  appendHostOutput(msg.host, msg.stream, msg.data);
+}
+
+const OMITTED_CHUNK = 1048576;
+
+async function loadOmitted(msg, gap, button) {
+  // One byte range per click, inserted in place of the marker
+  const end = msg.omitted_from + msg.omitted;
+  const upto = Math.min(end, msg.omitted_from + OMITTED_CHUNK);
+  button.disabled = true;
+  try {
+    const res = await fetch(msg.url, { headers: { Range: `bytes=${msg.omitted_from}-${upto - 1}` } });
+    if (!res.ok) throw new Error(res.status);
+    gap.before(document.createTextNode(await res.text()));
+  } catch (err) {
+    button.textContent = `Could not load output (${err.message})`;
+    return;
+  }
+  msg.omitted_from = upto;
+  msg.omitted = end - upto;
+  if (msg.omitted > 0) {
+    button.textContent = `… ${formatSize(msg.omitted)} more, load`;
+    button.disabled = false;
+  } else {
+    gap.remove();
+  }
+}
+
+function appendOutputBatch(chunks) {
+  const now = new Date().toLocaleTimeString();
+  (chunks || []).forEach(c => appendHostOutput(c.host, c.stream, c.data, now));
 }
 
 function handleMessage(msg) {
   if (msg.type === 'init') {
+    if (msg.job_id) {
+      jobId = msg.job_id;
+      clusterMode = !!msg.cluster;
+      try { localStorage.setItem(JOB_KEY, jobId); } catch {}
+    }
     summary = { total: msg.total_hosts || 0, started: 0, success: 0, failure: 0 };
     appendSystem(`Dispatching to ${msg.total_hosts} host(s)…`);
     updateSummaryBadge();
     return;
   }
+  if (msg.type === 'targets') {
+    // Exact count once the host expression is read to the end (init had an upper bound)
+    if (msg.total_hosts !== summary.total) {
+      appendSystem(`Target hosts: ${msg.total_hosts} after duplicates and exclusions`);
+    }
+    summary.total = msg.total_hosts;
+    recomputeSummary();
+    return;
+  }
   if (msg.type === 'host_status') {
     setStatus(msg.host, msg.stage, msg);
     if (msg.stage === 'connected') {
@@ -195,11 +399,49 @@ function handleMessage(msg) {
     appendHostOutput(msg.host, msg.stream, msg.data);
     return;
   }
+  if (msg.type === 'clusters') {
+    // Identical results grouped: "N hosts → this output"
+    applyClusters(msg);
+    recomputeSummary();
+    return;
+  }
+  if (msg.type === 'output_batch') {
+    // Many hosts' output since the last tick, in one frame
+    appendOutputBatch(msg.chunks);
+    return;
+  }
+  if (msg.type === 'output_rest') {
+    appendOutputRest(msg);
+    return;
+  }
+  if (msg.type === 'concurrency') {
+    // Live adaptive limits: in flight / current limit per stage
+    concurrencyText = ` · Connect ${msg.connect.in_flight}/${msg.connect.limit} · Exec ${msg.exec.in_flight}/${msg.exec.limit}`;
+    recomputeSummary();
+    return;
+  }
   if (msg.type === 'summary') {
-    appendSystem(`Summary: total=${msg.total_hosts}, started=${msg.started}, success=${msg.success}, failure=${msg.failure}, duration=${msg.duration_sec}s`);
+    appendSystem(`Summary: total=${msg.total_hosts}, started=${msg.started}, success=${msg.success}, failure=${msg.failure}${msg.unreachable ? ` (${msg.unreachable} unreachable)` : ""}, duration=${msg.duration_sec}s${msg.cancelled ? " (cancelled)" : ""}`);
+    if (msg.concurrency) {
+      appendSystem(`Concurrency: ${describeLimit('connect', msg.concurrency.connect)}; ${describeLimit('exec', msg.concurrency.exec)}`);
+      concurrencyText = '';
+    }
+    if (msg.clustering) {
+      const c = msg.clustering;
+      appendSystem(`Clusters: ${c.clusters} distinct result(s) across ${c.hosts} host(s); largest ${c.largest} host(s), ${c.outliers} outlier(s)`);
+      // Largest groups first, outliers last
+      const output = document.getElementById('output');
+      (msg.clusters || []).forEach(c => {
+        const view = clusterViews.get(c.id);
+        if (view) output.append(view.section);
+      });
+    }
+    if (msg.output && msg.output.frames) {
+      appendSystem(`Output: ${msg.output.bytes} chars in ${msg.output.frames} frame(s), ${msg.output.chunks_per_frame} host chunk(s) per frame`);
+    }
     summary = { total: msg.total_hosts, started: msg.started, success: msg.success, failure: msg.failure };
     // Reconcile any hosts that didn't receive a final completed event
-    if (msg.results && typeof msg.results === 'object') {
+    if (msg.results && typeof msg.results === 'object' && !clusterMode) {
       lastResults = msg.results || {};
       Object.entries(msg.results).forEach(([host, res]) => {
         const view = ensureHostView(host);
@@ -213,6 +455,8 @@ function handleMessage(msg) {
     return;
   }
   if (msg.type === 'done') {
+    jobDone = true;
+    try { if (localStorage.getItem(JOB_KEY) === jobId) localStorage.removeItem(JOB_KEY); } catch {}
     // Final guard: if any host is still pending but we have a result, apply it
     if (msg.results && typeof msg.results === 'object') {
       lastResults = msg.results || lastResults || {};
@@ -231,10 +475,22 @@ function handleMessage(msg) {
   }
   if (msg.type === 'error') {
     appendSystem(`Error: ${msg.message || 'unknown error'}`);
+    if (msg.message === 'Job not found') {
+      jobDone = true;
+      try { localStorage.removeItem(JOB_KEY); } catch {}
+    }
     return;
   }
 }
 
+function describeLimit(name, stats) {
+  const path = (stats.history || []).map(p => p.limit)
+    .filter((limit, i, all) => i === 0 || limit !== all[i - 1]);
+  const shown = path.length > 8 ? [...path.slice(0, 4), '…', ...path.slice(-3)] : path;
+  return `${name} limit ${shown.join('→')} (peak ${stats.peak_in_flight} in flight, `
+    + `${stats.decreases} backoff(s), ${stats.errors} error(s))`;
+}
+
 function updateSummaryBadge() {
   const el = document.getElementById('output-summary');
   if (!el) return;
@@ -248,9 +504,12 @@ function updateSummaryBadge() {
       if (stage === 'connect_failed' || stage === 'error') fail++;
     }
   });
+  clusterViews.forEach(view => {
+    if (view.ok) ok += view.hosts.length; else fail += view.hosts.length;
+  });
   const total = summary.total || hostViews.size || 0;
   const remaining = Math.max(0, total - (ok + fail));
-  el.textContent = `OK ${ok} · Fail ${fail} · Pending ${remaining}`;
+  el.textContent = `OK ${ok} · Fail ${fail} · Pending ${remaining}${concurrencyText}`;
 }
 
 function filterOutput() {
@@ -263,6 +522,8 @@ function filterOutput() {
 function clearOutput() {
   document.getElementById('output').innerHTML = '';
   hostViews.clear();
+  clusterViews.clear();
+  concurrencyText = '';
 }
 
 // New: robust summary recomputation
@@ -279,9 +540,12 @@ function recomputeSummary() {
       if (stage === 'connect_failed' || stage === 'error') fail++;
     }
   });
+  clusterViews.forEach(view => {
+    if (view.ok) ok += view.hosts.length; else fail += view.hosts.length;
+  });
   const total = summary.total || hostViews.size || 0;
   const remaining = Math.max(0, total - (ok + fail));
-  el.textContent = `OK ${ok} · Fail ${fail} · Pending ${remaining}`;
+  el.textContent = `OK ${ok} · Fail ${fail} · Pending ${remaining}${concurrencyText}`;
 }
 
 function readFileLines(file) {
@@ -343,5 +607,9 @@ document.addEventListener('DOMContentLoaded', () => {
   // Only set button states if we're on the right page
   if (runBtn && stopBtn) {
     setButtonsState(false);
+    // A run started before a reload is still going (or finished meanwhile): show it
+    let pending = null;
+    try { pending = localStorage.getItem(JOB_KEY); } catch {}
+    if (pending) resumeJob(pending, true);
   }
 });
\ No newline at end of file
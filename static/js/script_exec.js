@@ -58,6 +58,112 @@ function exportScriptLog() {
 }
 
 let scriptController;
+const scriptHosts = new Map();
+
+function formatSize(bytes) {
+  if (bytes >= 1048576) return (bytes / 1048576).toFixed(1) + ' MB';
+  if (bytes >= 1024) return (bytes / 1024).toFixed(1) + ' KB';
+  return bytes + ' B';
+}
+
+function appendScriptLine(text) {
+  const outputEl = document.getElementById('scriptOutput');
+  outputEl.appendChild(document.createTextNode(text + '\n'));
+  outputEl.scrollTop = outputEl.scrollHeight;
+}
+
+// One block per host: a header line with its current stage, then its output
+function scriptHostBlock(host) {
+  let block = scriptHosts.get(host);
+  if (block) return block;
+  const outputEl = document.getElementById('scriptOutput');
+  const header = document.createElement('span');
+  header.className = 'script-host-header';
+  const stage = document.createElement('span');
+  header.append(`[${host}] `, stage, '\n');
+  const body = document.createElement('span');
+  outputEl.append(header, body);
+  block = { stage, body };
+  scriptHosts.set(host, block);
+  return block;
+}
+
+function describeStage(msg) {
+  const took = msg.duration_sec !== undefined ? ` in ${msg.duration_sec}s` : '';
+  switch (msg.stage) {
+    case 'connecting': return 'connecting...';
+    case 'uploading': return 'uploading script...';
+    case 'command_started': return 'running...';
+    case 'completed': return `${msg.ok ? 'OK' : 'FAILED'} exit ${msg.exit_status}${took}`;
+    case 'connect_failed': return `CONNECT FAILED: ${msg.error}`;
+    case 'skipped': return `SKIPPED: ${msg.error}`;
+    case 'failed': return `FAILED: ${msg.error}`;
+    default: return msg.stage;
+  }
+}
+
+function appendScriptOutput(host, stream, data) {
+  const block = scriptHostBlock(host);
+  if (stream === 'stderr') {
+    const span = document.createElement('span');
+    span.className = 'script-stderr';
+    span.textContent = data;
+    block.body.appendChild(span);
+  } else {
+    block.body.appendChild(document.createTextNode(data));
+  }
+}
+
+function appendScriptRest(msg) {
+  const block = scriptHostBlock(msg.host);
+  if (msg.omitted) {
+    const gap = document.createElement('span');
+    gap.className = 'output-gap';
+    const link = document.createElement('a');
+    link.href = msg.url;
+    link.target = '_blank';
+    link.textContent = 'full output';
+    gap.append(`\n[... ${formatSize(msg.omitted)} of ${msg.stream} omitted, `, link, ' ...]\n');
+    block.body.appendChild(gap);
+  }
+  appendScriptOutput(msg.host, msg.stream, msg.data);
+}
+
+function handleScriptEvent(msg) {
+  const outputEl = document.getElementById('scriptOutput');
+  switch (msg.type) {
+    case 'init':
+      appendScriptLine(`[SYSTEM] Running ${msg.script} on ${msg.total_hosts} host(s), ${msg.concurrency} at a time (${msg.mode} mode)`);
+      break;
+    case 'host_status':
+      scriptHostBlock(msg.host).stage.textContent = describeStage(msg);
+      break;
+    case 'output_batch':
+      msg.chunks.forEach(ch => appendScriptOutput(ch.host, ch.stream, ch.data));
+      outputEl.scrollTop = outputEl.scrollHeight;
+      break;
+    case 'output_rest':
+      appendScriptRest(msg);
+      break;
+    case 'summary': {
+      appendScriptLine('\n[SYSTEM] Summary');
+      Object.entries(msg.results).forEach(([host, r]) => {
+        const status = r.ok ? 'OK' : (r.error ? `FAILED (${r.error})` : 'FAILED');
+        const exit = r.exit_status === null ? '-' : r.exit_status;
+        appendScriptLine(`  ${host.padEnd(20)} exit ${String(exit).padEnd(4)} ${String(r.duration_sec).padStart(7)}s  ${status}`);
+      });
+      appendScriptLine(`[SYSTEM] ${msg.success} succeeded, ${msg.failure} failed` +
+        (msg.unreachable ? ` (${msg.unreachable} unreachable)` : '') + ` in ${msg.duration_sec}s`);
+      const steps = Object.entries(msg.stage_avg_sec || {}).map(([stage, sec]) => `${stage} ${sec}s`);
+      if (steps.length) appendScriptLine(`[SYSTEM] Mean per host: ${steps.join(', ')}`);
+      const cache = msg.artifact_cache;
+      if (cache && cache.hits + cache.misses) {
+        appendScriptLine(`[SYSTEM] Host cache: ${cache.hits} hit(s), ${cache.misses} miss(es), ${formatSize(cache.bytes_saved)} not sent`);
+      }
+      break;
+    }
+  }
+}
 
 // Handle upload and run with abort capability
 async function uploadAndRun() {
@@ -68,6 +174,7 @@ async function uploadAndRun() {
   }
   
   outputEl.textContent = '[SYSTEM] Starting script execution...\n';
+  scriptHosts.clear();
   scriptController = new AbortController();
 
   try {
@@ -111,13 +218,25 @@ async function uploadAndRun() {
       throw new Error(`Server error: ${err}`);
     }
 
-    const log = await res.text();
-    outputEl.textContent += log;
+    // Server-sent events: stages and output arrive while the hosts run
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const frames = buffer.split('\n\n');
+      buffer = frames.pop();
+      frames.forEach(frame => {
+        if (frame.startsWith('data: ')) handleScriptEvent(JSON.parse(frame.slice(6)));
+      });
+    }
   } catch (err) {
     if (err.name === 'AbortError') {
-      outputEl.textContent += '[SYSTEM] Script execution aborted.\n';
+      appendScriptLine('[SYSTEM] Script execution aborted.');
     } else {
-      outputEl.textContent += `[ERROR] ${err.message}\n`;
+      appendScriptLine(`[ERROR] ${err.message}`);
     }
   }
 }
@@ -0,0 +1,187 @@
+// Terminal transport: many terminals share one multiplexed WebSocket.
+//
+// TermMux.connect(hostId, { cols, rows }) returns a WebSocket-like object
+// (readyState, send, close, onopen/onmessage/onclose/onerror) plus
+// resize(cols, rows), so existing xterm wiring keeps working unchanged.
+// Terminal output arrives as Uint8Array (status lines as strings); both can
+// be passed straight to term.write(). With { flow: true } the server pauses
+// output until the page acks what it has rendered:
+//   term.write(e.data, () => socket.ack(e.data));
+// Adding { screen: true } lets the server send repaints of the current screen
+// instead of the backlog when the terminal falls behind an output flood.
+//
+// The shell lives in a server-side session. If the shared socket drops, the
+// terminal reattaches to it and receives the output it missed. With
+// { resumeKey: '...' } the session also survives a reload of this tab; the
+// fresh xterm then gets the server's whole scrollback replayed.
+
+(function (global) {
+  const CONNECTING = 0, OPEN = 1, CLOSING = 2, CLOSED = 3;
+  const RECONNECT_ATTEMPTS = 5;
+  let port = null;
+  let nextId = 1;
+  const sockets = new Map();
+
+  function getPort() {
+    if (port) return port;
+    if (typeof SharedWorker !== 'undefined') {
+      try {
+        const worker = new SharedWorker('/static/js/term_mux_worker.js', { name: 'terminalx-mux' });
+        port = worker.port;
+      } catch (e) {
+        console.warn('SharedWorker unavailable, using in-page terminal mux', e);
+      }
+    }
+    if (!port) {
+      // Fallback: same hub, running inside this page over a MessageChannel
+      const channel = new MessageChannel();
+      const hub = global.__termMuxHub || (global.__termMuxHub = new TermMuxHub(location.origin));
+      hub.attach(channel.port2);
+      port = channel.port1;
+    }
+    port.onmessage = evt => onHubMessage(evt.data || {});
+    if (port.start) port.start();
+    global.addEventListener('pagehide', () => {
+      sockets.forEach(sock => sock._leave());
+      try { port.postMessage({ op: 'detach' }); } catch {}
+    });
+    return port;
+  }
+
+  function onHubMessage(msg) {
+    if (msg.op === 'ping') { port.postMessage({ op: 'pong' }); return; }
+    const sock = sockets.get(msg.id);
+    if (!sock) return;
+    if (msg.op === 'opened') {
+      // A reattach stays CONNECTING until its 'session' frame arrives
+      if (sock.readyState === CONNECTING && !sock.session) {
+        sock.readyState = OPEN;
+        if (sock.onopen) sock.onopen({ type: 'open' });
+      }
+    } else if (msg.op === 'session') {
+      sock._attached(msg);
+    } else if (msg.op === 'data') {
+      if (typeof msg.data !== 'string') sock.offset += msg.data.byteLength;
+      if (sock.onmessage) sock.onmessage({ type: 'message', data: msg.data });
+    } else if (msg.op === 'closed') {
+      if (msg.reason === 'disconnected' && sock._reconnect()) return;
+      sock._forget();
+      sock._finish(msg.reason === 'disconnected' ? 1006 : 1000, msg.reason || '');
+    }
+  }
+
+  function storageKey(resumeKey) {
+    return 'termmux:' + resumeKey;
+  }
+
+  class MuxSocket {
+    constructor(hostId, opts) {
+      opts = opts || {};
+      this.id = nextId++;
+      this.hostId = hostId;
+      this.readyState = CONNECTING;
+      this.flow = !!opts.flow;
+      this.screen = !!opts.screen;
+      this.cols = opts.cols || null;
+      this.rows = opts.rows || null;
+      this.resumeKey = opts.resumeKey || null;
+      this.session = null;
+      this.offset = 0;     // stream offset of the next output byte
+      this.acked = 0;      // output bytes rendered since the last attach
+      this.attempts = 0;
+      this.onopen = this.onmessage = this.onclose = this.onerror = null;
+      sockets.set(this.id, this);
+
+      let saved = null;
+      if (this.resumeKey) {
+        try { saved = sessionStorage.getItem(storageKey(this.resumeKey)); } catch {}
+      }
+      this._open(saved, 0);
+    }
+
+    _open(session, offset) {
+      getPort().postMessage({
+        op: 'open', id: this.id, hostId: Number(this.hostId),
+        cols: this.cols, rows: this.rows, flow: this.flow, screen: this.screen,
+        session: session || null, offset: offset || 0
+      });
+    }
+
+    _attached(msg) {
+      this.session = msg.session;
+      this.offset = msg.offset || 0;
+      this.acked = 0;
+      this.attempts = 0;
+      if (this.readyState === CONNECTING) this.readyState = OPEN;
+    }
+
+    // The shared socket dropped: reattach to the same session with backoff
+    _reconnect() {
+      if (!this.session || this.readyState >= CLOSING || this.attempts >= RECONNECT_ATTEMPTS) return false;
+      if (this.attempts === 0 && this.onmessage) {
+        this.onmessage({ type: 'message', data: '\r\n*** 🔄 Connection lost, reconnecting... ***\r\n' });
+      }
+      const delay = 1000 * Math.pow(2, this.attempts++);
+      this.readyState = CONNECTING;
+      setTimeout(() => {
+        if (this.readyState === CONNECTING) this._open(this.session, this.offset);
+      }, delay);
+      return true;
+    }
+
+    // Page is going away: resumable terminals detach, the rest close
+    _leave() {
+      if (this.readyState >= CLOSING) return;
+      if (this.resumeKey && this.session) {
+        try { sessionStorage.setItem(storageKey(this.resumeKey), this.session); } catch {}
+        port.postMessage({ op: 'detach', id: this.id });
+      } else {
+        port.postMessage({ op: 'close', id: this.id });
+      }
+    }
+
+    _forget() {
+      if (!this.resumeKey) return;
+      try { sessionStorage.removeItem(storageKey(this.resumeKey)); } catch {}
+    }
+
+    send(data) {
+      if (this.readyState !== OPEN) return;
+      port.postMessage({ op: 'data', id: this.id, data });
+    }
+
+    // Ack rendered output; only binary output counts toward the window.
+    ack(data) {
+      if (this.readyState !== OPEN || !data || typeof data === 'string') return;
+      this.acked += data.byteLength;
+      port.postMessage({ op: 'ack', id: this.id, bytes: this.acked });
+    }
+
+    resize(cols, rows) {
+      if (this.readyState > OPEN || !cols || !rows) return;
+      this.cols = cols;
+      this.rows = rows;
+      port.postMessage({ op: 'resize', id: this.id, cols, rows });
+    }
+
+    close() {
+      if (this.readyState >= CLOSING) return;
+      port.postMessage({ op: 'close', id: this.id });
+      this._forget();
+      this._finish(1000, 'closed');
+    }
+
+    _finish(code, reason) {
+      if (this.readyState === CLOSED) return;
+      const failed = this.readyState === CONNECTING && !this.session;
+      this.readyState = CLOSED;
+      sockets.delete(this.id);
+      if (failed && this.onerror) this.onerror({ type: 'error' });
+      if (this.onclose) this.onclose({ type: 'close', code, reason });
+    }
+  }
+
+  global.TermMux = {
+    connect(hostId, opts) { return new MuxSocket(hostId, opts); }
+  };
+})(window);
@@ -0,0 +1,158 @@
+// Terminal multiplexer hub: owns the single /ws/mux WebSocket and routes
+// channel frames to the pages (ports) that opened them.
+//
+// Runs as a SharedWorker so every tab and popup of this origin shares one
+// socket. When SharedWorker is unavailable, term_mux.js loads this file as a
+// regular script and attaches to an in-page hub instead.
+
+class TermMuxHub {
+  constructor(origin) {
+    this.origin = origin;
+    this.ws = null;
+    this.nextCh = 1;
+    this.channels = new Map();   // ch -> { port, id }
+    this.ports = new Map();      // port -> { ids: Map(localId -> ch), lastSeen }
+    this.pending = [];           // frames queued while the socket connects
+    this.heartbeat = null;
+  }
+
+  wsUrl() {
+    const proto = this.origin.startsWith('https:') ? 'wss' : 'ws';
+    return `${proto}://${this.origin.replace(/^https?:\/\//, '')}/ws/mux`;
+  }
+
+  ensureSocket() {
+    if (this.ws && (this.ws.readyState === WebSocket.OPEN || this.ws.readyState === WebSocket.CONNECTING)) {
+      return;
+    }
+    const ws = new WebSocket(this.wsUrl());
+    ws.binaryType = 'arraybuffer';
+    this.ws = ws;
+    ws.onopen = () => {
+      const queued = this.pending;
+      this.pending = [];
+      queued.forEach(frame => ws.send(frame));
+    };
+    ws.onmessage = evt => this.onServerFrame(evt.data);
+    ws.onclose = () => {
+      if (this.ws !== ws) return;
+      this.ws = null;
+      this.pending = [];
+      // Every channel rode on this socket; tell their pages.
+      this.channels.forEach((route, ch) => this.deliver(ch, { op: 'closed', reason: 'disconnected' }));
+      this.channels.clear();
+      this.ports.forEach(state => state.ids.clear());
+    };
+  }
+
+  sendServer(frame) {
+    const text = JSON.stringify(frame);
+    this.ensureSocket();
+    if (this.ws.readyState === WebSocket.OPEN) this.ws.send(text);
+    else this.pending.push(text);
+  }
+
+  onServerFrame(raw) {
+    if (typeof raw !== 'string') {
+      // Terminal output: 4-byte big-endian channel id, then raw bytes
+      if (raw.byteLength < 4) return;
+      const ch = new DataView(raw).getUint32(0);
+      this.deliver(ch, { op: 'data', data: new Uint8Array(raw, 4) }, [raw]);
+      return;
+    }
+    let msg;
+    try { msg = JSON.parse(raw); } catch { return; }
+    if (typeof msg.ch !== 'number') return;
+    if (msg.type === 'data') {
+      this.deliver(msg.ch, { op: 'data', data: msg.data });
+    } else if (msg.type === 'opened') {
+      this.deliver(msg.ch, { op: 'opened' });
+    } else if (msg.type === 'session') {
+      this.deliver(msg.ch, { op: 'session', session: msg.session, offset: msg.offset, resumed: !!msg.resumed });
+    } else if (msg.type === 'closed') {
+      this.deliver(msg.ch, { op: 'closed', reason: msg.reason || '' });
+      this.forget(msg.ch);
+    }
+  }
+
+  deliver(ch, payload, transfer) {
+    const route = this.channels.get(ch);
+    if (!route) return;
+    try { route.port.postMessage(Object.assign({ id: route.id }, payload), transfer || []); } catch {}
+  }
+
+  forget(ch) {
+    const route = this.channels.get(ch);
+    if (!route) return;
+    this.channels.delete(ch);
+    const state = this.ports.get(route.port);
+    if (state) state.ids.delete(route.id);
+  }
+
+  attach(port) {
+    this.ports.set(port, { ids: new Map(), lastSeen: Date.now() });
+    port.onmessage = evt => this.onPortMessage(port, evt.data || {});
+    if (port.start) port.start();
+    this.startHeartbeat();
+  }
+
+  // The page is gone; its sessions stay on the server for the detach grace period
+  detach(port) {
+    const state = this.ports.get(port);
+    if (!state) return;
+    state.ids.forEach(ch => {
+      this.channels.delete(ch);
+      this.sendServer({ type: 'detach', ch });
+    });
+    this.ports.delete(port);
+  }
+
+  onPortMessage(port, msg) {
+    const state = this.ports.get(port);
+    if (!state) return;
+    state.lastSeen = Date.now();
+    if (msg.op === 'pong') return;
+    if (msg.op === 'detach' && msg.id === undefined) { this.detach(port); return; }
+
+    if (msg.op === 'open') {
+      const ch = this.nextCh++;
+      state.ids.set(msg.id, ch);
+      this.channels.set(ch, { port, id: msg.id });
+      this.sendServer({
+        type: 'open', ch, host_id: msg.hostId, cols: msg.cols, rows: msg.rows, flow: !!msg.flow, screen: !!msg.screen,
+        session: msg.session || null, offset: msg.offset || 0
+      });
+      return;
+    }
+    const ch = state.ids.get(msg.id);
+    if (ch === undefined) return;
+    if (msg.op === 'data') {
+      this.sendServer({ type: 'data', ch, data: msg.data });
+    } else if (msg.op === 'ack') {
+      this.sendServer({ type: 'ack', ch, bytes: msg.bytes });
+    } else if (msg.op === 'resize') {
+      this.sendServer({ type: 'resize', ch, cols: msg.cols, rows: msg.rows });
+    } else if (msg.op === 'close' || msg.op === 'detach') {
+      this.forget(ch);
+      this.sendServer({ type: msg.op, ch });
+    }
+  }
+
+  // Pages normally send 'detach' on pagehide; this catches crashed/killed tabs.
+  startHeartbeat() {
+    if (this.heartbeat) return;
+    this.heartbeat = setInterval(() => {
+      const now = Date.now();
+      this.ports.forEach((state, port) => {
+        if (now - state.lastSeen > 45000) { this.detach(port); return; }
+        try { port.postMessage({ op: 'ping' }); } catch { this.detach(port); }
+      });
+      if (!this.ports.size) { clearInterval(this.heartbeat); this.heartbeat = null; }
+    }, 15000);
+  }
+}
+
+if (typeof SharedWorkerGlobalScope !== 'undefined' && self instanceof SharedWorkerGlobalScope) {
+  const hub = new TermMuxHub(self.location.origin);
+  self.onconnect = evt => hub.attach(evt.ports[0]);
+}
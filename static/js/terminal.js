@@ -30,13 +30,37 @@ window.addEventListener("DOMContentLoaded", () => {
   term.open(terminalContainer);
   adjustTerminalSize();
 
+  // Shares the browser-wide multiplexed socket; plain /ws/{id} if the mux script is missing
   const protocol = location.protocol === "https:" ? "wss" : "ws";
-  const socket = new WebSocket(`${protocol}://${location.host}/ws/${hostId}`);
+  const socket = window.TermMux
+    ? TermMux.connect(hostId, { cols: term.cols, rows: term.rows, flow: true, screen: true, resumeKey: `terminal:${hostId}` })
+    : new WebSocket(`${protocol}://${location.host}/ws/${hostId}`);
 
   term.onData(data => socket.send(data));
-  socket.onmessage = event => term.write(event.data);
+  term.onResize(({ cols, rows }) => { if (socket.resize) socket.resize(cols, rows); });
+  socket.onmessage = event => term.write(event.data, () => { if (socket.ack) socket.ack(event.data); });
   socket.onclose = () => term.write("\r\n*** Connection closed ***");
 
+  // Read-only sharing needs the server-side session id, which only TermMux exposes
+  const shareButton = document.getElementById("share-terminal");
+  if (shareButton && window.TermMux) {
+    shareButton.hidden = false;
+    shareButton.addEventListener("click", async () => {
+      if (!socket.session) return;
+      const resp = await fetch(`/api/terminal/sessions/${encodeURIComponent(socket.session)}/share`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ enabled: true })
+      });
+      if (!resp.ok) {
+        console.error("Failed to share terminal", resp.status);
+        return;
+      }
+      const data = await resp.json();
+      window.prompt("Read-only link for this terminal:", location.origin + data.watch_url);
+    });
+  }
+
   // Resize dynamically
   window.addEventListener("resize", adjustTerminalSize);
 
@@ -0,0 +1,59 @@
+// Read-only view of someone else's terminal session (/terminal/watch/<id>).
+//
+// Output arrives as binary frames; text frames are JSON notices: the owner's
+// terminal size and the end of the session. Rendered output is acked so the
+// server can switch a lagging viewer to screen repaints.
+
+window.addEventListener("DOMContentLoaded", () => {
+  if (typeof watchSessionId === "undefined") return;
+
+  const term = new Terminal({
+    fontFamily: "monospace",
+    theme: { background: "#000000" },
+    cursorBlink: false,
+    disableStdin: true,
+    scrollback: 1000
+  });
+  term.open(document.getElementById("terminal"));
+
+  const protocol = location.protocol === "https:" ? "wss" : "ws";
+  const socket = new WebSocket(
+    `${protocol}://${location.host}/ws/watch/${encodeURIComponent(watchSessionId)}?flow=1&screen=1`
+  );
+  socket.binaryType = "arraybuffer";
+  const encoder = new TextEncoder();
+  let acked = 0;
+  let ended = false;
+
+  const endMessages = {
+    ended: "Session ended",
+    closed: "Session closed",
+    expired: "Session expired",
+    too_slow: "Disconnected: this viewer fell too far behind",
+    unshared: "The owner stopped sharing this session",
+    not_found: "Session not found (or not shared with you)",
+    full: "Too many viewers on this session"
+  };
+
+  socket.onmessage = event => {
+    if (typeof event.data !== "string") {
+      const data = new Uint8Array(event.data);
+      term.write(data, () => {
+        acked += data.byteLength;
+        if (socket.readyState === WebSocket.OPEN) {
+          socket.send(encoder.encode(JSON.stringify({ type: "ack", bytes: acked })));
+        }
+      });
+      return;
+    }
+    let msg;
+    try { msg = JSON.parse(event.data); } catch { return; }
+    if (msg.type === "size") {
+      term.resize(msg.cols, msg.rows);
+    } else if (msg.type === "ended") {
+      ended = true;
+      term.write(`\r\n*** ${endMessages[msg.reason] || "Session ended"} ***\r\n`);
+    }
+  };
+  socket.onclose = () => { if (!ended) term.write("\r\n*** Connection closed ***\r\n"); };
+});
@@ -177,6 +177,8 @@ function openPopup(hostId, hostName, hostAddress) {
       <script src="/static/vendor/xterm/xterm.js"></script>
       <script src="/static/vendor/xterm/xterm-addon-fit.js"></script>
       <script src="/static/vendor/xterm/xterm-addon-web-links.js"></script>
+      <script src="/static/js/term_mux_worker.js"></script>
+      <script src="/static/js/term_mux.js"></script>
       
       <script>
         const hostId = ${hostId};
@@ -222,11 +224,13 @@ function openPopup(hostId, hostName, hostAddress) {
           // Show connection status
           showConnectionStatus(true);
           
-          // Connect WebSocket
+          // Connect over the shared multiplexed socket (plain WebSocket as fallback)
           const protocol = location.protocol === "https:" ? "wss" : "ws";
           const wsUrl = protocol + "://" + location.host + "/ws/" + hostId;
           
-          socket = new WebSocket(wsUrl);
+          socket = window.TermMux
+            ? TermMux.connect(hostId, { cols: term.cols, rows: term.rows, flow: true, screen: true })
+            : new WebSocket(wsUrl);
           
           socket.onopen = () => {
             console.log("Terminal WebSocket connected");
@@ -253,7 +257,7 @@ function openPopup(hostId, hostName, hostAddress) {
           };
           
           socket.onmessage = event => {
-            term.write(event.data);
+            term.write(event.data, () => { if (socket.ack) socket.ack(event.data); });
             if (!isConnected) {
               showConnectionStatus(false);
               isConnected = true;
@@ -266,6 +270,10 @@ function openPopup(hostId, hostName, hostAddress) {
             }
           });
           
+          term.onResize(({ cols, rows }) => {
+            if (socket.resize) socket.resize(cols, rows);
+          });
+          
           // Handle window resize
           window.addEventListener('resize', fitTerminal);
           
@@ -445,11 +453,14 @@ function openTerminalOverlay(hostId, hostName, hostAddress) {
   // Show connection status
   term.write(`\r\n🔌 Connecting to ${hostName} (${hostAddress})...\r\n`);
 
-  // Connect WebSocket
+  // Connect over the shared multiplexed socket (plain WebSocket as fallback)
   const protocol = location.protocol === "https:" ? "wss" : "ws";
   const wsUrl = `${protocol}://${location.host}/ws/${hostId}`;
   
-  socket = new WebSocket(wsUrl);
+  socket = window.TermMux
+    ? TermMux.connect(hostId, { cols: term.cols, rows: term.rows, flow: true, screen: true })
+    : new WebSocket(wsUrl);
+  const termSocket = socket;  // acks must reach this terminal's socket even if the global is replaced
   let isConnected = false;
 
   socket.onopen = () => {
@@ -474,7 +485,7 @@ function openTerminalOverlay(hostId, hostName, hostAddress) {
   };
 
   socket.onmessage = event => {
-    term.write(event.data);
+    term.write(event.data, () => { if (termSocket.ack) termSocket.ack(event.data); });
     if (!isConnected) {
       isConnected = true;
     }
@@ -486,6 +497,10 @@ function openTerminalOverlay(hostId, hostName, hostAddress) {
     }
   });
 
+  term.onResize(({ cols, rows }) => {
+    if (socket && socket.resize) socket.resize(cols, rows);
+  });
+
   // Handle window resize for overlay terminal
   const resizeHandler = () => {
     if (fitAddon && term) {
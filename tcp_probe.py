@@ -0,0 +1,249 @@
+# tcp_probe.py
+"""TCP reachability pre-check before an SSH handshake.
+
+A host that is down or decommissioned costs a full ``connect_timeout`` (10 s)
+inside ``asyncssh.connect``. During that time it holds a connect slot, and in
+ScriptExec and FileUploader it holds up every host after it. Before that
+handshake, :class:`TcpProbe` opens a plain TCP connection to port 22 with a
+short timeout (``SSH_PROBE_TIMEOUT_MS``) and closes it at once. Hosts that
+refuse, time out or do not resolve are reported as unreachable without
+taking an SSH slot. Probes are cheap, so many run at once
+(``SSH_PROBE_CONCURRENCY``), well ahead of the SSH stage.
+
+Results are cached per worker for ``SSH_PROBE_CACHE_SECONDS``, so a run
+started right after another skips known-dead hosts without probing again.
+A pooled SSH connection to the host counts as reachable. Set
+``SSH_PROBE_TIMEOUT_MS=0`` to turn the pre-check off.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Awaitable, Callable
+
+import ssh_pool
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.tcp_probe")
+
+
+PROBE_TIMEOUT_MS = max(0, env_int("SSH_PROBE_TIMEOUT_MS", 1500))
+PROBE_CONCURRENCY = max(1, env_int("SSH_PROBE_CONCURRENCY", 512))
+PROBE_CACHE_SECONDS = max(0, env_int("SSH_PROBE_CACHE_SECONDS", 30))
+PROBE_CACHE_SIZE = 65536
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+async def connect_time(host: str, port: int, timeout: float) -> tuple[float | None, str | None]:
+    """``(seconds, None)`` when ``host`` accepts TCP on ``port`` within ``timeout``, else ``(None, error)``.
+
+    The timeout covers name resolution too: a hanging DNS lookup must not hold the probe.
+    """
+    resolved = _is_ip(host)
+
+    async def attempt():
+        nonlocal resolved
+        address = host
+        if not resolved:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            address = infos[0][4][0]
+            resolved = True
+        started = time.monotonic()
+        _, writer = await asyncio.open_connection(address, port)
+        return time.monotonic() - started, writer
+
+    try:
+        latency, writer = await asyncio.wait_for(attempt(), timeout)
+    except asyncio.TimeoutError:
+        if not resolved:
+            return None, f"unreachable: cannot resolve host within {timeout:g} s"
+        return None, f"unreachable: no answer on port {port} within {timeout:g} s"
+    except ConnectionRefusedError:
+        return None, f"unreachable: port {port} refused the connection"
+    except socket.gaierror as e:
+        return None, f"unreachable: cannot resolve host ({e.strerror or e})"
+    except OSError as e:
+        return None, f"unreachable: {e.strerror or e}"
+    writer.transport.abort()
+    return latency, None
+
+
+class TcpProbe:
+    """Parallel TCP connect checks with a short-lived per-worker result cache."""
+
+    def __init__(self, *, timeout: float = PROBE_TIMEOUT_MS / 1000, concurrency: int = PROBE_CONCURRENCY,
+                 ttl: float = PROBE_CACHE_SECONDS, max_entries: int = PROBE_CACHE_SIZE):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache: OrderedDict[tuple[str, int], tuple[float, bool, str | None]] = OrderedDict()
+        self.probes = 0
+        self.cache_hits = 0
+        self.reachable = 0
+        self.unreachable = 0
+        self.latency_total = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.timeout > 0
+
+    # ── Cache ────────────────────────────────────────────────────────────────
+    def cached(self, host: str, port: int = 22) -> tuple[bool, str | None] | None:
+        """``(reachable, error)`` from a recent probe, or None."""
+        key = (host, port)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._cache[key]
+            return None
+        self.cache_hits += 1
+        return entry[1], entry[2]
+
+    def remember(self, host: str, ok: bool, error: str | None = None, port: int = 22) -> None:
+        """Cache a result found elsewhere (a shard process's probe)."""
+        self._store(host, port, ok, error)
+
+    def _store(self, host: str, port: int, ok: bool, error: str | None) -> None:
+        if self.ttl <= 0:
+            return
+        key = (host, port)
+        self._cache[key] = (time.monotonic() + self.ttl, ok, error)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def forget(self, host: str, port: int = 22) -> None:
+        self._cache.pop((host, port), None)
+
+    # ── Probing ──────────────────────────────────────────────────────────────
+    async def check(self, host: str, port: int = 22) -> tuple[bool, str | None]:
+        """``(reachable, error)`` for one host, from the cache or a fresh probe."""
+        hit = self._known(host, port)
+        if hit is not None:
+            return hit
+        return await self._probe(host, port)
+
+    def _known(self, host: str, port: int) -> tuple[bool, str | None] | None:
+        if port == 22 and ssh_pool.pool.has_connection(host):
+            return True, None
+        return self.cached(host, port)
+
+    async def _probe(self, host: str, port: int) -> tuple[bool, str | None]:
+        self.probes += 1
+        latency, error = await connect_time(host, port, self.timeout)
+        ok = error is None
+        if ok:
+            self.reachable += 1
+            self.latency_total += latency
+        else:
+            self.unreachable += 1
+        self._store(host, port, ok, error)
+        return ok, error
+
+    async def reachable_hosts(self, hosts: AsyncIterator[str],
+                              on_unreachable: Callable[[str, str], Awaitable[None]],
+                              port: int = 22) -> AsyncIterator[str]:
+        """Yield the hosts from ``hosts`` that accept TCP on ``port``.
+
+        Up to ``concurrency`` probes run ahead of the consumer. Reachable
+        hosts come out as their probes finish. For the others,
+        ``await on_unreachable(host, error)`` is called instead.
+        """
+        source = hosts.__aiter__()
+        results: asyncio.Queue = asyncio.Queue()
+        ready: deque[str] = deque()
+        tasks: set[asyncio.Task] = set()
+        in_flight = 0               # probes whose result has not been taken yet
+        exhausted = False
+
+        async def run(host: str):
+            ok, error = await self._probe(host, port)
+            results.put_nowait((host, ok, error))
+
+        async def take(result: tuple) -> None:
+            nonlocal in_flight
+            in_flight -= 1
+            host, ok, error = result
+            if ok:
+                ready.append(host)
+            else:
+                await on_unreachable(host, error)
+
+        try:
+            while True:
+                # Keep the probe window full, but stop when reachable hosts pile up unconsumed
+                while not exhausted and in_flight + len(ready) < self.concurrency:
+                    try:
+                        host = await source.__anext__()
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    hit = self._known(host, port)
+                    if hit is None:
+                        in_flight += 1
+                        task = asyncio.create_task(run(host))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    elif hit[0]:
+                        ready.append(host)
+                        break
+                    else:
+                        await on_unreachable(host, hit[1])
+                while not results.empty():
+                    await take(results.get_nowait())
+                if ready:
+                    yield ready.popleft()
+                elif in_flight:
+                    await take(await results.get())
+                elif exhausted:
+                    return
+        finally:
+            for task in list(tasks):
+                task.cancel()
+
+    async def check_all(self, hosts: list[str], port: int = 22) -> dict[str, tuple[bool, str | None]]:
+        """``(reachable, error)`` for every host, probed in parallel like :meth:`reachable_hosts`."""
+        results: dict[str, tuple[bool, str | None]] = {}
+
+        async def source():
+            for host in hosts:
+                yield host
+
+        async def unreachable(host: str, error: str) -> None:
+            results[host] = (False, error)
+
+        async for host in self.reachable_hosts(source(), unreachable, port):
+            results[host] = (True, None)
+        return results
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        cached_dead = sum(1 for expires, ok, _ in self._cache.values() if not ok and expires >= now)
+        return {
+            "enabled": self.enabled,
+            "timeout_ms": round(self.timeout * 1000),
+            "concurrency": self.concurrency,
+            "cache_seconds": self.ttl,
+            "probes": self.probes,
+            "cache_hits": self.cache_hits,
+            "reachable": self.reachable,
+            "unreachable": self.unreachable,
+            "avg_connect_ms": round(1000 * self.latency_total / self.reachable, 1) if self.reachable else None,
+            "cached_hosts": len(self._cache),
+            "cached_unreachable": cached_dead,
+        }
+
+
+prober = TcpProbe()
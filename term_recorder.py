@@ -0,0 +1,311 @@
+# term_recorder.py
+"""Audit recordings of interactive terminal sessions.
+
+Every :class:`term_sessions.TerminalSession` tees its output, input and
+resizes into a :class:`SessionRecorder`. On the event loop that is a list
+append. Batches are written by a small thread pool once a second or every
+``BATCH_BYTES``, whichever comes first.
+
+On disk a recording is an asciicast v2 file compressed as a sequence of gzip
+members (``<id>.cast.gz``). ``zcat`` of the file is a plain ``.cast`` that
+asciinema plays as is. Each member starts at a keyframe, every
+``TERMINAL_RECORD_KEYFRAME`` seconds, and can be decompressed on its own.
+The sidecar ``<id>.idx`` lists each keyframe's time, file position and
+output offset. A replay can therefore seek to minute 45 of a 3-hour session
+by decompressing one or two members instead of the whole file. Within a
+member, each batch ends in a sync flush, so a live recording is readable up
+to its last batch.
+"""
+
+import asyncio
+import codecs
+import json
+import logging
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
+import db
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.term_recorder")
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
+
+
+RECORD_ENABLED = _env_flag("TERMINAL_RECORD", True)
+RECORD_INPUT = _env_flag("TERMINAL_RECORD_INPUT", True)
+RECORDING_DIR = os.getenv("TERMINAL_RECORDING_DIR", "recordings")
+KEYFRAME_SECONDS = max(5, env_int("TERMINAL_RECORD_KEYFRAME", 60))
+FLUSH_INTERVAL = 1.0
+BATCH_BYTES = 262144
+MAX_PENDING_BYTES = 8 * 1048576   # past this (disk stalled) output events are dropped
+PRELUDE_BYTES = 65536             # output replayed instantly before a seek point
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="term-recorder")
+
+
+# ─── Writing (worker thread) ────────────────────────────────────────────────────
+class _CastWriter:
+    """Thread-side half of a recording: encoding, compression, file I/O."""
+
+    def __init__(self, path: str, header: dict, meta: dict):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.fh = open(path + ".cast.gz", "ab")
+        self.index = open(path + ".idx", "a", encoding="utf-8")
+        self.decoders = {code: codecs.getincrementaldecoder("utf-8")("replace") for code in ("o", "i")}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.events = 0
+        self.cpu_seconds = 0.0
+        self._comp = None
+        self._member_t = 0.0
+        self._start_member(0.0)
+        self._write((json.dumps(header) + "\n").encode("utf-8"))
+
+        with db.pool.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO terminal_recordings "
+                "(id, user_id, username, host_id, host_name, started, path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (meta["id"], meta["user_id"], meta["username"], meta["host_id"],
+                 meta["host_name"], header["timestamp"], path),
+            )
+
+    def _start_member(self, t: float):
+        if self._comp is not None:
+            self.fh.write(self._comp.flush(zlib.Z_FINISH))
+        self._comp = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip member
+        self._member_t = t
+        entry = {"t": round(t, 3), "pos": self.fh.tell(), "out": self.bytes_out}
+        self.index.write(json.dumps(entry) + "\n")
+        self.index.flush()
+
+    def _write(self, data: bytes):
+        self.fh.write(self._comp.compress(data) + self._comp.flush(zlib.Z_SYNC_FLUSH))
+        self.fh.flush()
+
+    def write_batch(self, events: list) -> None:
+        started = time.perf_counter()
+        if events and events[0][0] - self._member_t >= KEYFRAME_SECONDS:
+            self._start_member(events[0][0])
+        lines = []
+        for t, code, payload in events:
+            if code == "r":
+                text = payload
+            else:
+                text = self.decoders[code].decode(payload)
+                if code == "o":
+                    self.bytes_out += len(payload)
+                else:
+                    self.bytes_in += len(payload)
+                if not text:
+                    continue
+            lines.append(json.dumps([round(t, 6), code, text], ensure_ascii=False))
+        if lines:
+            self._write(("\n".join(lines) + "\n").encode("utf-8"))
+            self.events += len(lines)
+        self.cpu_seconds += time.perf_counter() - started
+
+    def close(self, ended: float, duration: float) -> int:
+        self.fh.write(self._comp.flush(zlib.Z_FINISH))
+        stored = self.fh.tell()
+        self.fh.close()
+        self.index.close()
+        with db.pool.connection() as conn:
+            conn.execute(
+                "UPDATE terminal_recordings SET ended = ?, duration = ?, bytes_out = ?, bytes_in = ?, "
+                "stored_bytes = ? WHERE id = ?",
+                (ended, duration, self.bytes_out, self.bytes_in, stored, os.path.basename(self.path)),
+            )
+        return stored
+
+
+# ─── Recording (event loop) ─────────────────────────────────────────────────────
+class SessionRecorder:
+    """Collects one session's events and hands them to the writer in batches."""
+
+    def __init__(self, session_id: str, user: dict, host, cols: int, rows: int):
+        started = time.time()
+        self.id = session_id
+        self.path = os.path.join(RECORDING_DIR, time.strftime("%Y-%m-%d", time.localtime(started)), session_id)
+        self._t0 = time.monotonic()
+        self._events: list = []
+        self._pending = 0
+        self.dropped_bytes = 0
+        self.loop_seconds = 0.0
+        self.failed = False
+        self._closing = False
+        self._wake = asyncio.Event()
+        self._writer: _CastWriter | None = None
+        header = {
+            "version": 2, "width": cols, "height": rows, "timestamp": int(started),
+            "title": f"{user['username']}@{host['name']}", "env": {"TERM": "xterm"},
+        }
+        meta = {"id": session_id, "user_id": user["id"], "username": user["username"],
+                "host_id": host["id"], "host_name": host["name"]}
+        self._task = asyncio.create_task(self._run(header, meta))
+
+    def _add(self, code: str, payload) -> None:
+        started = time.perf_counter()
+        if self.failed or (code == "o" and self._pending >= MAX_PENDING_BYTES):
+            self.dropped_bytes += len(payload)
+            return
+        self._events.append((time.monotonic() - self._t0, code, payload))
+        self._pending += len(payload)
+        if self._pending >= BATCH_BYTES:
+            self._wake.set()
+        self.loop_seconds += time.perf_counter() - started
+
+    def output(self, data: bytes) -> None:
+        self._add("o", data)
+
+    def input(self, data: bytes) -> None:
+        if RECORD_INPUT:
+            self._add("i", data)
+
+    def resize(self, cols: int, rows: int) -> None:
+        self._add("r", f"{cols}x{rows}")
+
+    async def _run(self, header: dict, meta: dict):
+        loop = asyncio.get_running_loop()
+        try:
+            self._writer = await loop.run_in_executor(_executor, _CastWriter, self.path, header, meta)
+            while not self._closing:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), FLUSH_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+                await self._flush()
+            await self._flush()
+            duration = time.monotonic() - self._t0
+            await loop.run_in_executor(_executor, self._writer.close, time.time(), duration)
+        except Exception as e:
+            self.failed = True
+            self._events = []
+            logger.error("Recording %s failed: %s", self.id, e)
+
+    async def _flush(self):
+        if not self._events:
+            return
+        batch, self._events, self._pending = self._events, [], 0
+        await asyncio.get_running_loop().run_in_executor(_executor, self._writer.write_batch, batch)
+
+    async def close(self) -> None:
+        """Write what is buffered and finish the file."""
+        self._closing = True
+        self._wake.set()
+        await asyncio.shield(self._task)
+
+    def stats(self) -> dict:
+        writer = self._writer
+        return {
+            "id": self.id,
+            "bytes_out": writer.bytes_out if writer else 0,
+            "bytes_in": writer.bytes_in if writer else 0,
+            "events": writer.events if writer else 0,
+            "stored_bytes": writer.fh.tell() if writer and not writer.fh.closed else 0,
+            "pending_bytes": self._pending,
+            "dropped_bytes": self.dropped_bytes,
+            "loop_seconds": round(self.loop_seconds, 4),
+            "writer_seconds": round(writer.cpu_seconds, 4) if writer else 0.0,
+            "failed": self.failed,
+        }
+
+
+# ─── Reading / replay ───────────────────────────────────────────────────────────
+def read_index(path: str) -> list[dict]:
+    entries = []
+    try:
+        with open(path + ".idx", encoding="utf-8") as fh:
+            for line in fh:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break  # torn last line of a live recording
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def _iter_lines(path: str, pos: int = 0) -> Iterator[bytes]:
+    """Decompressed lines from file position ``pos`` across gzip members."""
+    with open(path + ".cast.gz", "rb") as fh:
+        fh.seek(pos)
+        inflater = zlib.decompressobj(31)
+        pending = b""
+        while True:
+            chunk = fh.read(65536)
+            if not chunk:
+                break
+            while chunk:
+                pending += inflater.decompress(chunk)
+                if inflater.eof:
+                    chunk = inflater.unused_data
+                    inflater = zlib.decompressobj(31)
+                else:
+                    chunk = b""
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    yield line + b"\n"
+
+
+def iter_cast(path: str, start: float = 0.0) -> Iterator[bytes]:
+    """asciicast v2 lines of a recording, optionally from ``start`` seconds.
+
+    A seek starts decoding at the keyframe before the one covering ``start``
+    and collapses up to ``PRELUDE_BYTES`` of earlier output into one event at
+    time 0, so the player's screen is populated; later events are shifted by
+    ``-start``.
+    """
+    lines = _iter_lines(path)
+    header = next(lines, None)
+    if header is None:
+        return
+    if start <= 0:
+        yield header
+        yield from lines
+        return
+    lines.close()
+
+    keyframes = [e for e in read_index(path) if e["t"] <= start] or [{"pos": 0}]
+    entry = keyframes[-2] if len(keyframes) > 1 else keyframes[-1]
+    yield header
+
+    prelude: deque[str] = deque()
+    prelude_len = 0
+    size = None
+    seeking = True
+    for raw in _iter_lines(path, entry["pos"]):
+        try:
+            event = json.loads(raw)
+        except ValueError:
+            continue
+        if not isinstance(event, list):
+            continue  # header line of member 0
+        t, code, data = event
+        if seeking:
+            if t < start:
+                if code == "o":
+                    prelude.append(data)
+                    prelude_len += len(data)
+                    while prelude_len - len(prelude[0]) >= PRELUDE_BYTES:
+                        prelude_len -= len(prelude.popleft())
+                elif code == "r":
+                    size = data
+                continue
+            seeking = False
+            if size:
+                yield (json.dumps([0.0, "r", size]) + "\n").encode("utf-8")
+            if prelude:
+                yield (json.dumps([0.0, "o", "".join(prelude)], ensure_ascii=False) + "\n").encode("utf-8")
+        yield (json.dumps([round(t - start, 6), code, data], ensure_ascii=False) + "\n").encode("utf-8")
@@ -0,0 +1,154 @@
+# term_relay.py
+"""SSH → browser output relay for interactive terminals.
+
+Reads large buffers from the SSH channel and coalesces bursts into one frame
+per latency budget (``TERMINAL_FLUSH_MS``) or byte cap
+(``TERMINAL_FLUSH_BYTES``), whichever comes first. A small read after a quiet
+period is keystroke echo and goes out immediately, so typing latency is
+unchanged while ``cat bigfile`` produces a few hundred frames per second
+instead of tens of thousands.
+
+Clients that acknowledge what they have rendered get a :class:`FlowWindow`:
+reading from the SSH channel pauses while more than ``TERMINAL_WINDOW_HIGH``
+bytes are unacknowledged and resumes below ``TERMINAL_WINDOW_LOW``. While
+paused, asyncssh's channel window fills and the remote side blocks, so a
+runaway ``find /`` on a slow link cannot balloon worker memory.
+"""
+
+import asyncio
+import struct
+import time
+from typing import Awaitable, Callable
+
+from settings import env_int
+
+
+READ_BYTES = max(1024, env_int("TERMINAL_READ_BYTES", 65536))
+FLUSH_DELAY = max(0, env_int("TERMINAL_FLUSH_MS", 8)) / 1000.0
+FLUSH_BYTES = max(1024, env_int("TERMINAL_FLUSH_BYTES", 32768))
+INTERACTIVE_BYTES = 256
+WINDOW_HIGH = max(4096, env_int("TERMINAL_WINDOW_HIGH", 524288))
+WINDOW_LOW = min(max(0, env_int("TERMINAL_WINDOW_LOW", 131072)), WINDOW_HIGH // 2)
+
+# Binary mux frames: 4-byte big-endian channel id followed by raw output
+_CHANNEL_HEADER = struct.Struct("!I")
+
+
+def mux_frame(ch: int, payload: bytes) -> bytes:
+    return _CHANNEL_HEADER.pack(ch) + payload
+
+
+class FlowWindow:
+    """Unacknowledged-output window between one SSH reader and its client.
+
+    The client acks the cumulative number of output bytes it has rendered;
+    :meth:`wait_open` blocks the reader between the high and low marks.
+    """
+
+    def __init__(self, high: int = WINDOW_HIGH, low: int = WINDOW_LOW):
+        self.high = high
+        self.low = min(low, high)
+        self.sent = 0
+        self.acked = 0
+        self.pauses = 0
+        self._paused_at: float | None = None
+        self._paused_total = 0.0
+        self._open = asyncio.Event()
+        self._open.set()
+
+    @property
+    def in_flight(self) -> int:
+        return self.sent - self.acked
+
+    @property
+    def paused(self) -> bool:
+        return not self._open.is_set()
+
+    def on_sent(self, nbytes: int) -> None:
+        self.sent += nbytes
+        if self.in_flight >= self.high and self._open.is_set():
+            self._open.clear()
+            self.pauses += 1
+            self._paused_at = time.monotonic()
+
+    def ack(self, total: int) -> None:
+        """Record a cumulative ack; stale or bogus values are ignored."""
+        if total <= self.acked:
+            return
+        self.acked = min(int(total), self.sent)
+        if self.in_flight <= self.low and not self._open.is_set():
+            self._open.set()
+            if self._paused_at is not None:
+                self._paused_total += time.monotonic() - self._paused_at
+                self._paused_at = None
+
+    async def wait_open(self) -> None:
+        await self._open.wait()
+
+    def stats(self) -> dict:
+        paused_for = self._paused_total
+        if self._paused_at is not None:
+            paused_for += time.monotonic() - self._paused_at
+        return {
+            "high": self.high,
+            "low": self.low,
+            "sent": self.sent,
+            "acked": self.acked,
+            "in_flight": self.in_flight,
+            "paused": self.paused,
+            "pauses": self.pauses,
+            "paused_seconds": round(paused_for, 3),
+        }
+
+
+async def relay_output(reader, emit: Callable[[bytes], Awaitable[None]], *,
+                       window: FlowWindow | None = None,
+                       read_bytes: int = READ_BYTES,
+                       flush_delay: float = FLUSH_DELAY,
+                       flush_bytes: int = FLUSH_BYTES,
+                       interactive_bytes: int = INTERACTIVE_BYTES) -> None:
+    """Pump ``reader`` (bytes mode) until EOF, awaiting ``emit`` per batch.
+
+    ``emit`` is awaited before the next read, so a slow consumer slows the
+    reads and asyncssh's channel window pushes back on the remote side.
+    With a ``window``, reads also wait for client acks past the high mark.
+    """
+    loop = asyncio.get_running_loop()
+    last_emit = 0.0
+    while True:
+        if window is not None:
+            await window.wait_open()
+        data = await reader.read(read_bytes)
+        if not data:
+            return
+
+        now = loop.time()
+        if len(data) <= interactive_bytes and now - last_emit >= flush_delay:
+            await emit(data)
+            if window is not None:
+                window.on_sent(len(data))
+            last_emit = loop.time()
+            continue
+
+        buf = bytearray(data)
+        deadline = now + flush_delay
+        eof = False
+        while len(buf) < flush_bytes:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                # Cancelling a pending SSHReader.read leaves buffered data intact
+                more = await asyncio.wait_for(reader.read(read_bytes), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not more:
+                eof = True
+                break
+            buf += more
+        await emit(bytes(buf))
+        if window is not None:
+            window.on_sent(len(buf))
+        last_emit = loop.time()
+        if eof:
+            return
@@ -0,0 +1,125 @@
+# term_screen.py
+"""Headless terminal screen used to skip frames during output floods.
+
+When a terminal client opted into screen mode falls a full flow-control
+window behind, the session stops sending it raw output. Instead, at most
+``TERMINAL_SCREEN_FPS`` times a second (and only once the previous frame has
+been rendered), it sends a repaint of the current viewport rendered from a
+server-side emulator. Raw streaming resumes once the flood subsides.
+
+The emulator (pyte) is pure Python and far slower than the output it would
+have to parse, so it is not fed continuously. At frame time it is brought up
+to date from the session's ring buffer. Backlogs longer than two screenfuls
+of bytes are approximated by feeding only that tail, cut at a line boundary,
+which is exact for scrolling output and close for full-screen redraws.
+
+pyte is optional; without it screen mode is simply unavailable.
+"""
+
+try:
+    import pyte
+except ImportError:  # pragma: no cover
+    pyte = None
+
+from settings import env_int
+
+SCREEN_FPS = min(60, max(1, env_int("TERMINAL_SCREEN_FPS", 10)))
+
+_SGR_FLAGS = (("bold", "1"), ("italics", "3"), ("underscore", "4"),
+              ("blink", "5"), ("reverse", "7"), ("strikethrough", "9"))
+_ANSI_COLORS = ("black", "red", "green", "brown", "blue", "magenta", "cyan", "white")
+
+
+def available() -> bool:
+    return pyte is not None
+
+
+def _color(value: str, base: int) -> str | None:
+    """SGR parameter for a pyte colour; ``base`` is 30 (fg) or 40 (bg)."""
+    if value == "default":
+        return None
+    if value in _ANSI_COLORS:
+        return str(base + _ANSI_COLORS.index(value))
+    if value.startswith("bright") and value[6:] in _ANSI_COLORS:
+        return str(base + 60 + _ANSI_COLORS.index(value[6:]))
+    if len(value) == 6:
+        try:
+            r, g, b = (int(value[i:i + 2], 16) for i in (0, 2, 4))
+        except ValueError:
+            return None
+        return f"{base + 8};2;{r};{g};{b}"
+    return None
+
+
+def _sgr(char) -> str:
+    params = ["0"]
+    params += [code for attr, code in _SGR_FLAGS if getattr(char, attr, False)]
+    for value, base in ((char.fg, 30), (char.bg, 40)):
+        color = _color(value, base)
+        if color:
+            params.append(color)
+    return "\x1b[" + ";".join(params) + "m"
+
+
+class ScreenModel:
+    """A pyte screen that tracks one session's output stream by offset."""
+
+    def __init__(self, cols: int, rows: int, offset: int = 0):
+        if pyte is None:
+            raise RuntimeError("pyte is not installed")
+        self.screen = pyte.Screen(cols, rows)
+        self.stream = pyte.ByteStream(self.screen)
+        self.offset = offset  # stream offset the screen reflects
+        self._size = (cols, rows)
+
+    def resize(self, cols: int, rows: int) -> None:
+        # Applied by the next frame(), so the worker thread owns the screen
+        self._size = (cols, rows)
+
+    @property
+    def tail_bytes(self) -> int:
+        """How much backlog to feed when it cannot all be parsed."""
+        return max(4096, self.screen.columns * self.screen.lines * 2)
+
+    def frame(self, data: bytes, end: int, partial: bool) -> bytes:
+        """Apply ``data`` (ending at stream offset ``end``) and render a repaint.
+
+        ``partial`` means ``data`` is only the tail of the backlog; it is cut
+        to start on a line boundary. Runs in a worker thread.
+        """
+        cols, rows = self._size
+        if (cols, rows) != (self.screen.columns, self.screen.lines):
+            self.screen.resize(rows, cols)
+        if partial:
+            cut = data.find(b"\n")
+            data = b"\r\n" + data[cut + 1:] if cut >= 0 else data
+        self.stream.feed(data)
+        self.offset = end
+        return self.render()
+
+    def render(self) -> bytes:
+        screen = self.screen
+        out = ["\x1b[?25l"]
+        for y in range(screen.lines):
+            row = screen.buffer[y]
+            # Trailing default blanks are left to the line erase
+            last = screen.columns - 1
+            while last >= 0 and row[last].data in (" ", "") and _sgr(row[last]) == "\x1b[0m":
+                last -= 1
+            out.append(f"\x1b[{y + 1};1H\x1b[0m\x1b[2K")
+            current = "\x1b[0m"
+            for x in range(last + 1):
+                char = row[x]
+                if not char.data:
+                    continue  # right half of a wide character
+                sgr = _sgr(char)
+                if sgr != current:
+                    out.append(sgr)
+                    current = sgr
+                out.append(char.data)
+        cursor = screen.cursor
+        out.append(f"\x1b[{cursor.y + 1};{cursor.x + 1}H")
+        out.append(_sgr(cursor.attrs))
+        if not cursor.hidden:
+            out.append("\x1b[?25h")
+        return "".join(out).encode("utf-8", "replace")
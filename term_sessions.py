@@ -0,0 +1,634 @@
+# term_sessions.py
+"""Detachable terminal sessions.
+
+A :class:`TerminalSession` owns the interactive SSH shell and its output pump,
+independent of the WebSocket that is showing it. Every output byte is appended
+to a bounded :class:`OutputRing` and addressed by its absolute offset in the
+session's output stream.
+
+When the browser goes away (refresh, laptop sleep, flaky Wi-Fi) the session is
+detached instead of closed. The shell keeps running for
+``TERMINAL_DETACH_GRACE`` seconds, and its output keeps flowing into the ring,
+where the oldest bytes are dropped past ``TERMINAL_SCROLLBACK_BYTES``. A client
+that reattaches with the last offset it received gets exactly the output it
+missed (or everything still buffered, if it fell further behind), then the
+live stream. The pooled SSH connection is reused throughout, so a resume needs
+no handshake.
+
+Clients that opt into screen mode are sent viewport repaints instead of the
+raw backlog when they fall behind (see :mod:`term_screen`). Output, input and
+resizes are recorded for audit (see :mod:`term_recorder`).
+
+A session can also be watched read-only by any number of viewers (incident
+bridges, pairing). They share the one SSH read loop and the one ring: a
+viewer's queue is just the span between its position and the ring end,
+capped at ``TERMINAL_VIEWER_QUEUE_BYTES``. Each viewer is served by its own
+task, so a slow viewer never holds up the pump, the owner or other viewers.
+Once it falls past the cap it is sent a screen repaint instead of the
+backlog (screen mode) or dropped.
+
+Sessions live in the worker process that created them.
+"""
+
+import asyncio
+import logging
+import secrets
+import sys
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+import ssh_pool
+import term_recorder
+import term_screen
+from term_relay import relay_output, FlowWindow, FLUSH_BYTES
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.term_sessions")
+
+
+SCROLLBACK_BYTES = max(4096, env_int("TERMINAL_SCROLLBACK_BYTES", 1048576))
+DETACH_GRACE = max(0, env_int("TERMINAL_DETACH_GRACE", 300))
+MAX_DETACHED_PER_USER = max(1, env_int("TERMINAL_MAX_DETACHED", 8))
+SEND_SLICE = 65536  # replay is sent in frames of at most this size
+VIEWER_QUEUE_BYTES = min(SCROLLBACK_BYTES, max(SEND_SLICE, env_int("TERMINAL_VIEWER_QUEUE_BYTES", 262144)))
+MAX_VIEWERS = max(1, env_int("TERMINAL_MAX_VIEWERS", 20))
+VIEWER_STALL_SECONDS = 30  # a screen-mode viewer this long past its cap is dropped anyway
+
+_BYTES_OVERHEAD = sys.getsizeof(b"")
+
+
+class OutputRing:
+    """Last ``capacity`` bytes of a stream, addressed by absolute offset."""
+
+    def __init__(self, capacity: int = SCROLLBACK_BYTES):
+        self.capacity = capacity
+        self.start = 0   # offset of the oldest byte still held
+        self.end = 0     # offset one past the newest byte
+        self._chunks: deque[bytes] = deque()
+        self._size = 0
+
+    def append(self, data: bytes) -> None:
+        if not data:
+            return
+        self._chunks.append(bytes(data))
+        self._size += len(data)
+        self.end += len(data)
+        overflow = self._size - self.capacity
+        while overflow > 0:
+            head = self._chunks[0]
+            if len(head) <= overflow:
+                self._chunks.popleft()
+                dropped = len(head)
+            else:
+                self._chunks[0] = head[overflow:]
+                dropped = overflow
+            self._size -= dropped
+            self.start += dropped
+            overflow -= dropped
+
+    def read_from(self, offset: int) -> tuple[int, bytes]:
+        """``(offset, data)`` from ``offset`` (clamped to what is held) to the end."""
+        offset = min(max(offset, self.start), self.end)
+        need = self.end - offset
+        if not need:
+            return offset, b""
+        parts, got = [], 0
+        # Readers are normally near the tail, so walk back from the newest chunk
+        for chunk in reversed(self._chunks):
+            parts.append(chunk)
+            got += len(chunk)
+            if got >= need:
+                break
+        data = b"".join(reversed(parts))
+        return offset, data[len(data) - need:]
+
+    def tail(self, nbytes: int) -> tuple[int, bytes]:
+        """The last ``nbytes`` held, as ``(offset, data)``."""
+        return self.read_from(self.end - nbytes)
+
+    @property
+    def nbytes(self) -> int:
+        return self._size
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._size + len(self._chunks) * _BYTES_OVERHEAD
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "bytes": self._size,
+            "memory_bytes": self.memory_bytes,
+            "start_offset": self.start,
+            "end_offset": self.end,
+        }
+
+
+async def close_shell(ssh_conn, proc) -> None:
+    """Close an interactive process and hand its connection back to the pool."""
+    # Close SSH process if it exists
+    if proc:
+        try:
+            if not proc.stdin.is_closing():
+                proc.stdin.close()
+            if not proc.is_closing():
+                proc.close()
+            await proc.wait_closed()
+        except Exception as e:
+            logger.debug("Error closing SSH process: %s", e)
+
+    # Hand the SSH connection back to the pool (kept warm for the next session)
+    if ssh_conn:
+        try:
+            await ssh_pool.pool.release(ssh_conn)
+        except Exception as e:
+            logger.debug("Error releasing SSH connection: %s", e)
+
+
+class SessionClient:
+    """A browser terminal attached to a session.
+
+    ``send`` delivers raw output bytes; ``on_end`` is told why the client lost
+    the session (``ended``, ``error``, ``closed``, ``taken_over``). ``screen``
+    opts into frame skipping, which needs a flow-control ``window``.
+    """
+
+    def __init__(self, transport: str, send: Callable[[bytes], Awaitable[None]], *,
+                 window: FlowWindow | None = None,
+                 on_end: Callable[[str], Awaitable[None]] | None = None,
+                 screen: bool = False):
+        self.transport = transport
+        self.send = send
+        self.window = window
+        self.on_end = on_end
+        self.screen = screen and window is not None and term_screen.available()
+        self.position = 0  # next stream offset this client will receive
+        self.skipping = False
+        self.frames = 0
+        self.skipped_bytes = 0
+
+
+class SessionViewer:
+    """A read-only watcher of a session.
+
+    ``send`` delivers raw output bytes and ``on_size`` is awaited when the
+    owner's terminal size changes. ``done`` is set once the viewer has been
+    let go, with the reason in ``end_reason`` (``ended``, ``error``,
+    ``closed``, ``too_slow``, ``unshared``).
+    """
+
+    def __init__(self, user: dict, transport: str, send: Callable[[bytes], Awaitable[None]], *,
+                 on_size: Callable[[int, int], Awaitable[None]] | None = None,
+                 window: FlowWindow | None = None, screen: bool = False):
+        self.username = user["username"]
+        self.is_admin = bool(user.get("is_admin"))
+        self.transport = transport
+        self.send = send
+        self.on_size = on_size
+        self.window = window
+        self.screen = screen and term_screen.available()
+        self.position = 0
+        self.size: tuple[int, int] | None = None
+        self.frames = 0
+        self.skipped_bytes = 0
+        self.behind_since: float | None = None
+        self.wake = asyncio.Event()
+        self.done = asyncio.Event()
+        self.end_reason: str | None = None
+        self.task: asyncio.Task | None = None
+
+    def stats(self, end: int) -> dict:
+        return {
+            "user": self.username,
+            "transport": self.transport,
+            "queued_bytes": max(0, end - self.position),
+            "frames": self.frames,
+            "skipped_bytes": self.skipped_bytes,
+            "window": self.window.stats() if self.window else None,
+        }
+
+
+class TerminalSession:
+    """One interactive shell that outlives the WebSocket showing it."""
+
+    def __init__(self, user: dict, host, ssh_conn, proc, cols: int | None = None, rows: int | None = None):
+        self.id = secrets.token_urlsafe(12)
+        self.username = user["username"]
+        self.host_id = host["id"]
+        self.host_name = host["name"]
+        self.started = time.time()
+        self.ssh_conn = ssh_conn
+        self.proc = proc
+        self.cols = cols or 80
+        self.rows = rows or 24
+        self.ring = OutputRing()
+        self.screen: term_screen.ScreenModel | None = None
+        self.recorder: term_recorder.SessionRecorder | None = None
+        if term_recorder.RECORD_ENABLED:
+            self.recorder = term_recorder.SessionRecorder(self.id, user, host, self.cols, self.rows)
+        self.client: SessionClient | None = None
+        self.viewers: set[SessionViewer] = set()
+        self.shared = False
+        self.detached_at: float | None = None
+        self.end_reason: str | None = None
+        self._close_reason = "closed"
+        self._expiry: asyncio.TimerHandle | None = None
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._frame_task: asyncio.Task | None = None
+        self._screen_lock = asyncio.Lock()
+        self._frame: tuple[int, bytes] | None = None  # last rendered (offset, repaint)
+
+    # ── Output pump ──────────────────────────────────────────────────────────
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        reason = "ended"
+        try:
+            await relay_output(self.proc.stdout, self._on_output, window=self)
+        except asyncio.CancelledError:
+            reason = self._close_reason
+            raise
+        except Exception as e:
+            logger.debug("Session %s pump error: %s", self.id, e)
+            reason = "error"
+        finally:
+            self.end_reason = reason
+            _sessions.pop(self.id, None)
+            self._cancel_expiry()
+            client, self.client = self.client, None
+            for viewer in list(self.viewers):
+                self._end_viewer(viewer, reason)
+            await close_shell(self.ssh_conn, self.proc)
+            if self.recorder is not None:
+                await self.recorder.close()
+            logger.info("Terminal session %s on %s closed (%s)", self.id, self.host_name, reason)
+            if client is not None:
+                if client.window is not None:
+                    client.window.ack(client.window.sent)
+                if client.on_end is not None:
+                    try:
+                        await client.on_end(reason)
+                    except Exception as e:
+                        logger.debug("Session %s end notification failed: %s", self.id, e)
+
+    async def _on_output(self, chunk: bytes):
+        self.ring.append(chunk)
+        if self.recorder is not None:
+            self.recorder.output(chunk)
+        if self.viewers:
+            self._wake_viewers()
+        client = self.client
+        if client is not None:
+            await self._flush(client)
+
+    async def _flush(self, client: SessionClient):
+        """Send ``client`` everything between its position and the ring end."""
+        async with self._lock:
+            while self.client is client and not client.skipping:
+                offset, data = self.ring.read_from(client.position)
+                if not data:
+                    return
+                data = data[:SEND_SLICE]
+                client.position = offset + len(data)
+                try:
+                    await client.send(data)
+                except Exception as e:
+                    logger.debug("Session %s client send failed: %s", self.id, e)
+                    self.detach(client)
+                    return
+                if client.window is not None:
+                    client.window.on_sent(len(data))
+                    if client.screen and client.window.paused:
+                        # A full window behind: switch to screen frames
+                        client.skipping = True
+                        self._frame_task = asyncio.create_task(self._skip_frames(client))
+
+    async def _skip_frames(self, client: SessionClient):
+        """Send ``client`` viewport repaints until the output rate drops."""
+        window = client.window
+        interval = 1.0 / term_screen.SCREEN_FPS
+        try:
+            while self.client is client and client.skipping:
+                await asyncio.sleep(interval)
+                if window.in_flight > window.low:
+                    continue  # previous frame not rendered yet
+                async with self._lock:
+                    if self.client is not client:
+                        return
+                    backlog = self.ring.end - client.position
+                    if backlog > 0:
+                        client.position, frame = await self._render_frame(self.ring.end)
+                        await client.send(frame)
+                        window.on_sent(len(frame))
+                        client.frames += 1
+                        client.skipped_bytes += backlog
+                    if backlog < FLUSH_BYTES:
+                        client.skipping = False
+        except Exception as e:
+            logger.debug("Session %s screen frames stopped: %s", self.id, e)
+            self.detach(client)
+            return
+        if self.client is client:
+            await self._flush(client)
+
+    async def _render_frame(self, min_offset: int) -> tuple[int, bytes]:
+        """``(offset, repaint)`` of the screen at some offset >= ``min_offset``.
+
+        Callers waiting on the same render (the owner and any number of
+        viewers) share its result.
+        """
+        async with self._screen_lock:
+            if self._frame is not None and self._frame[0] >= min_offset:
+                return self._frame
+            if self.screen is None:
+                self.screen = term_screen.ScreenModel(self.cols, self.rows, self.ring.start)
+            screen = self.screen
+            end = self.ring.end
+            partial = screen.offset < self.ring.start or end - screen.offset > screen.tail_bytes
+            if partial:
+                _, data = self.ring.tail(screen.tail_bytes)
+            else:
+                _, data = self.ring.read_from(screen.offset)
+            # pyte is slow; keep it off the event loop
+            frame = await asyncio.to_thread(screen.frame, data, end, partial)
+            self._frame = (end, frame)
+            return self._frame
+
+    # relay_output gate: only an attached client with a window can pause the
+    # pump, and not while it is being sent screen frames
+    async def wait_open(self):
+        client = self.client
+        if client is not None and client.window is not None and not client.skipping:
+            await client.window.wait_open()
+
+    def on_sent(self, nbytes: int):
+        pass  # accounted per client in _flush
+
+    # ── Attach / detach ──────────────────────────────────────────────────────
+    async def attach(self, client: SessionClient, offset: int = 0, *,
+                     announce: Callable[[int], Awaitable[None]] | None = None) -> int:
+        """Make ``client`` the viewer, replaying output from ``offset``.
+
+        A client already attached elsewhere is taken over. ``announce`` is
+        awaited with the effective start offset before any output is sent.
+        """
+        previous = self.client
+        if previous is not None and previous is not client:
+            self.detach(previous, expire=False)
+            if previous.on_end is not None:
+                try:
+                    await previous.on_end("taken_over")
+                except Exception as e:
+                    logger.debug("Session %s takeover notification failed: %s", self.id, e)
+        async with self._lock:
+            self._cancel_expiry()
+            self.detached_at = None
+            client.position = min(max(offset, self.ring.start), self.ring.end)
+            self.client = client
+            if announce is not None:
+                await announce(client.position)
+        await self._flush(client)
+        return client.position
+
+    def detach(self, client: SessionClient, *, expire: bool = True) -> None:
+        """Drop ``client`` but keep the shell for the grace period."""
+        if self.client is not client:
+            return
+        self.client = None
+        if client.window is not None:
+            client.window.ack(client.window.sent)  # unblock a pump waiting on this client
+        if self.end_reason is not None or not expire:
+            return
+        self.detached_at = time.time()
+        if DETACH_GRACE:
+            self._expiry = asyncio.get_running_loop().call_later(DETACH_GRACE, self.close, "expired")
+        else:
+            self.close("expired")
+        _enforce_detached_cap(self.username)
+        logger.info("Terminal session %s on %s detached", self.id, self.host_name)
+
+    def close(self, reason: str = "closed") -> None:
+        """End the session; the pump's cleanup closes the shell."""
+        self._close_reason = reason
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def _cancel_expiry(self):
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+
+    # ── Read-only viewers ────────────────────────────────────────────────────
+    def may_watch(self, user: dict) -> bool:
+        return bool(self.shared or user.get("is_admin") or user["username"] == self.username)
+
+    def share(self, enabled: bool) -> None:
+        """Allow (or stop) other users watching; unsharing drops their viewers."""
+        self.shared = enabled
+        if not enabled:
+            for viewer in list(self.viewers):
+                if not (viewer.is_admin or viewer.username == self.username):
+                    self._end_viewer(viewer, "unshared")
+
+    async def watch(self, viewer: SessionViewer) -> None:
+        """Start streaming to ``viewer``; returns when it has been let go."""
+        if len(self.viewers) >= MAX_VIEWERS:
+            raise RuntimeError(f"Session already has {MAX_VIEWERS} viewers")
+        self.viewers.add(viewer)
+        viewer.task = asyncio.create_task(self._serve_viewer(viewer))
+        logger.info("Terminal session %s watched by %s (%d viewers)",
+                    self.id, viewer.username, len(self.viewers))
+        await viewer.done.wait()
+
+    def unwatch(self, viewer: SessionViewer) -> None:
+        self._end_viewer(viewer, "closed")
+
+    def _wake_viewers(self):
+        # Called for every output chunk: O(1) per viewer, never awaits a viewer
+        end = self.ring.end
+        slow = None
+        for viewer in self.viewers:
+            if end - viewer.position > VIEWER_QUEUE_BYTES:
+                now = time.monotonic()
+                if viewer.behind_since is None:
+                    viewer.behind_since = now
+                if not viewer.screen or now - viewer.behind_since > VIEWER_STALL_SECONDS:
+                    slow = slow or []
+                    slow.append(viewer)
+                    continue
+            viewer.wake.set()
+        for viewer in slow or ():
+            self._end_viewer(viewer, "too_slow")
+
+    def _end_viewer(self, viewer: SessionViewer, reason: str):
+        if viewer not in self.viewers:
+            return
+        self.viewers.discard(viewer)
+        viewer.end_reason = reason
+        if viewer.task is not None and viewer.task is not asyncio.current_task():
+            viewer.task.cancel()
+        if viewer.window is not None:
+            viewer.window.ack(viewer.window.sent)
+        viewer.done.set()
+        if reason == "too_slow":
+            logger.info("Terminal session %s dropped slow viewer %s", self.id, viewer.username)
+
+    async def _serve_viewer(self, viewer: SessionViewer):
+        """Drain one viewer's queue: raw output, or a repaint once it falls behind."""
+        interval = 1.0 / term_screen.SCREEN_FPS
+        last_frame = 0.0
+        reason = "error"
+        try:
+            # Screen-mode viewers join with a repaint of the current screen;
+            # others get as much of the scrollback as their queue holds
+            repaint = viewer.screen
+            viewer.position = self.ring.end if repaint else max(self.ring.start, self.ring.end - VIEWER_QUEUE_BYTES)
+            viewer.wake.set()
+            while True:
+                await viewer.wake.wait()
+                viewer.wake.clear()
+                if viewer.size != (self.cols, self.rows):
+                    viewer.size = (self.cols, self.rows)
+                    if viewer.on_size is not None:
+                        await viewer.on_size(self.cols, self.rows)
+                while repaint or viewer.position < self.ring.end:
+                    if viewer.window is not None:
+                        await viewer.window.wait_open()
+                    end = self.ring.end
+                    behind = end - viewer.position > VIEWER_QUEUE_BYTES or viewer.position < self.ring.start
+                    if viewer.screen and (behind or repaint):
+                        wait = last_frame + interval - time.monotonic()
+                        if wait > 0:
+                            await asyncio.sleep(wait)
+                        # A repaint rendered for another viewer will do if it
+                        # leaves this one at most half a queue behind
+                        offset, data = await self._render_frame(self.ring.end - VIEWER_QUEUE_BYTES // 2)
+                        repaint = False
+                        last_frame = time.monotonic()
+                        viewer.skipped_bytes += max(0, offset - viewer.position)
+                        viewer.frames += 1
+                    elif behind:
+                        reason = "too_slow"
+                        return
+                    else:
+                        offset, data = self.ring.read_from(viewer.position)
+                        data = data[:SEND_SLICE]
+                        offset += len(data)
+                    viewer.position = offset
+                    await viewer.send(data)
+                    if viewer.window is not None:
+                        viewer.window.on_sent(len(data))
+                    if self.ring.end - viewer.position <= VIEWER_QUEUE_BYTES:
+                        viewer.behind_since = None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.debug("Session %s viewer %s send failed: %s", self.id, viewer.username, e)
+        finally:
+            self._end_viewer(viewer, reason)
+
+    # ── Input ────────────────────────────────────────────────────────────────
+    def write(self, data: bytes) -> None:
+        if self.end_reason is None and not self.proc.stdin.is_closing():
+            self.proc.stdin.write(data)
+            if self.recorder is not None:
+                self.recorder.input(data)
+
+    async def drain(self) -> None:
+        await self.proc.stdin.drain()
+
+    def resize(self, cols: int, rows: int) -> None:
+        self.proc.change_terminal_size(cols, rows)
+        self.cols, self.rows = cols, rows
+        if self.screen is not None:
+            self.screen.resize(cols, rows)
+        self._frame = None
+        for viewer in self.viewers:
+            viewer.wake.set()
+        if self.recorder is not None:
+            self.recorder.resize(cols, rows)
+
+    # ── Monitoring ───────────────────────────────────────────────────────────
+    @property
+    def attached(self) -> bool:
+        return self.client is not None
+
+    def describe(self) -> dict:
+        client = self.client
+        info = {
+            "id": self.id,
+            "user": self.username,
+            "host_id": self.host_id,
+            "host_name": self.host_name,
+            "started": int(self.started),
+            "state": "attached" if client else "detached",
+            "transport": client.transport if client else None,
+            "offset": self.ring.end,
+            "buffer": self.ring.stats(),
+            "flow_control": bool(client and client.window),
+            "window": client.window.stats() if client and client.window else None,
+            "screen": {
+                "skipping": client.skipping,
+                "frames": client.frames,
+                "skipped_bytes": client.skipped_bytes,
+            } if client and client.screen else None,
+            "recording": self.recorder.stats() if self.recorder else None,
+            "shared": self.shared,
+            "viewers": [v.stats(self.ring.end) for v in self.viewers],
+        }
+        if self.detached_at is not None:
+            info["detached_for"] = round(time.time() - self.detached_at, 1)
+            info["expires_in"] = max(0, round(self.detached_at + DETACH_GRACE - time.time(), 1))
+        return info
+
+
+# ─── Registry (per worker) ──────────────────────────────────────────────────────
+_sessions: dict[str, TerminalSession] = {}
+
+
+def start_session(user: dict, host, ssh_conn, proc,
+                  cols: int | None = None, rows: int | None = None) -> TerminalSession:
+    """Wrap an open shell in a session and start pumping its output."""
+    term = TerminalSession(user, host, ssh_conn, proc, cols, rows)
+    _sessions[term.id] = term
+    term.start()
+    logger.info("Terminal session %s started on %s for %s", term.id, term.host_name, term.username)
+    return term
+
+
+def get_session(session_id: str, user: dict, host_id: int) -> TerminalSession | None:
+    """A live session owned by ``user`` on ``host_id``, else None."""
+    term = _sessions.get(session_id or "")
+    if term is None or term.end_reason is not None:
+        return None
+    if term.username != user["username"] or term.host_id != host_id:
+        return None
+    return term
+
+
+def find_watchable(session_id: str, user: dict) -> TerminalSession | None:
+    """A live session ``user`` may watch read-only, else None."""
+    term = _sessions.get(session_id or "")
+    if term is None or term.end_reason is not None or not term.may_watch(user):
+        return None
+    return term
+
+
+def list_sessions(user: dict) -> list[dict]:
+    """Sessions visible to ``user`` (all of them for admins)."""
+    return [
+        t.describe() for t in _sessions.values()
+        if user.get("is_admin") or t.username == user["username"]
+    ]
+
+
+def _enforce_detached_cap(username: str) -> None:
+    detached = sorted(
+        (t for t in _sessions.values() if t.username == username and t.detached_at is not None),
+        key=lambda t: t.detached_at,
+    )
+    for term in detached[:max(0, len(detached) - MAX_DETACHED_PER_USER)]:
+        term.close("evicted")
@@ -2,14 +2,21 @@
 
 import logging
 import asyncio
+import codecs
+import json
 import socket
 
 from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 
 import asyncssh
-import db
+import host_cache
+import ssh_pool
+import term_sessions
+from term_relay import mux_frame, FlowWindow
+from term_sessions import close_shell
+from settings import env_int
 
 # ─── Logging Setup ──────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -30,13 +37,7 @@ async def terminal_page(request: Request, host_id: int):
         return RedirectResponse("/login", status_code=302)
 
     # 2) Fetch host record (and enforce permissions)
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT name, host FROM hosts WHERE id = ? AND (user_id = ? OR ?)",
-        (host_id, user["id"], int(user["is_admin"]))
-    )
-    host = cursor.fetchone()
+    host = await host_cache.get_host(user, host_id)
     if not host:
         return RedirectResponse("/dashboard", status_code=302)
 
@@ -62,6 +63,388 @@ async def safe_websocket_send(websocket: WebSocket, message: str) -> bool:
         logger.debug("Failed to send WebSocket message: %s", e)
     return False
 
+# ─── Shared SSH session helpers ────────────────────────────────────────────────
+async def _fetch_host(user: dict, host_id: int):
+    """Host row if it exists and the user may use it, else None."""
+    return await host_cache.get_host(user, host_id)
+
+def _connect_error_message(host, exc: BaseException) -> str:
+    """Terminal-friendly explanation for a failed SSH connect."""
+    if isinstance(exc, asyncio.TimeoutError):
+        logger.warning("SSH connection timeout to %s", host["host"])
+        return (f"\r\n*** ⏱️ Connection timeout to {host['host']} ***\r\n"
+                "*** The host might be down or unreachable ***\r\n")
+    if isinstance(exc, ConnectionRefusedError):
+        logger.warning("SSH connection refused to %s", host["host"])
+        return (f"\r\n*** ❌ Connection refused by {host['host']} ***\r\n"
+                "*** SSH service is not running or host is down ***\r\n")
+    if isinstance(exc, socket.gaierror):
+        logger.warning("DNS resolution failed for %s: %s", host["host"], exc)
+        return (f"\r\n*** 🌐 DNS resolution failed for {host['host']} ***\r\n"
+                f"*** {str(exc)} ***\r\n")
+    if isinstance(exc, asyncssh.PermissionDenied):
+        logger.warning("SSH authentication failed for %s@%s", host["username"], host["host"])
+        return (f"\r\n*** 🔐 Authentication failed for {host['username']}@{host['host']} ***\r\n"
+                "*** Please check username and password ***\r\n")
+    if isinstance(exc, asyncssh.Error):
+        logger.warning("SSH error connecting to %s: %s", host["host"], exc)
+        return (f"\r\n*** 🔧 SSH error connecting to {host['host']} ***\r\n"
+                f"*** {str(exc)} ***\r\n")
+    logger.error("Unexpected SSH connection error to %s: %r", host["host"], exc)
+    return (f"\r\n*** ⚠️ Unexpected error connecting to {host['host']} ***\r\n"
+            f"*** {str(exc)} ***\r\n")
+
+async def _open_shell(host, cols: int | None = None, rows: int | None = None):
+    """Lease a pooled connection and start an interactive shell on it.
+
+    Returns ``(ssh_conn, proc)``; release both with :func:`term_sessions.close_shell`.
+    """
+    logger.info("Connecting to SSH %s@%s", host["username"], host["host"])
+    # Reuses a pooled connection for the same host/user/credential when one is live
+    ssh_conn = await ssh_pool.pool.acquire(
+        host["host"],
+        host["username"],
+        host["password"],
+        connect_timeout=10  # 10 second connection timeout
+    )
+    try:
+        term_size = (cols, rows) if cols and rows else None
+        # Raw bytes end to end: the browser decodes UTF-8, so chunks may split characters
+        proc = await ssh_conn.create_process(term_type="xterm", term_size=term_size, encoding=None)
+    except BaseException:
+        # A pooled connection that cannot open channels is not worth keeping
+        await ssh_pool.pool.release(ssh_conn, discard=True)
+        raise
+    logger.info("SSH interactive process created")
+    return ssh_conn, proc
+
+@router.get("/api/terminal/sessions")
+async def terminal_sessions(request: Request):
+    """Terminal sessions on this worker, attached and detached (own, or all for admins)."""
+    user = request.session.get("user")
+    if not user:
+        return JSONResponse({"detail": "Unauthorized"}, status_code=401)
+    sessions = term_sessions.list_sessions(user)
+    return JSONResponse({
+        "sessions": sessions,
+        "detached": sum(1 for t in sessions if t["state"] == "detached"),
+        "memory_bytes": sum(t["buffer"]["memory_bytes"] for t in sessions),
+        "scrollback_bytes": term_sessions.SCROLLBACK_BYTES,
+        "detach_grace": term_sessions.DETACH_GRACE,
+    })
+
+@router.post("/api/terminal/sessions/{session_id}/share")
+async def share_terminal_session(request: Request, session_id: str):
+    """Let other signed-in users watch a session read-only (owner or admin)."""
+    user = request.session.get("user")
+    if not user:
+        return JSONResponse({"detail": "Unauthorized"}, status_code=401)
+    term = term_sessions.find_watchable(session_id, user)
+    if term is None or not (user.get("is_admin") or term.username == user["username"]):
+        return JSONResponse({"detail": "Session not found"}, status_code=404)
+    try:
+        body = await request.json()
+    except ValueError:
+        body = {}
+    term.share(bool(body.get("enabled", True)))
+    return JSONResponse({
+        "session": term.id,
+        "shared": term.shared,
+        "watch_url": f"/terminal/watch/{term.id}",
+        "viewers": len(term.viewers),
+    })
+
+@router.get("/terminal/watch/{session_id}")
+async def terminal_watch_page(request: Request, session_id: str):
+    user = request.session.get("user")
+    if not user:
+        return RedirectResponse("/login", status_code=302)
+    term = term_sessions.find_watchable(session_id, user)
+    if term is None:
+        return RedirectResponse("/dashboard", status_code=302)
+    return templates.TemplateResponse("terminal_watch.html", {
+        "request": request,
+        "session_id": term.id,
+        "owner": term.username,
+        "host_name": term.host_name,
+        "title": f"Watching {term.username} - {term.host_name}"
+    })
+
+@router.websocket("/ws/watch/{session_id}")
+async def websocket_watch(websocket: WebSocket, session_id: str):
+    """Read-only view of a live session.
+
+    Output arrives as binary frames. Text frames carry JSON notices:
+    ``{"type": "size", "cols", "rows"}`` whenever the owner's terminal
+    changes size and ``{"type": "ended", "reason"}`` at the end. With
+    ``?flow=1`` the client acks rendered bytes with binary JSON
+    ``{"type": "ack", "bytes": <cumulative>}``; ``?screen=1`` allows repaints
+    in place of a backlog. Keystrokes are ignored.
+    """
+    await websocket.accept()
+    user = websocket.scope.get("session", {}).get("user")
+    term = term_sessions.find_watchable(session_id, user) if user else None
+    if term is None:
+        await safe_websocket_send(websocket, json.dumps({"type": "ended", "reason": "not_found"}))
+        await websocket.close()
+        return
+
+    params = websocket.query_params
+    window = FlowWindow() if params.get("flow") == "1" else None
+
+    async def on_size(cols: int, rows: int):
+        await websocket.send_text(json.dumps({"type": "size", "cols": cols, "rows": rows}))
+
+    viewer = term_sessions.SessionViewer(user, "watch", websocket.send_bytes, on_size=on_size,
+                                         window=window, screen=params.get("screen") == "1")
+
+    async def receive():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("bytes") is not None and window is not None:
+                    try:
+                        ctl = json.loads(message["bytes"])
+                        if ctl.get("type") == "ack":
+                            window.ack(int(ctl.get("bytes") or 0))
+                    except Exception as e:
+                        logger.debug("Ignoring bad control frame: %s", e)
+        except Exception as e:
+            logger.debug("Watch WebSocket receive ended: %s", e)
+
+    receiver = asyncio.create_task(receive())
+    receiver.add_done_callback(lambda _: term.unwatch(viewer))
+    try:
+        await term.watch(viewer)
+        await safe_websocket_send(websocket, json.dumps({"type": "ended", "reason": viewer.end_reason}))
+    except RuntimeError as e:
+        await safe_websocket_send(websocket, json.dumps({"type": "ended", "reason": "full", "detail": str(e)}))
+    finally:
+        receiver.cancel()
+        term.unwatch(viewer)
+        try:
+            if websocket.client_state.name == "CONNECTED":
+                await websocket.close()
+        except Exception as e:
+            logger.debug("Error closing watch WebSocket: %s", e)
+
+# ─── Multiplexed terminals: many channels over one WebSocket ──────────────────
+MUX_MAX_CHANNELS = env_int("TERMINAL_MUX_MAX_CHANNELS", 64)
+MUX_OUTBOX_FRAMES = 256  # bounded so a slow browser stalls the SSH readers, not memory
+
+class _MuxChannel:
+    __slots__ = ("ch", "host_id", "task", "term", "client")
+
+    def __init__(self, ch: int, host_id: int):
+        self.ch = ch
+        self.host_id = host_id
+        self.task: asyncio.Task | None = None
+        self.term: term_sessions.TerminalSession | None = None
+        self.client: term_sessions.SessionClient | None = None
+
+@router.websocket("/ws/mux")
+async def websocket_mux(websocket: WebSocket):
+    """One WebSocket carrying many terminal channels.
+
+    Client frames (JSON): ``open`` {ch, host_id, cols, rows, flow, screen,
+    session, offset}, ``data`` {ch, data}, ``resize`` {ch, cols, rows}, ``ack`` {ch,
+    bytes}, ``detach`` {ch}, ``close`` {ch}. Server frames: ``opened``,
+    ``session`` {session, offset, resumed}, ``data`` and ``closed`` tagged with
+    the same ``ch``; terminal output is sent as binary frames of a 4-byte
+    channel id followed by raw bytes. Channels opened with ``flow: true`` must
+    ack the output bytes they have rendered since ``session`` or their reader
+    pauses.
+
+    ``screen: true`` (with ``flow``) lets the server replace a backlog with
+    viewport repaints when the channel falls a full window behind.
+
+    ``close`` ends the shell. ``detach`` or a dropped socket only detaches it;
+    an ``open`` carrying the ``session`` id and the last received stream
+    offset resumes it within the grace period.
+    """
+    await websocket.accept()
+
+    session = websocket.scope.get("session", {})
+    user = session.get("user")
+    if not user:
+        logger.warning("Unauthorized mux WS attempt")
+        await safe_websocket_send(websocket, json.dumps({"type": "error", "message": "Unauthorized"}))
+        await websocket.close(code=1008)
+        return
+
+    logger.info("Mux WebSocket opened for user=%s", user["username"])
+    channels: dict[int, _MuxChannel] = {}
+    outbox: asyncio.Queue = asyncio.Queue(maxsize=MUX_OUTBOX_FRAMES)
+
+    async def emit(frame: dict):
+        await outbox.put(frame)
+
+    def end_channel(chan: _MuxChannel, reason: str):
+        if channels.get(chan.ch) is chan:
+            channels.pop(chan.ch)
+            try:
+                outbox.put_nowait({"type": "closed", "ch": chan.ch, "reason": reason})
+            except asyncio.QueueFull:
+                pass
+
+    async def writer():
+        try:
+            while True:
+                frame = await outbox.get()
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(json.dumps(frame, ensure_ascii=False))
+        except Exception as e:
+            logger.debug("Mux writer stopped: %s", e)
+
+    async def run_channel(chan: _MuxChannel, msg: dict):
+        ch = chan.ch
+        ssh_conn = proc = None
+        fresh = False
+        try:
+            host = await _fetch_host(user, chan.host_id)
+            if not host:
+                logger.warning("Host not found or access denied: host_id=%s user=%s", chan.host_id, user["username"])
+                await emit({"type": "data", "ch": ch, "data": "\r\n*** ❌ Host not found or access denied ***\r\n"})
+                end_channel(chan, "denied")
+                return
+
+            term = term_sessions.get_session(msg.get("session"), user, chan.host_id)
+            resumed = term is not None
+            if term is None:
+                await emit({"type": "data", "ch": ch, "data": f"\r\n🔌 Connecting to {host['username']}@{host['host']}...\r\n"})
+                try:
+                    ssh_conn, proc = await asyncio.wait_for(
+                        _open_shell(host, msg.get("cols"), msg.get("rows")), timeout=15
+                    )
+                except Exception as e:
+                    await emit({"type": "data", "ch": ch, "data": _connect_error_message(host, e)})
+                    end_channel(chan, "connect_failed")
+                    return
+                term = term_sessions.start_session(user, host, ssh_conn, proc, msg.get("cols"), msg.get("rows"))
+                ssh_conn = proc = None  # owned by the session now
+                fresh = True
+            chan.term = term
+
+            async def send_output(chunk: bytes):
+                await outbox.put(mux_frame(ch, chunk))
+
+            async def on_end(reason: str):
+                if reason == "ended":
+                    try:
+                        outbox.put_nowait({"type": "data", "ch": ch, "data": "\r\n*** 📡 SSH session ended ***\r\n"})
+                    except asyncio.QueueFull:
+                        pass
+                end_channel(chan, reason)
+
+            async def announce(offset: int):
+                await emit({"type": "session", "ch": ch, "session": term.id,
+                            "offset": offset, "resumed": resumed})
+
+            chan.client = term_sessions.SessionClient(
+                "mux", send_output, window=FlowWindow() if msg.get("flow") else None,
+                on_end=on_end, screen=bool(msg.get("screen"))
+            )
+            if resumed:
+                offset = int(msg.get("offset") or 0)
+                if msg.get("cols") and msg.get("rows"):
+                    term.resize(int(msg["cols"]), int(msg["rows"]))
+            else:
+                offset = 0
+                await emit({"type": "data", "ch": ch, "data": f"✅ Connected to {host['name']}\r\n\r\n"})
+            await term.attach(chan.client, offset, announce=announce)
+        except asyncio.CancelledError:
+            # Closed or detached before the shell was ever shown: nobody can resume it
+            if fresh and chan.term is not None and not chan.term.attached:
+                chan.term.close()
+            raise
+        except Exception as e:
+            logger.debug("Mux channel %s error: %s", ch, e)
+            end_channel(chan, "error")
+        finally:
+            await close_shell(ssh_conn, proc)
+
+    writer_task = asyncio.create_task(writer())
+    try:
+        # Single inbound relay loop dispatching to every channel on this socket
+        while True:
+            try:
+                msg = json.loads(await websocket.receive_text())
+                ch = int(msg.get("ch"))
+            except (ValueError, TypeError, AttributeError):
+                continue
+            kind = msg.get("type")
+            chan = channels.get(ch)
+
+            if kind == "data":
+                if chan and chan.term:
+                    chan.term.write((msg.get("data") or "").encode("utf-8"))
+            elif kind == "ack":
+                if chan and chan.client and chan.client.window:
+                    try:
+                        chan.client.window.ack(int(msg.get("bytes") or 0))
+                    except (ValueError, TypeError):
+                        pass
+            elif kind == "resize":
+                if chan and chan.term:
+                    try:
+                        chan.term.resize(int(msg["cols"]), int(msg["rows"]))
+                    except Exception as e:
+                        logger.debug("Resize failed on mux channel %s: %s", ch, e)
+            elif kind == "open":
+                if chan is not None or len(channels) >= MUX_MAX_CHANNELS:
+                    await emit({"type": "closed", "ch": ch, "reason": "rejected"})
+                    continue
+                try:
+                    host_id = int(msg.get("host_id"))
+                except (ValueError, TypeError):
+                    await emit({"type": "closed", "ch": ch, "reason": "rejected"})
+                    continue
+                chan = channels[ch] = _MuxChannel(ch, host_id)
+                await emit({"type": "opened", "ch": ch})
+                chan.task = asyncio.create_task(run_channel(chan, msg))
+            elif kind in ("close", "detach"):
+                if chan:
+                    channels.pop(ch, None)
+                    if chan.task and not chan.task.done():
+                        chan.task.cancel()
+                    if kind == "detach":
+                        if chan.term and chan.client:
+                            chan.term.detach(chan.client)
+                    else:
+                        if chan.term:
+                            chan.term.close()
+                        await emit({"type": "closed", "ch": ch, "reason": "closed"})
+    except WebSocketDisconnect:
+        logger.info("Mux WebSocket disconnected by client")
+    except Exception as e:
+        logger.debug("Error in mux relay: %s", e)
+    finally:
+        # Sessions outlive the socket: detach them so the page can resume
+        tasks = []
+        for chan in channels.values():
+            if chan.task and not chan.task.done():
+                chan.task.cancel()
+                tasks.append(chan.task)
+            if chan.term and chan.client:
+                chan.term.detach(chan.client)
+        channels.clear()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # Wake session pumps blocked on the full outbox; nothing drains it now
+        while not outbox.empty():
+            outbox.get_nowait()
+        writer_task.cancel()
+        try:
+            if websocket.client_state.name == "CONNECTED":
+                await websocket.close()
+        except Exception as e:
+            logger.debug("Error closing mux WebSocket: %s", e)
+        logger.info("Mux WebSocket cleanup completed")
+
 @router.websocket("/ws/{host_id}")
 async def websocket_terminal(websocket: WebSocket, host_id: int):
     await websocket.accept()
@@ -69,6 +452,9 @@ async def websocket_terminal(websocket: WebSocket, host_id: int):
 
     ssh_conn = None
     proc = None
+    term = None
+    client = None
+    fresh = False
 
     try:
         # ── Session check ────────────────────────────────────────────────────────────
@@ -82,13 +468,7 @@ async def websocket_terminal(websocket: WebSocket, host_id: int):
             return
 
         # ── Fetch host entry ─────────────────────────────────────────────────────────
-        conn = db.get_db()
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT * FROM hosts WHERE id = ? AND (user_id = ? OR ?)",
-            (host_id, user["id"], int(user["is_admin"]))
-        )
-        host = cursor.fetchone()
+        host = await _fetch_host(user, host_id)
         if not host:
             logger.warning("Host not found or access denied: host_id=%s user=%s", host_id, user["username"])
             await safe_websocket_send(websocket, "\r\n*** ❌ Host not found or access denied ***\r\n")
@@ -96,118 +476,94 @@ async def websocket_terminal(websocket: WebSocket, host_id: int):
             await websocket.close()
             return
 
-        # ── Send connection status ────────────────────────────────────────────────────
-        await safe_websocket_send(websocket, f"\r\n🔌 Connecting to {host['username']}@{host['host']}...\r\n")
+        # ── Resume a detached session (?session=<id>&offset=<n>) or open a new one ──
+        params = websocket.query_params
+        term = term_sessions.get_session(params.get("session"), user, host_id)
+        resumed = term is not None
+        if term is None:
+            # ── Send connection status ────────────────────────────────────────────────
+            await safe_websocket_send(websocket, f"\r\n🔌 Connecting to {host['username']}@{host['host']}...\r\n")
 
-        try:
-            # ── Establish SSH connection with timeout ──────────────────────────────────
-            logger.info("Connecting to SSH %s@%s", host["username"], host["host"])
-            
-            ssh_conn = await asyncio.wait_for(
-                asyncssh.connect(
-                    host["host"],
-                    username=host["username"],
-                    password=host["password"],
-                    known_hosts=None,
-                    connect_timeout=10,  # 10 second connection timeout
-                    keepalive_interval=30  # Keep connection alive
-                ),
-                timeout=15  # Overall timeout of 15 seconds
-            )
-            
-            logger.info("SSH connection established")
+            try:
+                # ── Establish SSH connection and interactive shell with timeout ────────
+                ssh_conn, proc = await asyncio.wait_for(
+                    _open_shell(host),
+                    timeout=15  # Overall timeout of 15 seconds
+                )
+                logger.info("SSH connection established")
+            except Exception as e:
+                await safe_websocket_send(websocket, _connect_error_message(host, e))
+                await asyncio.sleep(2)
+                await websocket.close()
+                return
+            term = term_sessions.start_session(user, host, ssh_conn, proc)
+            ssh_conn = proc = None  # owned by the session now
+            fresh = True
             await safe_websocket_send(websocket, f"✅ Connected to {host['name']}\r\n\r\n")
 
-            # ── Start an interactive shell process ────────────────────────────────────
-            proc = await ssh_conn.create_process(term_type="xterm")
-            logger.info("SSH interactive process created")
-
-        except asyncio.TimeoutError:
-            error_msg = f"\r\n*** ⏱️ Connection timeout to {host['host']} ***\r\n"
-            error_msg += "*** The host might be down or unreachable ***\r\n"
-            logger.warning("SSH connection timeout to %s", host["host"])
-            await safe_websocket_send(websocket, error_msg)
-            await asyncio.sleep(2)
-            await websocket.close()
-            return
-
-        except ConnectionRefusedError:
-            error_msg = f"\r\n*** ❌ Connection refused by {host['host']} ***\r\n"
-            error_msg += "*** SSH service is not running or host is down ***\r\n"
-            logger.warning("SSH connection refused to %s", host["host"])
-            await safe_websocket_send(websocket, error_msg)
-            await asyncio.sleep(2)
-            await websocket.close()
-            return
-
-        except socket.gaierror as e:
-            error_msg = f"\r\n*** 🌐 DNS resolution failed for {host['host']} ***\r\n"
-            error_msg += f"*** {str(e)} ***\r\n"
-            logger.warning("DNS resolution failed for %s: %s", host["host"], e)
-            await safe_websocket_send(websocket, error_msg)
-            await asyncio.sleep(2)
-            await websocket.close()
-            return
-
-        except asyncssh.PermissionDenied:
-            error_msg = f"\r\n*** 🔐 Authentication failed for {host['username']}@{host['host']} ***\r\n"
-            error_msg += "*** Please check username and password ***\r\n"
-            logger.warning("SSH authentication failed for %s@%s", host["username"], host["host"])
-            await safe_websocket_send(websocket, error_msg)
-            await asyncio.sleep(2)
-            await websocket.close()
-            return
-
-        except asyncssh.Error as e:
-            error_msg = f"\r\n*** 🔧 SSH error connecting to {host['host']} ***\r\n"
-            error_msg += f"*** {str(e)} ***\r\n"
-            logger.warning("SSH error connecting to %s: %s", host["host"], e)
-            await safe_websocket_send(websocket, error_msg)
-            await asyncio.sleep(2)
-            await websocket.close()
-            return
-
-        except Exception as e:
-            error_msg = f"\r\n*** ⚠️ Unexpected error connecting to {host['host']} ***\r\n"
-            error_msg += f"*** {str(e)} ***\r\n"
-            logger.exception("Unexpected SSH connection error to %s", host["host"])
-            await safe_websocket_send(websocket, error_msg)
-            await asyncio.sleep(2)
-            await websocket.close()
-            return
-
         # ── Relay data from SSH → WebSocket ──────────────────────────────────────
-        async def ssh_to_ws():
-            try:
-                while True:
-                    data = await proc.stdout.read(1024)
-                    if not data:
-                        logger.info("SSH process stdout EOF")
-                        break
-                    
-                    # Only send if WebSocket is still connected
-                    if not await safe_websocket_send(websocket, data):
-                        logger.info("WebSocket disconnected, stopping SSH->WS relay")
-                        break
-                        
-            except Exception as e:
-                logger.debug("Error reading from SSH stdout: %s", e)
-            finally:
+        # Clients that pass ?binary=1 get raw binary frames; others get text.
+        # ?flow=1 (binary only) enables the ack window: the client sends binary
+        # JSON control frames {"type": "ack", "bytes": <cumulative>}. ?screen=1
+        # on top of that allows screen frames in place of a backlog.
+        binary = params.get("binary") == "1"
+        window = FlowWindow() if binary and params.get("flow") == "1" else None
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        ended = asyncio.Event()
+
+        async def send_output(chunk: bytes):
+            # Send errors detach this client from the session (WebSocket is gone)
+            if binary:
+                await websocket.send_bytes(chunk)
+            else:
+                text = decoder.decode(chunk)
+                if text:
+                    await websocket.send_text(text)
+
+        async def on_end(reason: str):
+            if reason == "taken_over":
+                await safe_websocket_send(websocket, "\r\n*** 🔀 Session attached from another window ***\r\n")
+            else:
                 # Signal that SSH output ended
                 await safe_websocket_send(websocket, "\r\n*** 📡 SSH session ended ***\r\n")
+            ended.set()
+
+        client = term_sessions.SessionClient("ws", send_output, window=window, on_end=on_end,
+                                             screen=params.get("screen") == "1")
+        try:
+            offset = int(params.get("offset") or 0) if resumed else 0
+        except ValueError:
+            offset = 0
+        await term.attach(client, offset)
 
         # ── Relay data from WebSocket → SSH ──────────────────────────────────────
+        def handle_control(raw: bytes):
+            try:
+                ctl = json.loads(raw)
+                if ctl.get("type") == "ack" and window is not None:
+                    window.ack(int(ctl.get("bytes") or 0))
+                elif ctl.get("type") == "resize":
+                    term.resize(int(ctl["cols"]), int(ctl["rows"]))
+            except Exception as e:
+                logger.debug("Ignoring bad control frame: %s", e)
+
         async def ws_to_ssh():
             try:
                 while True:
-                    msg = await websocket.receive_text()
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        raise WebSocketDisconnect(message.get("code", 1000))
+                    if message.get("bytes") is not None:
+                        handle_control(message["bytes"])
+                        continue
+                    msg = message.get("text") or ""
                     logger.debug("<- WS → SSH: %r", msg)
                     
-                    if proc and not proc.stdin.is_closing():
-                        proc.stdin.write(msg)
-                        await proc.stdin.drain()
+                    if term.end_reason is None:
+                        term.write(msg.encode("utf-8"))
+                        await term.drain()
                     else:
-                        logger.debug("SSH process stdin is closed, dropping message")
+                        logger.debug("SSH session has ended, dropping message")
                         break
                         
             except WebSocketDisconnect:
@@ -215,15 +571,14 @@ async def websocket_terminal(websocket: WebSocket, host_id: int):
             except Exception as e:
                 logger.debug("Error in WS->SSH relay: %s", e)
 
-        # ── Run both loops concurrently ───────────────────────────────────────────
+        # ── Run until the browser leaves or the shell ends ───────────────────────
+        relay = asyncio.create_task(ws_to_ssh())
+        ended_wait = asyncio.create_task(ended.wait())
         try:
-            await asyncio.gather(
-                ssh_to_ws(), 
-                ws_to_ssh(), 
-                return_exceptions=True
-            )
-        except Exception as e:
-            logger.debug("Error in data relay: %s", e)
+            await asyncio.wait({relay, ended_wait}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            relay.cancel()
+            ended_wait.cancel()
 
     except WebSocketDisconnect:
         logger.info("WebSocket disconnected during connection setup")
@@ -234,27 +589,13 @@ async def websocket_terminal(websocket: WebSocket, host_id: int):
 
     finally:
         # ── Clean shutdown ───────────────────────────────────────────────────────
-        logger.info("Cleaning up SSH connection for host_id=%s", host_id)
-        
-        # Close SSH process if it exists
-        if proc:
-            try:
-                if not proc.stdin.is_closing():
-                    proc.stdin.close()
-                if not proc.is_closing():
-                    proc.close()
-                await proc.wait_closed()
-            except Exception as e:
-                logger.debug("Error closing SSH process: %s", e)
-
-        # Close SSH connection if it exists
-        if ssh_conn:
-            try:
-                if not ssh_conn.is_closing():
-                    ssh_conn.close()
-                await ssh_conn.wait_closed()
-            except Exception as e:
-                logger.debug("Error closing SSH connection: %s", e)
+        # The shell survives a dropped socket for the detach grace period
+        if term is not None:
+            if client is not None:
+                term.detach(client)
+            elif fresh:
+                term.close()
+        await close_shell(ssh_conn, proc)
 
         # Close WebSocket if still open
         try:
@@ -263,7 +604,7 @@ async def websocket_terminal(websocket: WebSocket, host_id: int):
         except Exception as e:
             logger.debug("Error closing WebSocket: %s", e)
 
-        logger.info("SSH connection cleanup completed for host_id=%s", host_id)
+        logger.info("WebSocket cleanup completed for host_id=%s", host_id)
 
 @router.get("/terminal-combined")
 async def combined_terminal_page(request: Request, host_id: int):
@@ -274,13 +615,7 @@ async def combined_terminal_page(request: Request, host_id: int):
         return RedirectResponse("/login", status_code=302)
 
     # 2) Fetch host record (and enforce permissions)
-    conn = db.get_db()
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT name, host FROM hosts WHERE id = ? AND (user_id = ? OR ?)",
-        (host_id, user["id"], int(user["is_admin"]))
-    )
-    host = cursor.fetchone()
+    host = await host_cache.get_host(user, host_id)
     if not host:
         return RedirectResponse("/dashboard", status_code=302)
 
@@ -0,0 +1,232 @@
+# upload_runner.py
+"""Send one uploaded file to many hosts at once and report transfer progress.
+
+An :class:`UploadRun` works through the hosts with ``UPLOAD_CONCURRENCY``
+workers. A run may ask for fewer. Each worker connects through the SSH pool,
+makes the remote directory and places the file through the host's
+:mod:`artifact_cache`, then takes the next host. Transfers go through
+:func:`sftp_transfer.put`. All of a run's transfers share one
+:class:`sftp_transfer.Throttle`: the run's own cap, if it asked for one,
+under the worker-wide ``UPLOAD_MAX_MB_PER_SEC``.
+
+Events go on the :attr:`UploadRun.events` queue, with None at the end:
+
+* ``log``: a line for the upload log, as FileUploader always wrote them.
+* ``progress``: every ``PROGRESS_INTERVAL`` seconds, the hosts whose transfer
+  moved since the last one. Each has bytes sent, total, rate and ETA, and
+  the run's aggregate bytes and rate are included. Progress callbacks only
+  record the count, so the event rate does not depend on block size or host
+  count.
+* ``summary``: per-host outcome, bytes sent and the aggregate MB/s.
+
+Cancelling :meth:`UploadRun.run` (the client went away) stops every transfer.
+"""
+
+import asyncio
+import logging
+import secrets
+import time
+
+import artifact_cache
+import sftp_transfer
+import ssh_pool
+import tcp_probe
+from settings import env_int
+
+logger = logging.getLogger("ssh_portal.upload_runner")
+
+
+CONCURRENCY = max(1, env_int("UPLOAD_CONCURRENCY", 16))    # hosts at once; a run may ask for fewer
+PROGRESS_INTERVAL = 0.5         # seconds between progress events
+QUEUE_EVENTS = 256              # events waiting for the client before hosts pause
+MB = 1048576
+
+
+class _Transfer:
+    """Bytes sent to one host so far."""
+
+    __slots__ = ("total", "sent", "started", "reported")
+
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self.started = time.monotonic()
+        self.reported = -1
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def progress(self, host: str) -> dict:
+        rate = self.rate()
+        return {"host": host, "sent": self.sent, "total": self.total, "rate": round(rate),
+                "eta_sec": round((self.total - self.sent) / rate, 1) if rate else None}
+
+
+class UploadRun:
+    """One file to a list of hosts."""
+
+    def __init__(self, artifact: artifact_cache.Artifact, hosts: list[str], ssh_user: str, ssh_pass: str,
+                 remote_path: str, *, probe: bool = True, concurrency: int = CONCURRENCY,
+                 max_mb_per_sec: int = 0):
+        self.id = secrets.token_hex(8)
+        self.artifact = artifact
+        self.hosts = hosts
+        self.ssh_user = ssh_user
+        self.ssh_pass = ssh_pass
+        self.remote_dir = remote_path.rstrip("/")
+        self.probe = probe
+        self.concurrency = max(1, min(concurrency, CONCURRENCY, len(hosts) or 1))
+        self.throttle = sftp_transfer.Throttle(max(0, max_mb_per_sec) * MB, parent=sftp_transfer.outbound)
+        self.events: asyncio.Queue[dict | None] = asyncio.Queue(maxsize=QUEUE_EVENTS)
+        self.cache = artifact_cache.CacheStats()
+        self.transfers: dict[str, _Transfer] = {}       # in progress
+        self.results: dict[str, dict] = {}
+        self.bytes_sent = 0                             # finished transfers
+        self.started = 0.0
+        self.cancelled = False
+
+    async def emit(self, event: dict) -> None:
+        if not self.cancelled:
+            await self.events.put(event)
+
+    async def log(self, message: str, level: int = logging.INFO) -> None:
+        logger.log(level, message)
+        await self.emit({"type": "log", "message": message})
+
+    @property
+    def cap(self) -> int:
+        """Bytes per second this run may send at most; 0 when nothing limits it."""
+        caps = [t.rate for t in (self.throttle, self.throttle.parent) if t is not None and t.rate]
+        return min(caps) if caps else 0
+
+    # ── Running ──────────────────────────────────────────────────────────────
+    async def run(self) -> None:
+        name = self.artifact.path.name
+        capped = f", up to {self.cap / MB:g} MB/s" if self.cap else ""
+        await self.log(f"🚀 Sending {name} ({self.artifact.size / MB:.1f} MB) to {len(self.hosts)} host(s), "
+                       f"{self.concurrency} at a time{capped}")
+        reporter = None
+        try:
+            # Check port 22 on every host at once so dead hosts don't each cost an SSH timeout
+            reach = {}
+            if self.probe and tcp_probe.prober.enabled:
+                await self.log(f"🔎 Checking port 22 on {len(self.hosts)} host(s)...")
+                reach = await tcp_probe.prober.check_all(self.hosts)
+                down = sum(1 for ok, _ in reach.values() if not ok)
+                if down:
+                    await self.log(f"⚠ {down} host(s) unreachable, skipping them", logging.WARNING)
+            pending = iter(self.hosts)
+
+            async def worker():
+                for host in pending:
+                    ok, error = reach.get(host, (True, None))
+                    if ok:
+                        await self._send_host(host)
+                    else:
+                        self.results[host] = {"ok": False, "error": error, "skipped": True}
+                        await self.log(f"[{host}] ❌ Skipped: {error}", logging.WARNING)
+
+            self.started = time.monotonic()
+            reporter = asyncio.create_task(self._report())
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        except asyncio.CancelledError:
+            # Nobody reads the queue any more: drop what is in it and what comes
+            logger.info("Upload run %s cancelled", self.id)
+            self.cancelled = True
+            while not self.events.empty():
+                self.events.get_nowait()
+            raise
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+        duration = time.monotonic() - self.started
+        await self._summary(duration)
+        await self.events.put(None)
+
+    async def _send_host(self, host: str) -> None:
+        started = time.monotonic()
+        transfer = None
+        try:
+            await self.log(f"[{host}] Connecting...")
+            async with ssh_pool.pool.connection(host, self.ssh_user, self.ssh_pass) as conn:
+                result = await conn.run(f"mkdir -p {self.remote_dir}", check=False)
+                if result.exit_status == 0:
+                    await self.log(f"[{host}] 📁 Ensured directory {self.remote_dir} exists")
+                else:
+                    await self.log(f"[{host}] ⚠ Failed to mkdir: {result.stderr}", logging.WARNING)
+
+                remote_full = f"{self.remote_dir}/{self.artifact.path.name}"
+                transfer = self.transfers[host] = _Transfer(self.artifact.size)
+
+                def progress(sent: int) -> None:
+                    transfer.sent = sent
+
+                hit = await artifact_cache.place(conn, self.artifact, remote_full, self.cache,
+                                                 throttle=self.throttle, progress=progress)
+            duration = time.monotonic() - started
+            if hit:
+                await self.log(f"[{host}] ✅ Copied to {remote_full} from the host's cache")
+            else:
+                rate = transfer.rate()
+                await self.log(f"[{host}] ✅ Uploaded to {remote_full} "
+                               f"({transfer.sent / MB:.1f} MB at {rate / MB:.1f} MB/s)")
+            self.results[host] = {"ok": True, "cached": hit, "bytes_sent": transfer.sent,
+                                  "duration_sec": round(duration, 2)}
+        except Exception as e:
+            self.results[host] = {"ok": False, "error": str(e) or type(e).__name__,
+                                  "bytes_sent": transfer.sent if transfer else 0}
+            await self.log(f"[{host}] ❌ Upload failed: {e}", logging.ERROR)
+        finally:
+            if transfer is not None:
+                # A failed transfer still used the link for what it sent
+                self.bytes_sent += transfer.sent
+                self.transfers.pop(host, None)
+
+    # ── Progress ─────────────────────────────────────────────────────────────
+    def sent(self) -> int:
+        return self.bytes_sent + sum(t.sent for t in self.transfers.values())
+
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.sent() / elapsed if elapsed > 0 else 0.0
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            moved = []
+            for host, transfer in list(self.transfers.items()):
+                if transfer.sent != transfer.reported:
+                    transfer.reported = transfer.sent
+                    moved.append(transfer.progress(host))
+            if moved:
+                await self.emit({"type": "progress", "hosts": moved, "sent": self.sent(),
+                                 "rate": round(self.rate())})
+
+    async def _summary(self, duration: float) -> None:
+        ok = sum(1 for r in self.results.values() if r["ok"])
+        skipped = sum(1 for r in self.results.values() if r.get("skipped"))
+        rate = self.bytes_sent / duration if duration > 0 else 0.0
+        if self.cache.hits + self.cache.misses:
+            summary = self.cache.summary()
+            await self.log(f" 📦 Host cache: {self.cache.hits} hit(s), {self.cache.misses} miss(es), "
+                           f"{summary['hit_rate']:.0%} hit rate, {self.cache.bytes_saved / MB:.1f} MB not sent")
+        capped = f" (cap {self.cap / MB:g} MB/s)" if self.cap else ""
+        await self.log(f" 📊 {ok}/{len(self.hosts)} host(s) done, {self.bytes_sent / MB:.1f} MB sent "
+                       f"in {duration:.1f}s: {rate / MB:.1f} MB/s aggregate{capped}")
+        await self.emit({
+            "type": "summary",
+            "run_id": self.id,
+            "total_hosts": len(self.hosts),
+            "success": ok,
+            "failure": len(self.hosts) - ok - skipped,
+            "unreachable": skipped,
+            "duration_sec": round(duration, 2),
+            "bytes_sent": self.bytes_sent,
+            "rate": round(rate),
+            "max_bytes_per_sec": self.cap,
+            "artifact_cache": self.cache.summary(),
+            "results": self.results,
+        })
+        await self.log(" 🧭 Upload finished - look for errors if they occured")
@@ -0,0 +1,75 @@
+# upload_spool.py
+"""Move uploaded files to disk in fixed-size chunks, hashing them on the way.
+
+:func:`spool` copies the multipart upload's temporary file into a directory
+of its own under ``UPLOAD_SPOOL_DIR``, ``CHUNK_BYTES`` at a time, on a worker
+thread. It computes the SHA-256 in the same pass for the
+:mod:`artifact_cache`. Memory per upload stays at one chunk. :func:`discard`
+removes the directory once the run is over.
+"""
+
+import asyncio
+import hashlib
+import os
+import secrets
+import shutil
+from pathlib import Path
+
+from fastapi import UploadFile
+
+import artifact_cache
+from settings import env_int
+
+
+SPOOL_DIR = Path(os.getenv("UPLOAD_SPOOL_DIR", "/tmp/uploads"))
+CHUNK_BYTES = max(64, env_int("UPLOAD_SPOOL_CHUNK_KB", 1024)) * 1024
+
+# Spool activity in this worker
+active = 0
+spooled_files = 0
+spooled_bytes = 0
+
+
+def _copy(src, dest: Path) -> tuple[int, str]:
+    digest = hashlib.sha256()
+    size = 0
+    src.seek(0)
+    with open(dest, "wb") as out:
+        while chunk := src.read(CHUNK_BYTES):
+            digest.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+async def spool(upload: UploadFile) -> artifact_cache.Artifact:
+    """Copy ``upload`` to a fresh directory off the event loop; returns it hashed."""
+    global active, spooled_files, spooled_bytes
+    directory = SPOOL_DIR / secrets.token_hex(8)
+    directory.mkdir(parents=True)
+    path = directory / (Path(upload.filename or "upload").name or "upload")
+    active += 1
+    try:
+        size, digest = await asyncio.to_thread(_copy, upload.file, path)
+    except BaseException:
+        discard(path)
+        raise
+    finally:
+        active -= 1
+    spooled_files += 1
+    spooled_bytes += size
+    return artifact_cache.Artifact(path, digest, size)
+
+
+def discard(path: Path) -> None:
+    """Remove a spooled file and its directory."""
+    shutil.rmtree(path.parent, ignore_errors=True)
+
+
+def stats() -> dict:
+    return {
+        "active": active,
+        "files": spooled_files,
+        "bytes": spooled_bytes,
+        "chunk_bytes": CHUNK_BYTES,
+    }